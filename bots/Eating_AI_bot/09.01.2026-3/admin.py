@@ -1,315 +1,470 @@
-from fastapi import FastAPI, Request, Form, Depends, HTTPException
-from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
-from sqlalchemy.orm import Session
-from database.base import SessionLocal, engine, Base
-from database.models import Block, BotUser, Trace, UserSession, UserParam
-import uvicorn
-import re
-import os
-
-# Create tables if not exist (for new columns/tables)
-Base.metadata.create_all(bind=engine)
-
-app = FastAPI()
-
-# Setup Templates
-templates_dir = os.path.join(os.path.dirname(__file__), "templates")
-if not os.path.exists(templates_dir):
-    os.makedirs(templates_dir)
-templates = Jinja2Templates(directory=templates_dir)
-
-# Dependency
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-@app.get("/", response_class=HTMLResponse)
-async def index(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
-
-# --- USERS ---
-@app.get("/users", response_class=HTMLResponse)
-async def list_users(request: Request, q: str = None, db: Session = Depends(get_db)):
-    query = db.query(BotUser)
-    if q:
-        search = f"%{q}%"
-        query = query.filter(
-            (BotUser.user_id.like(search)) | 
-            (BotUser.username.like(search)) | 
-            (BotUser.platform.like(search))
-        )
-    users = query.all()
-    return templates.TemplateResponse("users.html", {"request": request, "users": users, "q": q})
-
-@app.post("/users/create")
-async def create_user(user_id: str = Form(...), username: str = Form(None), platform: str = Form(...), db: Session = Depends(get_db)):
-    user = BotUser(user_id=user_id, username=username, platform=platform, is_active=True)
-    db.add(user)
-    db.commit()
-    return RedirectResponse(url="/users", status_code=303)
-
-@app.post("/users/{id}/toggle")
-async def toggle_user(id: int, db: Session = Depends(get_db)):
-    user = db.query(BotUser).filter(BotUser.id == id).first()
-    if user:
-        user.is_active = not user.is_active
-        db.commit()
-    return RedirectResponse(url="/users", status_code=303)
-
-@app.post("/users/{id}/delete")
-async def delete_user(id: int, db: Session = Depends(get_db)):
-    user = db.query(BotUser).filter(BotUser.id == id).first()
-    if user:
-        db.delete(user)
-        db.commit()
-    return RedirectResponse(url="/users", status_code=303)
-
-# --- WORKFLOW EDITOR ---
-@app.get("/workflow", response_class=HTMLResponse)
-async def workflow_editor(request: Request):
-    return templates.TemplateResponse("editor.html", {"request": request})
-
-@app.get("/api/graph")
-async def get_graph(db: Session = Depends(get_db)):
-    blocks = db.query(Block).all()
-    nodes = []
-    edges = []
-    
-    for b in blocks:
-        nodes.append({
-            "data": {"id": str(b.id), "name": b.name, "is_start": b.is_start},
-            "position": {"x": b.ui_x, "y": b.ui_y}
-        })
-        
-        # Parse script for go_to(ID)
-        # Regex to find go_to(123)
-        matches = re.findall(r"go_to\((\d+)\)", b.script_code)
-        for target_id in matches:
-            edges.append({
-                "data": {
-                    "source": str(b.id),
-                    "target": str(target_id)
-                }
-            })
-            
-    return {"nodes": nodes, "edges": edges}
-
-@app.post("/api/blocks/{id}/position")
-async def update_position(id: int, x: float = Form(...), y: float = Form(...), db: Session = Depends(get_db)):
-    block = db.query(Block).filter(Block.id == id).first()
-    if block:
-        block.ui_x = int(x)
-        block.ui_y = int(y)
-        db.commit()
-    return {"status": "ok"}
-
-@app.get("/api/blocks/{id}")
-async def get_block(id: int, db: Session = Depends(get_db)):
-    block = db.query(Block).filter(Block.id == id).first()
-    if not block:
-        raise HTTPException(status_code=404, detail="Block not found")
-    return {"id": block.id, "name": block.name, "script_code": block.script_code}
-
-@app.post("/api/blocks/{id}/save")
-async def save_block(id: int, script_code: str = Form(...), name: str = Form(...), db: Session = Depends(get_db)):
-    block = db.query(Block).filter(Block.id == id).first()
-    if block:
-        block.script_code = script_code
-        block.name = name
-        db.commit()
-    return {"status": "ok"}
-
-@app.post("/api/blocks/create")
-async def create_block(name: str = Form("New Block"), x: int = Form(0), y: int = Form(0), db: Session = Depends(get_db)):
-    # Find next available ID
-    last_block = db.query(Block).order_by(Block.id.desc()).first()
-    new_id = (last_block.id + 1) if last_block else 1
-    
-    new_block = Block(
-        id=new_id,
-        name=f"{name} {new_id}",
-        script_code="\nif event == 'enter':\n    send_message('New Block')\n",
-        ui_x=x,
-        ui_y=y
-    )
-    db.add(new_block)
-    db.commit()
-    return {"id": new_block.id, "name": new_block.name, "script_code": new_block.script_code, "ui_x": new_block.ui_x, "ui_y": new_block.ui_y}
-
-@app.post("/api/blocks/{id}/delete")
-async def delete_block(id: int, db: Session = Depends(get_db)):
-    block = db.query(Block).filter(Block.id == id).first()
-    if block:
-        db.delete(block)
-        db.commit()
-    return {"status": "ok"}
-
-@app.post("/api/validate_code")
-async def validate_code(script_code: str = Form(...)):
-    # Mock context
-    output_log = []
-    def mock_send_message(
-    text,
-    buttons=None,
-    parse_mode="text",
-    request_contact=False):
-        output_log.append(
-        f"send_message: text='{text}', "
-        f"buttons={buttons}, "
-        f"parse_mode={parse_mode}, "
-        f"request_contact={request_contact}")
-        
-    #def mock_send_message(text, buttons=None):
-    #    output_log.append(f"send_message: {text} (Buttons: {buttons})")
-    
-    def mock_set_param(key, value):
-        output_log.append(f"set_param: {key} = {value}")
-        
-    def mock_get_param(key):
-        return "mock_value"
-        
-    def mock_go_to(block_id):
-        output_log.append(f"go_to: {block_id}")
-        
-    def mock_module_start(name):
-        output_log.append(f"ModuleStart: {name}")
-
-    def mock_call_module(name, func, *args):
-        return f"Mock result from {name}.{func}"
-
-    context = {
-        'input_text': 'test_input',
-        'event': 'message',
-        'set_param': mock_set_param,
-        'get_param': mock_get_param,
-        'send_message': mock_send_message,
-        'go_to': mock_go_to,
-        'ModuleStart': mock_module_start,
-        'call_module': mock_call_module,
-        'print': lambda *args: output_log.append(" ".join(map(str, args)))
-    }
-    
-    try:
-        exec(script_code, context)
-        return {"status": "ok", "output": "\n".join(output_log)}
-    except Exception as e:
-        import traceback
-        tb = traceback.extract_tb(e.__traceback__)
-        # Find the line number in the script (not the wrapper)
-        line_no = -1
-        for frame in tb:
-            if frame.filename == "<string>":
-                line_no = frame.lineno
-                break
-        
-        return {"status": "error", "message": str(e), "line": line_no}
-
-@app.post("/api/format_code")
-async def format_code(script_code: str = Form(...)):
-    try:
-        import black
-        formatted = black.format_str(script_code, mode=black.Mode())
-        return {"status": "ok", "formatted_code": formatted}
-    except Exception as e:
-        return {"status": "error", "message": str(e)}
-
-# --- TRACE ---
-@app.get("/trace", response_class=HTMLResponse)
-async def view_trace(request: Request, user_id: str = None, q: str = None, db: Session = Depends(get_db)):
-    # Get all users who have sessions, optionally filtered
-    session_query = db.query(UserSession)
-    
-    if q:
-        # Join with BotUser to search by username
-        # Note: This assumes UserSession.user_id matches BotUser.user_id. 
-        # Ideally we should have a relationship, but for now we can filter manually or join.
-        # Let's try a simple join if possible, or just filter by user_id if no relationship.
-        # Given the models, UserSession doesn't have a direct relationship to BotUser defined in models.py shown earlier.
-        # So we'll filter by user_id or platform on UserSession, and if possible filter by username via subquery or join.
-        # For simplicity and speed, let's fetch all and filter in python or do a join if we add it.
-        # Let's do a join with BotUser.
-        session_query = session_query.outerjoin(BotUser, (UserSession.user_id == BotUser.user_id) & (UserSession.platform == BotUser.platform))
-        search = f"%{q}%"
-        session_query = session_query.filter(
-            (UserSession.user_id.like(search)) |
-            (BotUser.username.like(search)) |
-            (UserSession.platform.like(search))
-        )
-    
-    sessions = session_query.all()
-    
-    # Pre-fetch user info for display (username)
-    # We can create a map of user_id -> username
-    user_map = {}
-    bot_users = db.query(BotUser).all()
-    for bu in bot_users:
-        user_map[bu.user_id] = bu.username
-
-    selected_user_data = None
-    traces = []
-    
-    if user_id:
-        # Get specific session info
-        user_session = db.query(UserSession).filter(UserSession.user_id == user_id).first()
-        params = db.query(UserParam).filter(UserParam.user_id == user_id).all()
-        traces = db.query(Trace).filter(Trace.user_id == user_id).order_by(Trace.created_at.desc()).limit(100).all()
-        
-        # Get all blocks for the dropdown
-        all_blocks = db.query(Block).all()
-        
-        selected_user_data = {
-            "session": user_session,
-            "params": params,
-            "blocks": all_blocks,
-            "username": user_map.get(user_id)
-        }
-    else:
-        # Just show recent traces if no user selected
-        traces = db.query(Trace).order_by(Trace.created_at.desc()).limit(100).all()
-
-    return templates.TemplateResponse("trace.html", {
-        "request": request, 
-        "sessions": sessions, 
-        "user_map": user_map,
-        "selected_user_id": user_id,
-        "selected_data": selected_user_data,
-        "traces": traces,
-        "q": q
-    })
-
-@app.post("/api/session/{user_id}/block")
-async def update_session_block(user_id: str, block_id: int = Form(...), db: Session = Depends(get_db)):
-    session = db.query(UserSession).filter(UserSession.user_id == user_id).first()
-    if session:
-        session.current_block_id = block_id
-        db.commit()
-    return RedirectResponse(url=f"/trace?user_id={user_id}", status_code=303)
-
-
-
-
-
-if __name__ == "__main__":
-    admin_ip = os.getenv("ADMIN_IP")
-    if not admin_ip:
-        print("Error: ADMIN_IP not found in .env")
-        admin_ip = "127.0.0.1"
-
-    admin_port_def = 8005 
-    admin_port = os.getenv("ADMIN_PORT")
-    if not admin_port:
-        print("Error: ADMIN_IP not found in .env")
-        admin_port = admin_port_def
-    else:
-        # Преобразуем строку в число
-        try:
-            admin_port = int(admin_port)
-        except ValueError:
-            print(f"Error: ADMIN_PORT must be a number, got '{admin_port}'")
-            admin_port = admin_port_def
-    uvicorn.run(app, host=admin_ip, port=admin_port)
+from fastapi import FastAPI, Request, Form, Depends, HTTPException
+from fastapi.templating import Jinja2Templates
+from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from database.base import SessionLocal, engine, Base
+from database.models import Block, BotUser, Trace, TraceArchive, TraceRollup, UserSession, Workflow
+from database.versions import bump_version, SCENARIO, STATE, USERS
+from database.trace_archive import read_archive
+from database.params import read_params
+from datetime import date, timedelta
+from engine.code_cache import block_code_cache
+import migrate_user_params
+import migrate_block_heavy
+import migrate_workflows
+import aiohttp
+import uvicorn
+import csv
+import io
+import re
+import os
+
+# Create tables if not exist (for new columns/tables); same steps as main.py
+Base.metadata.create_all(bind=engine)
+migrate_user_params.migrate(engine)
+migrate_block_heavy.migrate(engine)
+migrate_workflows.migrate(engine)
+
+app = FastAPI()
+
+# Metrics endpoint of the bot process (engine/metrics.py)
+BOT_METRICS_URL = os.getenv("BOT_METRICS_URL", "http://127.0.0.1:9101")
+# Rows fetched per round trip by the CSV exports
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "1000"))
+
+# Setup Templates
+templates_dir = os.path.join(os.path.dirname(__file__), "templates")
+if not os.path.exists(templates_dir):
+    os.makedirs(templates_dir)
+templates = Jinja2Templates(directory=templates_dir)
+
+# Dependency
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+@app.get("/", response_class=HTMLResponse)
+async def index(request: Request):
+    return templates.TemplateResponse("index.html", {"request": request})
+
+# --- USERS ---
+@app.get("/users", response_class=HTMLResponse)
+async def list_users(request: Request, q: str = None, db: Session = Depends(get_db)):
+    query = db.query(BotUser)
+    if q:
+        search = f"%{q}%"
+        query = query.filter(
+            (BotUser.user_id.like(search)) | 
+            (BotUser.username.like(search)) | 
+            (BotUser.platform.like(search))
+        )
+    users = query.all()
+    return templates.TemplateResponse("users.html", {"request": request, "users": users, "q": q})
+
+@app.post("/users/create")
+async def create_user(user_id: str = Form(...), username: str = Form(None), platform: str = Form(...), db: Session = Depends(get_db)):
+    user = BotUser(user_id=user_id, username=username, platform=platform, is_active=True)
+    db.add(user)
+    bump_version(db, USERS)
+    db.commit()
+    return RedirectResponse(url="/users", status_code=303)
+
+@app.post("/users/{id}/toggle")
+async def toggle_user(id: int, db: Session = Depends(get_db)):
+    user = db.query(BotUser).filter(BotUser.id == id).first()
+    if user:
+        user.is_active = not user.is_active
+        # The bot drops its cached copy of bot_users when this changes
+        bump_version(db, USERS)
+        db.commit()
+    return RedirectResponse(url="/users", status_code=303)
+
+@app.post("/users/{id}/delete")
+async def delete_user(id: int, db: Session = Depends(get_db)):
+    user = db.query(BotUser).filter(BotUser.id == id).first()
+    if user:
+        db.delete(user)
+        bump_version(db, USERS)
+        db.commit()
+    return RedirectResponse(url="/users", status_code=303)
+
+# --- WORKFLOW EDITOR ---
+@app.get("/workflow", response_class=HTMLResponse)
+async def workflow_editor(request: Request):
+    return templates.TemplateResponse("editor.html", {"request": request})
+
+@app.get("/api/graph")
+async def get_graph(workflow_id: int = 0, db: Session = Depends(get_db)):
+    blocks = db.query(Block).filter(Block.workflow_id == workflow_id).all()
+    nodes = []
+    edges = []
+    
+    for b in blocks:
+        nodes.append({
+            "data": {"id": str(b.id), "name": b.name, "is_start": b.is_start, "is_heavy": bool(b.is_heavy)},
+            "position": {"x": b.ui_x, "y": b.ui_y}
+        })
+        
+        # Parse script for go_to(ID)
+        # Regex to find go_to(123)
+        matches = re.findall(r"go_to\((\d+)\)", b.script_code)
+        for target_id in matches:
+            edges.append({
+                "data": {
+                    "source": str(b.id),
+                    "target": str(target_id)
+                }
+            })
+            
+    return {"nodes": nodes, "edges": edges}
+
+@app.get("/api/metrics/blocks")
+async def get_block_metrics():
+    # Numbers live in the bot process; the editor overlays them on the nodes
+    try:
+        timeout = aiohttp.ClientTimeout(total=3)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.get(f"{BOT_METRICS_URL}/metrics/blocks") as resp:
+                resp.raise_for_status()
+                return {"status": "ok", "blocks": await resp.json()}
+    except Exception as e:
+        return {"status": "error", "message": f"Bot metrics unavailable: {e}", "blocks": {}}
+
+# --- WORKFLOWS ---
+# The bot (RUN_MODE=workflows) starts and stops them within WORKFLOW_POLL_INTERVAL seconds
+@app.get("/api/workflows")
+async def list_workflows(db: Session = Depends(get_db)):
+    return [
+        {"id": w.id, "name": w.name, "status": w.status, "is_active": bool(w.is_active),
+         "has_token": bool(w.telegram_token)}
+        for w in db.query(Workflow).order_by(Workflow.id).all()
+    ]
+
+@app.post("/api/workflows/{id}/{action}")
+async def set_workflow_status(id: int, action: str, db: Session = Depends(get_db)):
+    if action not in ("start", "stop"):
+        raise HTTPException(status_code=404, detail="Unknown action")
+    workflow = db.query(Workflow).filter(Workflow.id == id).first()
+    if not workflow:
+        raise HTTPException(status_code=404, detail="Workflow not found")
+    workflow.status = "running" if action == "start" else "stopped"
+    db.commit()
+    return {"status": "ok", "workflow_status": workflow.status}
+
+@app.post("/api/blocks/{id}/position")
+async def update_position(id: int, x: float = Form(...), y: float = Form(...), db: Session = Depends(get_db)):
+    block = db.query(Block).filter(Block.id == id).first()
+    if block:
+        block.ui_x = int(x)
+        block.ui_y = int(y)
+        db.commit()
+    return {"status": "ok"}
+
+@app.get("/api/blocks/{id}")
+async def get_block(id: int, db: Session = Depends(get_db)):
+    block = db.query(Block).filter(Block.id == id).first()
+    if not block:
+        raise HTTPException(status_code=404, detail="Block not found")
+    return {"id": block.id, "name": block.name, "script_code": block.script_code, "is_heavy": bool(block.is_heavy)}
+
+@app.post("/api/blocks/{id}/save")
+async def save_block(id: int, script_code: str = Form(...), name: str = Form(...), is_heavy: bool = Form(False),
+                     db: Session = Depends(get_db)):
+    block = db.query(Block).filter(Block.id == id).first()
+    if block:
+        block.script_code = script_code
+        block.name = name
+        block.is_heavy = is_heavy
+        bump_version(db, SCENARIO)
+        db.commit()
+        block_code_cache.invalidate(id)
+    return {"status": "ok"}
+
+@app.post("/api/blocks/create")
+async def create_block(name: str = Form("New Block"), x: int = Form(0), y: int = Form(0), workflow_id: int = Form(0),
+                       db: Session = Depends(get_db)):
+    # Find next available ID
+    last_block = db.query(Block).order_by(Block.id.desc()).first()
+    new_id = (last_block.id + 1) if last_block else 1
+    
+    new_block = Block(
+        id=new_id,
+        name=f"{name} {new_id}",
+        workflow_id=workflow_id,
+        script_code="\nif event == 'enter':\n    send_message('New Block')\n",
+        ui_x=x,
+        ui_y=y
+    )
+    db.add(new_block)
+    bump_version(db, SCENARIO)
+    db.commit()
+    return {"id": new_block.id, "name": new_block.name, "script_code": new_block.script_code, "ui_x": new_block.ui_x, "ui_y": new_block.ui_y}
+
+@app.post("/api/blocks/{id}/delete")
+async def delete_block(id: int, db: Session = Depends(get_db)):
+    block = db.query(Block).filter(Block.id == id).first()
+    if block:
+        db.delete(block)
+        bump_version(db, SCENARIO)
+        db.commit()
+        block_code_cache.invalidate(id)
+    return {"status": "ok"}
+
+@app.post("/api/validate_code")
+async def validate_code(script_code: str = Form(...)):
+    # Mock context
+    output_log = []
+    def mock_send_message(
+    text,
+    buttons=None,
+    parse_mode="text",
+    request_contact=False):
+        output_log.append(
+        f"send_message: text='{text}', "
+        f"buttons={buttons}, "
+        f"parse_mode={parse_mode}, "
+        f"request_contact={request_contact}")
+        
+    #def mock_send_message(text, buttons=None):
+    #    output_log.append(f"send_message: {text} (Buttons: {buttons})")
+    
+    def mock_set_param(key, value):
+        output_log.append(f"set_param: {key} = {value}")
+        
+    def mock_get_param(key):
+        return "mock_value"
+
+    def mock_get_params(keys):
+        return {key: "mock_value" for key in keys}
+        
+    def mock_go_to(block_id):
+        output_log.append(f"go_to: {block_id}")
+        
+    def mock_module_start(name):
+        output_log.append(f"ModuleStart: {name}")
+
+    def mock_call_module(name, func, *args):
+        return f"Mock result from {name}.{func}"
+
+    context = {
+        'input_text': 'test_input',
+        'event': 'message',
+        'set_param': mock_set_param,
+        'get_param': mock_get_param,
+        'get_params': mock_get_params,
+        'send_message': mock_send_message,
+        'go_to': mock_go_to,
+        'ModuleStart': mock_module_start,
+        'call_module': mock_call_module,
+        'print': lambda *args: output_log.append(" ".join(map(str, args)))
+    }
+    
+    try:
+        exec(script_code, context)
+        return {"status": "ok", "output": "\n".join(output_log)}
+    except Exception as e:
+        import traceback
+        tb = traceback.extract_tb(e.__traceback__)
+        # Find the line number in the script (not the wrapper)
+        line_no = -1
+        for frame in tb:
+            if frame.filename == "<string>":
+                line_no = frame.lineno
+                break
+        
+        return {"status": "error", "message": str(e), "line": line_no}
+
+@app.post("/api/format_code")
+async def format_code(script_code: str = Form(...)):
+    try:
+        import black
+        formatted = black.format_str(script_code, mode=black.Mode())
+        return {"status": "ok", "formatted_code": formatted}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+# --- TRACE ---
+@app.get("/trace", response_class=HTMLResponse)
+async def view_trace(request: Request, user_id: str = None, workflow_id: int = 0, q: str = None,
+                     db: Session = Depends(get_db)):
+    # Get all users who have sessions, optionally filtered
+    session_query = db.query(UserSession)
+    
+    if q:
+        # Join with BotUser to search by username
+        # Note: This assumes UserSession.user_id matches BotUser.user_id. 
+        # Ideally we should have a relationship, but for now we can filter manually or join.
+        # Let's try a simple join if possible, or just filter by user_id if no relationship.
+        # Given the models, UserSession doesn't have a direct relationship to BotUser defined in models.py shown earlier.
+        # So we'll filter by user_id or platform on UserSession, and if possible filter by username via subquery or join.
+        # For simplicity and speed, let's fetch all and filter in python or do a join if we add it.
+        # Let's do a join with BotUser.
+        session_query = session_query.outerjoin(BotUser, (UserSession.user_id == BotUser.user_id) & (UserSession.platform == BotUser.platform)
+                                                & (UserSession.workflow_id == BotUser.workflow_id))
+        search = f"%{q}%"
+        session_query = session_query.filter(
+            (UserSession.user_id.like(search)) |
+            (BotUser.username.like(search)) |
+            (UserSession.platform.like(search))
+        )
+    
+    sessions = session_query.all()
+    
+    # Pre-fetch user info for display (username)
+    # We can create a map of (workflow_id, user_id) -> username
+    user_map = {}
+    bot_users = db.query(BotUser).all()
+    for bu in bot_users:
+        user_map[(bu.workflow_id, bu.user_id)] = bu.username
+
+    selected_user_data = None
+    traces = []
+    
+    if user_id:
+        # Get specific session info; the same user id may talk to several workflows
+        user_session = db.query(UserSession).filter(UserSession.user_id == user_id,
+                                                    UserSession.workflow_id == workflow_id).first()
+        params = [{"key": k, "value": v} for k, v in read_params(db, user_id, workflow_id=workflow_id).items()]
+        traces = db.query(Trace).filter(Trace.user_id == user_id, Trace.workflow_id == workflow_id)\
+            .order_by(Trace.created_at.desc()).limit(100).all()
+        
+        # Blocks of the user's workflow for the dropdown
+        all_blocks = db.query(Block).filter(Block.workflow_id == workflow_id).all()
+        
+        selected_user_data = {
+            "session": user_session,
+            "params": params,
+            "blocks": all_blocks,
+            "username": user_map.get((workflow_id, user_id))
+        }
+    else:
+        # Just show recent traces if no user selected
+        traces = db.query(Trace).order_by(Trace.created_at.desc()).limit(100).all()
+
+    return templates.TemplateResponse("trace.html", {
+        "request": request, 
+        "sessions": sessions, 
+        "user_map": user_map,
+        "selected_user_id": user_id,
+        "selected_workflow_id": workflow_id,
+        "selected_data": selected_user_data,
+        "traces": traces,
+        "q": q
+    })
+
+@app.get("/trace/archive", response_class=HTMLResponse)
+async def view_trace_archive(request: Request, day: str = None, user_id: str = None, db: Session = Depends(get_db)):
+    days = db.query(TraceArchive).order_by(TraceArchive.day.desc()).all()
+
+    selected_day = None
+    rollups = []
+    traces = []
+    if day:
+        try:
+            selected_day = date.fromisoformat(day)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="day must be YYYY-MM-DD")
+        rollups = db.query(TraceRollup).filter(TraceRollup.day == selected_day)\
+            .order_by(TraceRollup.messages.desc()).all()
+        traces = read_archive(selected_day, user_id=user_id or None)
+
+    block_names = {b.id: b.name for b in db.query(Block.id, Block.name).all()}
+
+    return templates.TemplateResponse("trace_archive.html", {
+        "request": request,
+        "days": days,
+        "selected_day": selected_day,
+        "rollups": rollups,
+        "block_names": block_names,
+        "traces": traces,
+        "user_id": user_id
+    })
+
+# --- EXPORTS ---
+def stream_csv(statement):
+    """
+    CSV of `statement`, EXPORT_BATCH rows at a time. stream_results makes
+    PostgreSQL use a server-side cursor, so the table is never held in
+    memory here; the connection is kept until the download finishes.
+    """
+    buffer = io.StringIO()
+    out = csv.writer(buffer)
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=EXPORT_BATCH).execute(statement)
+        out.writerow(result.keys())
+        for rows in result.partitions():
+            out.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def csv_response(statement, filename: str):
+    return StreamingResponse(stream_csv(statement), media_type="text/csv",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+@app.get("/users/export.csv")
+async def export_users():
+    return csv_response(select(BotUser.__table__).order_by(BotUser.id), "users.csv")
+
+
+@app.get("/trace/export.csv")
+async def export_trace(user_id: str = None, workflow_id: int = None, day: str = None):
+    statement = select(Trace.__table__).order_by(Trace.id)
+    if user_id:
+        statement = statement.where(Trace.user_id == user_id)
+    if workflow_id is not None:
+        statement = statement.where(Trace.workflow_id == workflow_id)
+    if day:
+        try:
+            selected_day = date.fromisoformat(day)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="day must be YYYY-MM-DD")
+        statement = statement.where(Trace.created_at >= selected_day, Trace.created_at < selected_day + timedelta(days=1))
+    return csv_response(statement, f"trace{'_' + user_id if user_id else ''}{'_' + day if day else ''}.csv")
+
+
+@app.post("/api/session/{user_id}/block")
+async def update_session_block(user_id: str, block_id: int = Form(...), workflow_id: int = Form(0),
+                               db: Session = Depends(get_db)):
+    if not db.query(Block.id).filter(Block.id == block_id, Block.workflow_id == workflow_id).first():
+        raise HTTPException(status_code=400, detail="block is not in this workflow")
+    session = db.query(UserSession).filter(UserSession.user_id == user_id,
+                                           UserSession.workflow_id == workflow_id).first()
+    if session:
+        session.current_block_id = block_id
+        # The bot drops its cached sessions when this changes
+        bump_version(db, STATE)
+        db.commit()
+    return RedirectResponse(url=f"/trace?user_id={user_id}&workflow_id={workflow_id}", status_code=303)
+
+
+
+
+
+if __name__ == "__main__":
+    admin_ip = os.getenv("ADMIN_IP")
+    if not admin_ip:
+        print("Error: ADMIN_IP not found in .env")
+        admin_ip = "127.0.0.1"
+
+    admin_port_def = 8005 
+    admin_port = os.getenv("ADMIN_PORT")
+    if not admin_port:
+        print("Error: ADMIN_IP not found in .env")
+        admin_port = admin_port_def
+    else:
+        # Преобразуем строку в число
+        try:
+            admin_port = int(admin_port)
+        except ValueError:
+            print(f"Error: ADMIN_PORT must be a number, got '{admin_port}'")
+            admin_port = admin_port_def
+    uvicorn.run(app, host=admin_ip, port=admin_port)
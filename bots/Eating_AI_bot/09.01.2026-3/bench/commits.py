@@ -0,0 +1,106 @@
+"""
+Commits and SQL statements per inbound message.
+
+Seeds a throwaway SQLite database with the seed.py scenario and walks
+a number of users through it via ChatbotEngine.process_message.
+
+Usage (from the project root):
+    python -m bench.commits --users 20
+
+Reference numbers for the seed.py walk (20 users, 11 messages each):
+    before the single unit of work:  4.91 commits, 16.8 statements / message
+    after:                           1.00 commits, 11.6 statements / message
+    with the buffered TraceWriter:   1.01 commits,  9.3 statements / message
+    with the preloaded UserState:    1.01 commits,  5.0 statements / message
+    with ON CONFLICT upserts:        1.01 commits,  4.7 statements / message
+    with the UserDirectory:          1.01 commits,  3.8 statements / message
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix="bench_"), "bench.db")
+os.environ["DB_URL"] = f"sqlite:///{DB_FILE}"
+
+from sqlalchemy import event  # noqa: E402
+from database.base import AsyncSessionLocal, async_engine  # noqa: E402
+from engine.core import ChatbotEngine  # noqa: E402
+import seed  # noqa: E402
+
+# One full walk through seed.py (AI_Chat is left out, it needs the network)
+SCRIPT = [
+    "/start",
+    "Собрать данные", "Иван Иванов", "30", "Мужской", "180", "80",
+    "Расчёт калорий",
+    "Вывести всю информацию",
+    "непонятно",
+    "Собрать данные",
+]
+
+USER_DATA = {
+    "username": "bench",
+    "first_name": "Bench",
+    "last_name": "User",
+    "language_code": "ru",
+    "is_premium": False,
+    "contact": None,
+}
+
+
+class NullConnector:
+    """Connector that only counts outgoing messages."""
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, user_id, text, buttons=None, parse_mode="text", request_contact=False):
+        self.sent += 1
+
+
+class Counters:
+    def __init__(self):
+        self.commits = 0
+        self.statements = 0
+
+    def on_commit(self, conn):
+        self.commits += 1
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+
+
+async def run(users: int):
+    seed.seed()
+
+    counters = Counters()
+    event.listen(async_engine.sync_engine, "commit", counters.on_commit)
+    event.listen(async_engine.sync_engine, "before_cursor_execute", counters.on_execute)
+
+    connector = NullConnector()
+    chatbot_engine = ChatbotEngine(AsyncSessionLocal, connector)
+
+    messages = 0
+    started = time.perf_counter()
+    for n in range(users):
+        for text in SCRIPT:
+            await chatbot_engine.process_message(str(100000 + n), "telegram", text, USER_DATA)
+            messages += 1
+    await chatbot_engine.close()
+    elapsed = time.perf_counter() - started
+    await async_engine.dispose()
+
+    print(f"users:               {users}")
+    print(f"messages:            {messages}")
+    print(f"outbound messages:   {connector.sent}")
+    print(f"commits / message:   {counters.commits / messages:.2f}")
+    print(f"SQL stmts / message: {counters.statements / messages:.2f}")
+    print(f"messages / sec:      {messages / elapsed:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args.users))
@@ -0,0 +1,150 @@
+"""
+Local fake of the Telegram Bot API.
+
+Answers getMe / getUpdates / deleteWebhook / sendMessage well enough for
+aiogram, enforces Telegram-like flood limits (HTTP 429 with retry_after)
+and records what every chat received, in arrival order.
+
+Standalone:
+    python -m bench.fake_bot_api --port 8081
+    TG_API_URL=http://127.0.0.1:8081 python main.py
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import defaultdict, deque
+from aiohttp import web
+
+
+class FakeBotAPI:
+    def __init__(self, global_limit: int = 30, chat_limit: int = 1, window: float = 1.0,
+                 host: str = "127.0.0.1", port: int = 8081):
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+        self.window = window
+        self.host = host
+        self.port = port
+
+        self.received = defaultdict(list)  # chat_id -> [text, ...]
+        self.updates = []  # queued for getUpdates
+        self.flood_errors = 0
+        self._global_times = deque()
+        self._chat_times = defaultdict(deque)
+        self._message_id = 0
+        self._update_id = 0
+        self._runner = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def push_update(self, update: dict):
+        """Queue an update for the next getUpdates call."""
+        self._update_id += 1
+        self.updates.append(dict(update, update_id=self._update_id))
+
+    # ───────────────────────────────
+    # Bot API methods
+    # ───────────────────────────────
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"].lower()
+        data = dict(await request.post())
+
+        if method == "getme":
+            return self._ok({"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"})
+        if method in ("deletewebhook", "setwebhook", "close"):
+            return self._ok(True)
+        if method == "getupdates":
+            return await self._get_updates(data)
+        if method == "sendmessage":
+            return self._send_message(data)
+        return web.json_response({"ok": False, "error_code": 404, "description": "Not Found"}, status=404)
+
+    async def _get_updates(self, data: dict):
+        offset = int(data.get("offset") or 0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates:
+            await asyncio.sleep(min(float(data.get("timeout") or 0), 1.0))
+        return self._ok(self.updates[:100])
+
+    def _send_message(self, data: dict):
+        chat_id = str(data["chat_id"])
+        now = time.monotonic()
+
+        retry_after = self._flood_check(self._global_times, self.global_limit, now)
+        retry_after = max(retry_after, self._flood_check(self._chat_times[chat_id], self.chat_limit, now))
+        if retry_after:
+            self.flood_errors += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after},
+            }, status=429)
+
+        self._global_times.append(now)
+        self._chat_times[chat_id].append(now)
+        self.received[chat_id].append(data.get("text"))
+
+        self._message_id += 1
+        return self._ok({
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "text": data.get("text"),
+        })
+
+    def _flood_check(self, times: deque, limit: int, now: float) -> int:
+        while times and now - times[0] >= self.window:
+            times.popleft()
+        if len(times) >= limit:
+            return max(1, int(self.window - (now - times[0]) + 0.999))
+        return 0
+
+    @staticmethod
+    def _ok(result):
+        return web.json_response({"ok": True, "result": result})
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self.received),
+            "received": sum(len(v) for v in self.received.values()),
+            "flood_errors": self.flood_errors,
+        }
+
+
+async def serve(args):
+    api = FakeBotAPI(args.global_limit, args.chat_limit, host=args.host, port=args.port)
+    await api.start()
+    print(f"Fake Bot API listening on {api.url}")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(json.dumps(api.stats()))
+    finally:
+        await api.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local fake of the Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--global-limit", type=int, default=30, help="messages per second, bot-wide")
+    parser.add_argument("--chat-limit", type=int, default=1, help="messages per second, per chat")
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,278 @@
+"""
+End-to-end load test: N concurrent users walk the seed.py scenario.
+
+Messages take the same path as in main.py: MemoryBotProvider ->
+MessageDispatcher -> ChatbotEngine.process_message, on a throwaway SQLite
+database; GigaAI is replaced by bench/stub_giga.py. Latency is measured
+from the connector callback to the end of process_message, so it
+includes the wait in the dispatcher queue.
+
+Every user runs the whole walk (menu, questionnaire, calculation, report,
+AI chat) `--rounds` times. Results are printed and saved as JSON so runs
+of different commits can be compared:
+
+    python -m bench.load --users 50
+    python -m bench.load --users 50 --compare bench/results/load-<older>.json
+
+--store picks the state store (see engine.store): sql, kv, or either with
+the LRU tier in front (sql+lru, kv+lru). Given several, each runs in its
+own subprocess on a fresh database and the latencies are compared:
+
+    python -m bench.load --users 50 --store sql sql+lru kv kv+lru
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix="bench_"), "bench.db")
+os.environ["DB_URL"] = f"sqlite:///{DB_FILE}"
+
+from sqlalchemy import event  # noqa: E402
+from connectors.memory import MemoryBotProvider  # noqa: E402
+from database.base import AsyncSessionLocal, SessionLocal, async_engine  # noqa: E402
+from database.models import Module  # noqa: E402
+from engine.core import ChatbotEngine  # noqa: E402
+from engine.dispatcher import DISPATCH_WORKERS, MessageDispatcher  # noqa: E402
+from engine.store import STATE_STORE, make_state_store  # noqa: E402
+import seed  # noqa: E402
+
+try:
+    import resource  # Unix only
+except ImportError:
+    resource = None
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+STUB_AI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_giga.py")
+
+WALK = [
+    "/start",
+    "Собрать данные", "Иван Иванов", "30", "Мужской", "180", "80",
+    "Расчёт калорий",
+    "Вывести всю информацию",
+    "AI Ассистент", "Сколько пить воды в день?", "Выход в меню",
+]
+
+
+class Counters:
+    def __init__(self):
+        self.commits = 0
+        self.statements = 0
+
+    def on_commit(self, conn):
+        self.commits += 1
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+
+
+def percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_db():
+    seed.seed()
+    db = SessionLocal()
+    try:
+        giga = db.query(Module).filter_by(name="GigaAI").first()
+        giga.py_file = STUB_AI
+        db.commit()
+    finally:
+        db.close()
+
+
+def state_store(name: str, cache_size: int):
+    store, _, tier = name.partition("+")
+    if tier not in ("", "lru"):
+        raise ValueError(f"Unknown state store: {name}")
+    return make_state_store(AsyncSessionLocal, store, cache_size if tier else 0,
+                            kv_path=os.path.join(os.path.dirname(DB_FILE), "state.kv"))
+
+
+class Tracker:
+    """Dispatcher handler that lets each simulated user wait for its message to be handled."""
+
+    def __init__(self, process_message):
+        self.process_message = process_message
+        self.waiting = {}  # user_id -> Future of the message being handled
+        self.failed = 0
+
+    async def handle(self, user_id, platform, text, user_data, workflow_id=0):
+        try:
+            await self.process_message(user_id, platform, text, user_data, workflow_id)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.waiting.pop(user_id).set_result(None)
+
+    async def send(self, provider: MemoryBotProvider, user_id: str, text: str, user_data: dict):
+        done = self.waiting[user_id] = asyncio.get_running_loop().create_future()
+        await provider.inject(user_id, text, user_data)
+        await done
+
+
+async def user_walk(provider: MemoryBotProvider, tracker: Tracker, user_id: str, rounds: int,
+                    think: float, latencies: list):
+    user_data = {"username": f"load{user_id}", "first_name": "Load", "language_code": "ru"}
+    for _ in range(rounds):
+        for text in WALK:
+            started = time.perf_counter()
+            await tracker.send(provider, user_id, text, user_data)
+            latencies.append(time.perf_counter() - started)
+            if think:
+                await asyncio.sleep(think)
+
+
+async def run(args) -> dict:
+    os.environ["STUB_AI_LATENCY_MS"] = str(args.ai_latency_ms)
+    prepare_db()
+
+    counters = Counters()
+    event.listen(async_engine.sync_engine, "commit", counters.on_commit)
+    event.listen(async_engine.sync_engine, "before_cursor_execute", counters.on_execute)
+
+    provider = MemoryBotProvider(keep=False)
+    chatbot_engine = ChatbotEngine(AsyncSessionLocal, provider,
+                                   state_store=state_store(args.store[0], args.cache_size))
+    tracker = Tracker(chatbot_engine.process_message)
+    dispatcher = MessageDispatcher(tracker.handle, workers=args.workers)
+    await dispatcher.start()
+    provider.set_callback(dispatcher.submit)
+
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        user_walk(provider, tracker, str(100000 + n), args.rounds, args.think_ms / 1000, latencies)
+        for n in range(args.users)
+    ))
+    elapsed = time.perf_counter() - started
+    await dispatcher.close()
+    await chatbot_engine.close()
+    await async_engine.dispose()
+
+    latencies.sort()
+    messages = len(latencies)
+    return {
+        "commit": git_commit(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "users": args.users,
+            "workers": args.workers,
+            "rounds": args.rounds,
+            "think_ms": args.think_ms,
+            "ai_latency_ms": args.ai_latency_ms,
+            "store": args.store[0],
+        },
+        "results": {
+            "messages": messages,
+            "failed": tracker.failed,
+            "outbound_messages": provider.sent_count,
+            "elapsed_s": round(elapsed, 3),
+            "messages_per_sec": round(messages / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "sql_per_message": round(counters.statements / messages, 2),
+            "commits_per_message": round(counters.commits / messages, 2),
+            "peak_rss_mb": peak_rss_mb(),
+        },
+    }
+
+
+def print_report(report: dict, baseline: dict = None):
+    print(f"commit {report['commit']}  {report['config']}")
+    for key, value in report["results"].items():
+        line = f"{key + ':':22}{value}"
+        old = baseline["results"].get(key) if baseline else None
+        if isinstance(old, (int, float)) and isinstance(value, (int, float)) and old:
+            line += f"   (was {old}, {(value - old) / old * 100:+.1f}%)"
+        print(line)
+
+
+def compare_stores(args) -> list:
+    """Run every --store in a subprocess and print their results side by side."""
+    reports = []
+    for name in args.store:
+        out = os.path.join(os.path.dirname(DB_FILE), f"{name}.json")
+        run_args = [sys.executable, "-m", "bench.load", "--store", name, "--out", out,
+                    "--users", str(args.users), "--workers", str(args.workers), "--rounds", str(args.rounds),
+                    "--think-ms", str(args.think_ms), "--ai-latency-ms", str(args.ai_latency_ms),
+                    "--cache-size", str(args.cache_size)]
+        done = subprocess.run(run_args, capture_output=True, text=True)
+        if done.returncode or not os.path.exists(out):
+            print(f"store={name} failed:\n{done.stdout}{done.stderr}")
+            continue
+        with open(out, encoding="utf-8") as f:
+            reports.append(json.load(f))
+
+    columns = ["messages_per_sec", "p50_ms", "p95_ms", "p99_ms", "sql_per_message", "failed"]
+    print(f"{'store':10}" + "".join(f"{column:>18}" for column in columns))
+    for report in reports:
+        results = report["results"]
+        print(f"{report['config']['store']:10}" + "".join(f"{results[column]:>18}" for column in columns))
+    return reports
+
+
+def save_report(report: dict, path: str = None) -> str:
+    if not path:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(RESULTS_DIR, f"load-{stamp}-{report['commit'] or 'nogit'}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end load test of the seed.py scenario")
+    parser.add_argument("--users", type=int, default=50, help="concurrent users")
+    parser.add_argument("--workers", type=int, default=DISPATCH_WORKERS, help="dispatcher workers")
+    parser.add_argument("--rounds", type=int, default=1, help="scenario walks per user")
+    parser.add_argument("--think-ms", type=float, default=0, help="pause between a user's messages")
+    parser.add_argument("--ai-latency-ms", type=float, default=50, help="answer time of the GigaAI stub")
+    parser.add_argument("--out", help="JSON file to write (default bench/results/load-<time>-<commit>.json)")
+    parser.add_argument("--compare", help="earlier JSON result to compare against")
+    parser.add_argument("--store", nargs="+", default=[STATE_STORE],
+                        help="state stores to compare: sql, kv, sql+lru, kv+lru")
+    parser.add_argument("--cache-size", type=int, default=10000, help="users in the LRU tier of +lru stores")
+    args = parser.parse_args()
+
+    if len(args.store) > 1:
+        reports = compare_stores(args)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(reports, f, ensure_ascii=False, indent=2)
+        sys.exit()
+
+    report = asyncio.run(run(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    print(f"saved to {save_report(report, args.out)}")
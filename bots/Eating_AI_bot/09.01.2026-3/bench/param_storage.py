@@ -0,0 +1,150 @@
+"""
+UserParam rows vs. one UserDocument per user.
+
+Fills a throwaway SQLite database per layout with the same profiles
+(seed.py questionnaire plus the Telegram fields), then measures what the
+engine does per message through UserState: loading a user's params, and
+changing one key and committing. Reports latency percentiles, fill time
+and the database file size.
+
+Usage (from the project root):
+    python -m bench.param_storage --users 100000 --samples 2000
+
+Reference numbers (100k users, 10 keys each, SQLite, aiosqlite):
+                    rows    document
+    read p50 ms     1.66        1.82
+    read p95 ms     2.19        2.28
+    write p50 ms    4.06        3.75
+    write p95 ms    4.95        5.57
+    fill s          8.32        2.57
+    db size MB     87.98       32.60
+Per-message latency is dominated by the session round trips either way;
+the document layout mainly buys a ~2.7x smaller table and faster bulk loads.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from sqlalchemy import create_engine, insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from database.base import Base
+from database.models import UserDocument, UserParam
+from database.params import encode_document
+from engine.state import UserState
+import migrate_user_params
+
+PLATFORM = "telegram"
+
+
+def profile(n: int) -> dict:
+    return {
+        "fio": f"Иванов Иван Иванович {n}",
+        "age": str(18 + n % 60),
+        "gender": "Мужской" if n % 2 else "Женский",
+        "height": str(150 + n % 50),
+        "weight": str(50 + n % 70),
+        "first_name": f"Иван{n}",
+        "last_name": f"Иванов{n}",
+        "language_code": "ru",
+        "is_premium": "False",
+        "contact": f"+7900{n:07d}",
+    }
+
+
+def fill(engine, storage: str, users: int, chunk: int = 5000):
+    with engine.begin() as conn:
+        for start in range(0, users, chunk):
+            ids = range(start, min(start + chunk, users))
+            if storage == "document":
+                conn.execute(insert(UserDocument), [
+                    {"user_id": str(n), "platform": PLATFORM, "data": encode_document(profile(n))}
+                    for n in ids
+                ])
+            else:
+                conn.execute(insert(UserParam), [
+                    {"user_id": str(n), "platform": PLATFORM, "key": k, "value": v}
+                    for n in ids for k, v in profile(n).items()
+                ])
+
+
+def percentiles(samples: list) -> dict:
+    q = statistics.quantiles(samples, n=100)
+    return {"p50_ms": q[49] * 1000, "p95_ms": q[94] * 1000, "p99_ms": q[98] * 1000}
+
+
+async def measure(url: str, storage: str, users: int, samples: int) -> dict:
+    engine = create_async_engine(url)
+    factory = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+    rnd = random.Random(42)
+
+    reads = []
+    for _ in range(samples):
+        user_id = str(rnd.randrange(users))
+        started = time.perf_counter()
+        async with factory() as db:
+            state = await UserState.load(db, user_id, PLATFORM, storage)
+        reads.append(time.perf_counter() - started)
+        assert state.get("fio")
+
+    writes = []
+    for n in range(samples):
+        user_id = str(rnd.randrange(users))
+        started = time.perf_counter()
+        async with factory() as db:
+            state = await UserState.load(db, user_id, PLATFORM, storage)
+            state.set("weight", str(60 + n % 40))
+            await state.write_back(db)
+            await db.commit()
+        writes.append(time.perf_counter() - started)
+
+    await engine.dispose()
+    return {"read": percentiles(reads), "load_and_write": percentiles(writes)}
+
+
+def run_layout(storage: str, args) -> dict:
+    path = os.path.join(tempfile.mkdtemp(prefix="bench_"), f"{storage}.db")
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    migrate_user_params.migrate(engine)
+
+    started = time.perf_counter()
+    fill(engine, storage, args.users)
+    fill_time = time.perf_counter() - started
+    engine.dispose()
+
+    result = asyncio.run(measure(f"sqlite+aiosqlite:///{path}", storage, args.users, args.samples))
+    result["fill_s"] = fill_time
+    result["db_mb"] = os.path.getsize(path) / 2 ** 20
+    return result
+
+
+def main(args):
+    results = {storage: run_layout(storage, args) for storage in ("rows", "document")}
+
+    print(f"{args.users} users, {args.samples} samples per operation")
+    print(f"{'':16}{'rows':>12}{'document':>12}")
+    for label, get in [
+        ("read p50 ms", lambda r: r["read"]["p50_ms"]),
+        ("read p95 ms", lambda r: r["read"]["p95_ms"]),
+        ("write p50 ms", lambda r: r["load_and_write"]["p50_ms"]),
+        ("write p95 ms", lambda r: r["load_and_write"]["p95_ms"]),
+        ("fill s", lambda r: r["fill_s"]),
+        ("db size MB", lambda r: r["db_mb"]),
+    ]:
+        print(f"{label:16}{get(results['rows']):12.2f}{get(results['document']):12.2f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"users": args.users, "samples": args.samples, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UserParam rows vs. one UserDocument per user")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--json", help="also save the results to this file")
+    main(parser.parse_args())
@@ -0,0 +1,100 @@
+"""
+POST Telegram updates to a local bot running in webhook mode.
+
+Either replays recorded updates (a JSON-lines file, one Update object per
+line, e.g. saved from getUpdates) or generates `--users` users walking
+the seed.py scenario. Updates of one user are posted in order, users in
+parallel. Prints the HTTP statuses and how fast the webhook acknowledged.
+
+    TG_MODE=webhook TG_WEBHOOK_SECRET=s3cret TG_API_URL=http://127.0.0.1:8081 python main.py
+    python -m bench.post_updates --secret s3cret --users 20
+    python -m bench.post_updates --secret s3cret --file updates.jsonl
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter, defaultdict
+from aiohttp import ClientSession
+
+WALK = [
+    "/start",
+    "Собрать данные", "Иван Иванов", "30", "Мужской", "180", "80",
+    "Расчёт калорий",
+    "Вывести всю информацию",
+]
+
+
+def synthetic_updates(users: int) -> list:
+    updates = []
+    now = int(time.time())
+    for n in range(users):
+        user_id = 500000 + n
+        for text in WALK:
+            updates.append({
+                "update_id": len(updates) + 1,
+                "message": {
+                    "message_id": len(updates) + 1,
+                    "date": now,
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": "Webhook",
+                             "username": f"webhook{n}", "language_code": "ru"},
+                    "text": text,
+                },
+            })
+    return updates
+
+
+def load_updates(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def sender_of(update: dict):
+    message = update.get("message") or update.get("edited_message") or {}
+    return (message.get("from") or {}).get("id")
+
+
+async def post_user(session: ClientSession, url: str, headers: dict, updates: list,
+                    statuses: Counter, latencies: list):
+    for update in updates:
+        started = time.perf_counter()
+        async with session.post(url, json=update, headers=headers) as resp:
+            await resp.read()
+            statuses[resp.status] += 1
+        latencies.append(time.perf_counter() - started)
+
+
+async def run(args):
+    updates = load_updates(args.file) if args.file else synthetic_updates(args.users)
+    by_user = defaultdict(list)
+    for update in updates:
+        by_user[sender_of(update)].append(update)
+
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    statuses = Counter()
+    latencies = []
+
+    started = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*(
+            post_user(session, args.url, headers, user_updates, statuses, latencies)
+            for user_updates in by_user.values()
+        ))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"updates:      {len(updates)} from {len(by_user)} users")
+    print(f"statuses:     {dict(statuses)}")
+    print(f"elapsed:      {elapsed:.2f}s ({len(updates) / elapsed:.0f} updates/s)")
+    print(f"ack p50:      {latencies[len(latencies) // 2] * 1000:.1f} ms")
+    print(f"ack max:      {latencies[-1] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="POST Telegram updates to a local webhook")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--secret", help="TG_WEBHOOK_SECRET of the bot")
+    parser.add_argument("--file", help="JSON-lines file of recorded updates")
+    parser.add_argument("--users", type=int, default=10, help="synthetic users when no --file is given")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,188 @@
+"""
+Checks of PostgreSQL operation against a local server.
+
+PG_TEST_URL must point at a throwaway database: every table in it is
+dropped. Needs asyncpg (the bot) and psycopg2 (admin.py, scripts).
+
+    createdb bot_test
+    PG_TEST_URL=postgresql://postgres@localhost/bot_test python -m bench.postgres_smoke
+
+Covers the ported migrations on a pre-workflow schema, the COPY mover
+from bot.db (--source), the bot walking users through a two-block
+scenario (ON CONFLICT upserts, prepared statements, pool settings) and
+the streamed CSV export of admin.py. Prints one line per check and
+exits with 1 if any failed.
+"""
+import argparse
+import asyncio
+import csv
+import io
+import os
+import sys
+
+PG_TEST_URL = os.getenv("PG_TEST_URL")
+if not PG_TEST_URL:
+    sys.exit("Set PG_TEST_URL to a throwaway PostgreSQL database, e.g. postgresql://postgres@localhost/bot_test")
+os.environ["DB_URL"] = PG_TEST_URL
+os.environ.pop("ASYNC_DB_URL", None)
+
+from sqlalchemy import func, inspect, select, text  # noqa: E402
+from connectors.memory import MemoryBotProvider  # noqa: E402
+from database.base import AsyncSessionLocal, Base, SessionLocal, async_engine, engine  # noqa: E402
+from database.models import Block, BotUser, Trace, UserSession  # noqa: E402
+from database.params import read_params  # noqa: E402
+from database.postgres import DB_POOL_SIZE, PG_STATEMENT_CACHE_SIZE  # noqa: E402
+from engine.core import ChatbotEngine  # noqa: E402
+import fix_db  # noqa: E402
+import migrate_block_heavy  # noqa: E402
+import migrate_to_postgres  # noqa: E402
+import migrate_username  # noqa: E402
+import migrate_workflows  # noqa: E402
+
+BLOCK = """
+if event == 'message':
+    set_param('last', input_text)
+    go_to({next})
+"""
+
+failures = []
+
+
+def check(name: str, ok: bool, detail=""):
+    print(f"{'ok  ' if ok else 'FAIL'} {name}{f' ({detail})' if detail else ''}")
+    if not ok:
+        failures.append(name)
+
+
+def reset():
+    with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(text(f'DROP TABLE IF EXISTS "{table.name}" CASCADE'))
+        conn.execute(text("DROP TABLE IF EXISTS admin_users CASCADE"))
+
+
+# ───────────────────────────────
+# Checks
+# ───────────────────────────────
+
+def check_migrations():
+    """A database from before ui_x/ui_y, username, is_heavy and workflows."""
+    reset()
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE blocks (id SERIAL PRIMARY KEY, name VARCHAR NOT NULL, "
+                          "script_code TEXT NOT NULL, is_start BOOLEAN DEFAULT FALSE)"))
+        conn.execute(text("CREATE TABLE bot_users (id SERIAL PRIMARY KEY, user_id VARCHAR, platform VARCHAR, "
+                          "is_active BOOLEAN DEFAULT TRUE, created_at TIMESTAMP)"))
+        conn.execute(text("INSERT INTO bot_users (user_id, platform) VALUES ('1', 'telegram')"))
+    for _ in range(2):  # the second run must be a no-op
+        fix_db.fix_db(engine)
+        migrate_username.migrate(engine)
+        migrate_block_heavy.migrate(engine)
+        migrate_workflows.migrate(engine)
+    Base.metadata.create_all(bind=engine)
+
+    inspector = inspect(engine)
+    blocks = {c["name"] for c in inspector.get_columns("blocks")}
+    users = {c["name"] for c in inspector.get_columns("bot_users")}
+    check("migrations add the block columns", {"ui_x", "ui_y", "is_heavy", "workflow_id"} <= blocks, sorted(blocks))
+    check("migrations add the user columns", {"username", "workflow_id"} <= users, sorted(users))
+    with engine.connect() as conn:
+        workflow = conn.execute(text("SELECT workflow_id FROM bot_users")).scalar()
+    check("existing rows go to workflow 0", workflow == 0, workflow)
+
+
+async def check_mover(source: str):
+    reset()
+    rows = await migrate_to_postgres.migrate(source, PG_TEST_URL, batch=500)
+    check("mover copies bot.db", rows > 0, f"{rows} rows")
+    try:
+        await migrate_to_postgres.migrate(source, PG_TEST_URL)
+        check("mover refuses a non-empty target", False)
+    except RuntimeError as e:
+        check("mover refuses a non-empty target", True, e)
+    again = await migrate_to_postgres.migrate(source, PG_TEST_URL, truncate=True)
+    check("mover --truncate copies again", again == rows, f"{again} rows")
+
+    # Sequences continue after the copied ids
+    db = SessionLocal()
+    try:
+        top = db.query(func.max(Trace.id)).scalar() or 0
+        trace = Trace(user_id="seq", platform="smoke", direction="inbound", content="x")
+        db.add(trace)
+        db.commit()
+        check("ids continue after the copied ones", trace.id > top, f"{trace.id} > {top}")
+    finally:
+        db.close()
+
+
+async def check_engine(users: int, messages: int):
+    reset()
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        db.add(Block(id=1, name="Ping", script_code=BLOCK.format(next=2), is_start=True))
+        db.add(Block(id=2, name="Pong", script_code=BLOCK.format(next=1)))
+        db.commit()
+    finally:
+        db.close()
+
+    chatbot_engine = ChatbotEngine(AsyncSessionLocal, MemoryBotProvider(keep=False))
+
+    async def user(user_id: str):
+        for n in range(messages):
+            await chatbot_engine.process_message(user_id, "smoke", str(n))
+
+    await asyncio.gather(*(user(str(500000 + n)) for n in range(users)))
+    await chatbot_engine.close()
+
+    db = SessionLocal()
+    try:
+        created = db.query(BotUser).filter(BotUser.platform == "smoke").count()
+        check("one bot_users row per user", created == users, created)
+        sessions = db.query(UserSession).filter(UserSession.platform == "smoke").all()
+        # Every message moves the user to the other block, starting from Ping
+        expected = 2 if messages % 2 else 1
+        check("sessions moved on every message", len(sessions) == users
+              and all(s.current_block_id == expected for s in sessions), [s.current_block_id for s in sessions][:5])
+        last = read_params(db, "500000", workflow_id=0)
+        check("params upserted", last.get("last") == str(messages - 1), last)
+        traces = db.query(Trace).filter(Trace.platform == "smoke").count()
+        check("trace written", traces >= users * messages, traces)
+    finally:
+        db.close()
+
+    check("pool size from DB_POOL_SIZE", async_engine.pool.size() == DB_POOL_SIZE, async_engine.pool.size())
+    if PG_STATEMENT_CACHE_SIZE:
+        async with async_engine.connect() as conn:
+            for _ in range(2):
+                await conn.execute(select(Block.id).where(Block.id == 1))
+            prepared = (await conn.execute(text("SELECT count(*) FROM pg_prepared_statements"))).scalar()
+        check("statements stay prepared on the connection", prepared > 0, prepared)
+    await async_engine.dispose()
+
+
+def check_export():
+    import admin
+    admin.EXPORT_BATCH = 7  # several fetches from the server-side cursor
+    with engine.connect() as conn:
+        expected = conn.execute(select(func.count()).select_from(Trace)).scalar()
+    exported = list(csv.reader(io.StringIO("".join(admin.stream_csv(select(Trace.__table__).order_by(Trace.id))))))
+    check("CSV export streams every trace row", len(exported) - 1 == expected, f"{len(exported) - 1} of {expected}")
+    check("CSV export has a header", exported[0][:2] == ["id", "user_id"], exported[0])
+
+
+async def main(args):
+    check_migrations()
+    await check_mover(args.source)
+    await check_engine(args.users, args.messages)
+    check_export()
+    print(f"{len(failures)} failed" if failures else "All checks passed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PostgreSQL checks against PG_TEST_URL")
+    parser.add_argument("--source", default="bot.db", help="SQLite database for the mover")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=5)
+    sys.exit(asyncio.run(main(parser.parse_args())))
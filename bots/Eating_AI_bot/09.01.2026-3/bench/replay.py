@@ -0,0 +1,296 @@
+"""
+Replay recorded traffic from the `trace` table against a copy of the DB.
+
+Inbound messages of a time range are sent again through MemoryBotProvider
+-> MessageDispatcher -> ChatbotEngine, at the recorded pace divided by
+--speed (0 = as fast as possible), with quiet periods cut to --max-gap
+seconds. The bot's own DB is never written to:
+it is copied to a temporary file first, and the copy gets the current
+scenario. For every message the outbound texts are compared with the
+ones recorded after it, which shows what a scenario change would alter
+before it is deployed.
+
+Each user starts at the block recorded with their first replayed
+message; their params are the ones in the copy (the latest values), so
+blocks that read params can differ for that reason alone. Modules are
+replaced by bench/stub_giga.py unless --real-modules is given; use
+--ignore-blocks to leave such blocks out of the comparison.
+
+Usage (from the project root):
+    python -m bench.replay --since 2026-01-09T00:00 --until 2026-01-10T00:00 --speed 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+from datetime import datetime
+
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix="replay_"), "replay.db")
+os.environ["DB_URL"] = f"sqlite:///{DB_FILE}"
+
+from sqlalchemy import select  # noqa: E402
+from connectors.memory import MemoryBotProvider  # noqa: E402
+from database.base import AsyncSessionLocal, Base, SessionLocal, async_engine, engine  # noqa: E402
+from database.models import Module, Trace, UserSession  # noqa: E402
+from engine.core import ChatbotEngine  # noqa: E402
+from engine.dispatcher import DISPATCH_WORKERS, MessageDispatcher  # noqa: E402
+import migrate_block_heavy  # noqa: E402
+import migrate_user_params  # noqa: E402
+import migrate_workflows  # noqa: E402
+
+STUB_AI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_giga.py")
+
+
+# ───────────────────────────────
+# Workload
+# ───────────────────────────────
+
+def copy_db(source: str):
+    """
+    Consistent copy through the SQLite backup API, safe while the bot is
+    running, brought up to the current schema.
+    """
+    if not os.path.exists(source):
+        raise FileNotFoundError(f"Database not found: {source}")
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(DB_FILE)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+    Base.metadata.create_all(bind=engine)
+    migrate_user_params.migrate(engine)
+    migrate_block_heavy.migrate(engine)
+    migrate_workflows.migrate(engine)
+
+
+def load_workload(since: datetime, until: datetime, user_id: str = None, limit: int = None) -> list:
+    """
+    Inbound messages of the range, in order, each with the outbound texts
+    recorded for that user up to their next inbound message.
+    """
+    db = SessionLocal()
+    try:
+        query = select(Trace).where(
+            Trace.created_at >= since, Trace.created_at < until,
+            Trace.direction.in_(("inbound", "outbound"))
+        ).order_by(Trace.created_at, Trace.id)
+        if user_id:
+            query = query.where(Trace.user_id == user_id)
+
+        messages = []
+        last = {}  # (workflow_id, user_id, platform) -> its latest inbound message
+        for row in db.scalars(query):
+            key = (row.workflow_id, row.user_id, row.platform)
+            if row.direction == "inbound":
+                if limit and len(messages) >= limit:
+                    break
+                last[key] = {
+                    "workflow_id": row.workflow_id,
+                    "user_id": row.user_id,
+                    "platform": row.platform,
+                    "text": row.content or "",
+                    "block_id": row.block_id,
+                    "at": row.created_at,
+                    "expected": [],
+                }
+                messages.append(last[key])
+            elif key in last:
+                last[key]["expected"].append(row.content)
+        return messages
+    finally:
+        db.close()
+
+
+def prepare_copy(messages: list, real_modules: bool):
+    """Put each replayed user at the block of their first message and stub the modules."""
+    db = SessionLocal()
+    try:
+        first = {}
+        for msg in messages:
+            first.setdefault((msg["workflow_id"], msg["user_id"], msg["platform"]), msg["block_id"])
+
+        for (workflow_id, user_id, platform), block_id in first.items():
+            session = db.scalar(select(UserSession).filter_by(
+                workflow_id=workflow_id, user_id=user_id, platform=platform
+            ))
+            if block_id is None:
+                # Recorded before the user had a session: start from scratch
+                if session:
+                    db.delete(session)
+            elif session:
+                session.current_block_id = block_id
+            else:
+                db.add(UserSession(workflow_id=workflow_id, user_id=user_id, platform=platform,
+                                   current_block_id=block_id))
+
+        if not real_modules:
+            for module in db.scalars(select(Module)):
+                module.py_file = STUB_AI
+        db.commit()
+    finally:
+        db.close()
+
+
+# ───────────────────────────────
+# Replay
+# ───────────────────────────────
+
+class Recorder:
+    """Dispatcher handler: runs the engine and keeps what each message produced."""
+
+    def __init__(self, process_message, provider: MemoryBotProvider):
+        self.process_message = process_message
+        self.provider = provider
+        self.waiting = defaultdict(deque)  # (workflow_id, user_id, platform) -> messages in dispatch order
+        self.failed = 0
+
+    async def handle(self, user_id, platform, text, user_data, workflow_id=0):
+        msg = self.waiting[(workflow_id, user_id, platform)].popleft()
+        sent = self.provider.sent[user_id]
+        before = len(sent)
+        try:
+            await self.process_message(user_id, platform, text, user_data, workflow_id)
+        except Exception as e:
+            self.failed += 1
+            msg["error"] = str(e)
+            raise
+        finally:
+            msg["actual"] = [m["text"] for m in sent[before:]]
+            msg["latency"] = time.perf_counter() - msg["submitted"]
+            msg["done"].set_result(None)
+
+    async def submit(self, msg: dict):
+        msg["done"] = asyncio.get_running_loop().create_future()
+        msg["submitted"] = time.perf_counter()
+        self.waiting[(msg["workflow_id"], msg["user_id"], msg["platform"])].append(msg)
+        await self.provider.on_message(msg["user_id"], msg["platform"], msg["text"], None,
+                                       workflow_id=msg["workflow_id"])
+
+
+async def replay(messages: list, speed: float, max_gap: float, workers: int) -> float:
+    provider = MemoryBotProvider()
+    chatbot_engine = ChatbotEngine(AsyncSessionLocal, provider)
+    for workflow_id in {msg["workflow_id"] for msg in messages}:
+        chatbot_engine.connectors[workflow_id] = provider
+    recorder = Recorder(chatbot_engine.process_message, provider)
+    dispatcher = MessageDispatcher(recorder.handle, workers=workers)
+    await dispatcher.start()
+    provider.set_callback(dispatcher.submit)
+
+    started = time.perf_counter()
+    scheduled = 0.0  # seconds after `started`
+    previous = messages[0]["at"]
+    for msg in messages:
+        if speed:
+            scheduled += min((msg["at"] - previous).total_seconds() / speed, max_gap)
+            previous = msg["at"]
+            delay = scheduled - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await recorder.submit(msg)
+
+    await asyncio.gather(*(msg["done"] for msg in messages))
+    elapsed = time.perf_counter() - started
+    await dispatcher.close()
+    await chatbot_engine.close()
+    await async_engine.dispose()
+    return elapsed
+
+
+# ───────────────────────────────
+# Report
+# ───────────────────────────────
+
+def percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+
+def report(messages: list, elapsed: float, ignore_blocks: set, show: int) -> dict:
+    latencies = sorted(msg["latency"] for msg in messages)
+    compared = [msg for msg in messages if msg["block_id"] not in ignore_blocks]
+    diverged = [msg for msg in compared if msg["actual"] != msg["expected"]]
+
+    result = {
+        "messages": len(messages),
+        "users": len({(msg["workflow_id"], msg["user_id"], msg["platform"]) for msg in messages}),
+        "failed": sum(1 for msg in messages if "error" in msg),
+        "elapsed_s": round(elapsed, 3),
+        "messages_per_sec": round(len(messages) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "compared": len(compared),
+        "diverged": len(diverged),
+        "diverged_by_block": dict(Counter(msg["block_id"] for msg in diverged)),
+        "examples": [
+            {
+                "user_id": msg["user_id"],
+                "at": msg["at"].isoformat(),
+                "block_id": msg["block_id"],
+                "input": msg["text"],
+                "expected": msg["expected"],
+                "actual": msg["actual"],
+            }
+            for msg in diverged[:show]
+        ],
+    }
+
+    for key, value in result.items():
+        if key != "examples":
+            print(f"{key + ':':22}{value}")
+    for example in result["examples"]:
+        print(f"\n{example['at']} user {example['user_id']} block {example['block_id']}: {example['input']!r}")
+        print(f"  recorded: {example['expected']}")
+        print(f"  replayed: {example['actual']}")
+    return result
+
+
+def parse_time(value: str) -> datetime:
+    # trace.created_at is naive UTC
+    return datetime.fromisoformat(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded inbound traffic against a copy of the DB")
+    parser.add_argument("--db", default="bot.db", help="SQLite database to copy (default ./bot.db)")
+    parser.add_argument("--since", type=parse_time, required=True, help="UTC, e.g. 2026-01-09T00:00")
+    parser.add_argument("--until", type=parse_time, default=datetime.utcnow(), help="UTC, default now")
+    parser.add_argument("--speed", type=float, default=1, help="1 = recorded pace, 10 = 10x faster, 0 = no pauses")
+    parser.add_argument("--max-gap", type=float, default=10, help="longest pause in seconds after scaling")
+    parser.add_argument("--user", help="replay one user only")
+    parser.add_argument("--limit", type=int, help="at most this many inbound messages")
+    parser.add_argument("--workers", type=int, default=DISPATCH_WORKERS, help="dispatcher workers")
+    parser.add_argument("--real-modules", action="store_true", help="call the real modules instead of the stub")
+    parser.add_argument("--ignore-blocks", type=int, nargs="*", default=[],
+                        help="leave out messages that arrived in these blocks")
+    parser.add_argument("--show", type=int, default=10, help="divergent messages to print")
+    parser.add_argument("--out", help="write the report as JSON")
+    args = parser.parse_args()
+
+    copy_db(args.db)
+    try:
+        workload = load_workload(args.since, args.until, args.user, args.limit)
+        if not workload:
+            print("No inbound messages in this range")
+        else:
+            prepare_copy(workload, args.real_modules)
+            elapsed = asyncio.run(replay(workload, args.speed, args.max_gap, args.workers))
+            result = report(workload, elapsed, set(args.ignore_blocks), args.show)
+            if args.out:
+                with open(args.out, "w", encoding="utf-8") as f:
+                    json.dump(result, f, ensure_ascii=False, indent=2)
+                print(f"\nsaved to {args.out}")
+    finally:
+        engine.dispose()
+        shutil.rmtree(os.path.dirname(DB_FILE), ignore_errors=True)
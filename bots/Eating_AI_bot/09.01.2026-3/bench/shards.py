@@ -0,0 +1,139 @@
+"""
+Throughput of CPU-bound blocks with the engine in 1 or N processes.
+
+Every message runs a block that burns `--work` loop iterations and
+answers once; users send their next message when the answer arrives.
+With --engine-workers 1 the engine runs in this process behind
+MessageDispatcher, as main.py does by default; with N > 1 it runs in N
+forked workers behind Supervisor (ENGINE_WORKERS=N). Each setting runs in
+its own subprocess on a throwaway SQLite database.
+
+    python -m bench.shards --engine-workers 1 2 4 --users 50 --messages 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix="shards_"), "shards.db")
+os.environ["DB_URL"] = f"sqlite:///{DB_FILE}"
+
+from connectors.memory import MemoryBotProvider  # noqa: E402
+from database.base import AsyncSessionLocal, Base, SessionLocal, async_engine, engine  # noqa: E402
+from database.models import Block  # noqa: E402
+from engine.core import ChatbotEngine  # noqa: E402
+from engine.dispatcher import MessageDispatcher  # noqa: E402
+from engine.supervisor import Supervisor, preload  # noqa: E402
+import migrate_workflows  # noqa: E402
+
+BLOCK = """
+if event == 'message':
+    total = 0
+    for i in range({work}):
+        total += i * i
+    send_message(str(total))
+"""
+
+
+class Replies(MemoryBotProvider):
+    """Resolves the waiting user's future when the answer comes back."""
+
+    def __init__(self):
+        super().__init__(keep=False)
+        self.waiting = {}  # user_id -> Future
+
+    async def send_message(self, user_id, text, buttons=None, parse_mode="text", request_contact=False):
+        await super().send_message(user_id, text, buttons, parse_mode, request_contact)
+        future = self.waiting.pop(user_id, None)
+        if future:
+            future.set_result(None)
+
+
+def prepare_db(work: int):
+    Base.metadata.create_all(bind=engine)
+    migrate_workflows.migrate(engine)
+    db = SessionLocal()
+    try:
+        db.add(Block(id=1, name="Burn", script_code=BLOCK.format(work=work), is_start=True))
+        db.commit()
+    finally:
+        db.close()
+
+
+async def user(provider: Replies, user_id: str, messages: int, latencies: list):
+    loop = asyncio.get_running_loop()
+    for n in range(messages):
+        done = provider.waiting[user_id] = loop.create_future()
+        started = time.perf_counter()
+        await provider.inject(user_id, str(n))
+        await done
+        latencies.append(time.perf_counter() - started)
+
+
+async def run_once(workers: int, users: int, messages: int, work: int) -> dict:
+    prepare_db(work)
+    provider = Replies()
+    if workers > 1:
+        chatbot_engine = ChatbotEngine(AsyncSessionLocal, None)
+        preload(chatbot_engine)
+        intake = Supervisor(chatbot_engine, provider, workers=workers)
+    else:
+        chatbot_engine = ChatbotEngine(AsyncSessionLocal, provider)
+        intake = MessageDispatcher(chatbot_engine.process_message)
+    await intake.start()
+    provider.set_callback(intake.submit)
+
+    # First contact creates the user and the session; not measured
+    await asyncio.gather(*(user(provider, str(200000 + n), 1, []) for n in range(users)))
+
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(user(provider, str(200000 + n), messages, latencies) for n in range(users)))
+    elapsed = time.perf_counter() - started
+
+    await intake.close()
+    if workers == 1:
+        await chatbot_engine.close()
+    await async_engine.dispose()
+
+    latencies.sort()
+    return {
+        "engine_workers": workers,
+        "messages": len(latencies),
+        "elapsed_s": round(elapsed, 3),
+        "messages_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU-bound block throughput with 1 or N engine processes")
+    parser.add_argument("--engine-workers", type=int, nargs="+", default=[1, os.cpu_count() or 1])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20, help="messages per user")
+    parser.add_argument("--work", type=int, default=20000, help="loop iterations per message")
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)  # one setting, in a subprocess
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(asyncio.run(run_once(args.run, args.users, args.messages, args.work))))
+        sys.exit()
+
+    print(f"{os.cpu_count()} CPUs, {args.users} users x {args.messages} messages, {args.work} iterations each")
+    for workers in args.engine_workers:
+        out = subprocess.run(
+            [sys.executable, "-m", "bench.shards", "--run", str(workers), "--users", str(args.users),
+             "--messages", str(args.messages), "--work", str(args.work)],
+            capture_output=True, text=True
+        )
+        lines = [line for line in out.stdout.splitlines() if line.startswith("{")]
+        if out.returncode or not lines:
+            print(f"engine_workers={workers} failed:\n{out.stdout}{out.stderr}")
+            continue
+        result = json.loads(lines[-1])
+        print("  ".join(f"{key}={value}" for key, value in result.items()))
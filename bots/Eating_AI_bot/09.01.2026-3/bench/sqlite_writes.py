@@ -0,0 +1,127 @@
+"""
+Write throughput of the SQLite profiles at 1, 10 and 100 concurrent users.
+
+Every message runs a block that stores a param and moves the user to the
+next block, so each message is one write transaction (params and session
+upserts, plus its trace row) on top of its reads. Each user sends the
+next message as soon as the previous one is handled, for --seconds.
+SQLITE_PROFILE is read when database.base is imported, so every profile
+and user count runs in its own subprocess on a throwaway database.
+
+    python -m bench.sqlite_writes --users 1 10 100 --profile default production
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix="sqlite_writes_"), "writes.db")
+os.environ["DB_URL"] = f"sqlite:///{DB_FILE}"
+
+from connectors.memory import MemoryBotProvider  # noqa: E402
+from database.base import AsyncSessionLocal, Base, SessionLocal, async_engine, db_writer, engine  # noqa: E402
+from database.models import Block  # noqa: E402
+from engine.core import ChatbotEngine  # noqa: E402
+import migrate_workflows  # noqa: E402
+
+BLOCK = """
+if event == 'message':
+    set_param('last', input_text)
+    go_to({next})
+"""
+
+
+def prepare_db():
+    Base.metadata.create_all(bind=engine)
+    migrate_workflows.migrate(engine)
+    db = SessionLocal()
+    try:
+        db.add(Block(id=1, name="Ping", script_code=BLOCK.format(next=2), is_start=True))
+        db.add(Block(id=2, name="Pong", script_code=BLOCK.format(next=1)))
+        db.commit()
+    finally:
+        db.close()
+
+
+async def user(chatbot_engine: ChatbotEngine, user_id: str, until: float, latencies: list, failures: list):
+    n = 0
+    while time.perf_counter() < until:
+        n += 1
+        started = time.perf_counter()
+        try:
+            await chatbot_engine.process_message(user_id, "bench", str(n))
+        except Exception as e:
+            failures.append(type(e).__name__)
+            continue
+        latencies.append(time.perf_counter() - started)
+
+
+async def run_once(users: int, seconds: float) -> dict:
+    prepare_db()
+    chatbot_engine = ChatbotEngine(AsyncSessionLocal, MemoryBotProvider(keep=False))
+    # First contact creates the users; not measured
+    await asyncio.gather(*(chatbot_engine.process_message(str(300000 + n), "bench", "hi") for n in range(users)))
+
+    latencies, failures = [], []
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        user(chatbot_engine, str(300000 + n), started + seconds, latencies, failures) for n in range(users)
+    ))
+    elapsed = time.perf_counter() - started
+    writer = db_writer.stats() if db_writer else None
+    await chatbot_engine.close()
+    await async_engine.dispose()
+
+    latencies.sort()
+    return {
+        "profile": os.environ.get("SQLITE_PROFILE", "default"),
+        "users": users,
+        "writes": len(latencies),
+        "writes_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2) if latencies else None,
+        "failed": len(failures),
+        "errors": sorted(set(failures)),
+        "per_commit": writer["per_commit"] if writer else 1.0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SQLite write throughput per profile and concurrency")
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--profile", nargs="+", default=["default", "production"])
+    parser.add_argument("--seconds", type=float, default=10, help="duration of each run")
+    parser.add_argument("--out", help="write all results as JSON")
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)  # one setting, in a subprocess
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(asyncio.run(run_once(args.run, args.seconds))))
+        sys.exit()
+
+    results = []
+    print(f"{'profile':12}{'users':>6}{'writes/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'failed':>8}{'per commit':>12}")
+    for profile in args.profile:
+        for users in args.users:
+            out = subprocess.run(
+                [sys.executable, "-m", "bench.sqlite_writes", "--run", str(users), "--seconds", str(args.seconds)],
+                capture_output=True, text=True, env={**os.environ, "SQLITE_PROFILE": profile}
+            )
+            lines = [line for line in out.stdout.splitlines() if line.startswith("{")]
+            if out.returncode or not lines:
+                print(f"{profile} users={users} failed:\n{out.stdout[-2000:]}{out.stderr[-2000:]}")
+                continue
+            result = json.loads(lines[-1])
+            results.append(result)
+            print(f"{profile:12}{users:>6}{result['writes_per_sec']:>10}{result['p50_ms']!s:>9}"
+                  f"{result['p95_ms']!s:>9}{result['failed']:>8}{result['per_commit']:>12}")
+            if result["errors"]:
+                print(f"{'':18}errors: {', '.join(result['errors'])}")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
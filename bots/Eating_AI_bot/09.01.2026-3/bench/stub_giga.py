@@ -0,0 +1,19 @@
+"""
+Stand-in for MOD/GigaAI/giga_ai.py in benchmarks: same `ask` entry point,
+no network. Answers after STUB_AI_LATENCY_MS milliseconds.
+"""
+import asyncio
+import os
+
+STUB_AI_LATENCY_MS = float(os.getenv("STUB_AI_LATENCY_MS", "50"))
+# No shared state: calls may overlap (see MODULE_CONCURRENCY in engine/manager.py)
+CONCURRENCY = 4
+
+
+def init():
+    return True
+
+
+async def ask(question):
+    await asyncio.sleep(STUB_AI_LATENCY_MS / 1000)
+    return f"Ответ на: {question}"
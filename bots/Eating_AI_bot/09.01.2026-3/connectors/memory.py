@@ -0,0 +1,51 @@
+import asyncio
+from collections import defaultdict
+from typing import List, Optional
+from .base import BotProvider
+
+
+class MemoryBotProvider(BotProvider):
+    """
+    BotProvider without a network, for load tests and traffic replay.
+
+    The caller feeds messages in with inject(), which awaits the callback,
+    so with ChatbotEngine.process_message as the callback it returns once
+    the message has been fully handled. Outgoing messages are counted and,
+    unless `keep` is False, kept per user in `sent`.
+    """
+
+    def __init__(self, platform: str = "memory", keep: bool = True):
+        super().__init__()
+        self.platform = platform
+        self.keep = keep
+        self.sent = defaultdict(list)  # user_id -> [message dict]
+        self.sent_count = 0
+        self._stopped = None
+
+    async def inject(self, user_id: str, text: str, user_data: dict = None):
+        await self.on_message(user_id, self.platform, text, user_data or {})
+
+    async def listen(self):
+        self._stopped = self._stopped or asyncio.Event()
+        await self._stopped.wait()
+
+    async def close(self):
+        if self._stopped:
+            self._stopped.set()
+
+    async def send_message(
+        self,
+        user_id: str,
+        text: str,
+        buttons: Optional[List[str]] = None,
+        parse_mode: str = "text",
+        request_contact: bool = False
+    ):
+        self.sent_count += 1
+        if self.keep:
+            self.sent[user_id].append({
+                "text": text,
+                "buttons": buttons,
+                "parse_mode": parse_mode,
+                "request_contact": request_contact
+            })
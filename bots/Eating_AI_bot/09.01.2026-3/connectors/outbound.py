@@ -0,0 +1,162 @@
+import asyncio
+import os
+import time
+import traceback
+from collections import deque
+
+# Telegram allows ~30 messages/sec per bot and ~1 message/sec per chat,
+# the defaults stay a little below that
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "25"))
+OUTBOUND_GLOBAL_BURST = int(os.getenv("OUTBOUND_GLOBAL_BURST", "5"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "5"))
+
+
+class RetryLater(Exception):
+    """Raised by a deliver function when the platform asked us to slow down."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class PermanentError(Exception):
+    """Raised by a deliver function when retrying cannot help (blocked bot, bad request)."""
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Take one token and return how long to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class _ChatQueue:
+    __slots__ = ("items", "bucket", "task")
+
+    def __init__(self, bucket: TokenBucket):
+        self.items = deque()  # (enqueued_at, kwargs)
+        self.bucket = bucket
+        self.task = None
+
+
+class OutboundPipeline:
+    """
+    Rate-limited, ordered delivery of outgoing messages.
+
+    Each chat has its own FIFO drained by a single task, so messages to
+    one chat are sent strictly in order. A global token bucket caps the
+    bot-wide rate and a per-chat bucket caps each chat. When `deliver`
+    raises RetryLater the chat pauses for the requested time and the
+    same message is retried. Other errors are retried with backoff up to
+    `max_retries` times; PermanentError drops the message at once.
+    """
+
+    def __init__(self, deliver, global_rate: float = OUTBOUND_GLOBAL_RATE,
+                 global_burst: int = OUTBOUND_GLOBAL_BURST,
+                 chat_rate: float = OUTBOUND_CHAT_RATE, chat_burst: int = OUTBOUND_CHAT_BURST,
+                 max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.deliver = deliver  # async def deliver(chat_id, **kwargs)
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats = {}  # chat_id -> _ChatQueue
+
+        # Metrics
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def send(self, chat_id: str, **kwargs):
+        """Queue a message for `chat_id` and return immediately."""
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _ChatQueue(TokenBucket(self.chat_rate, self.chat_burst))
+
+        chat.items.append((time.monotonic(), kwargs))
+        if chat.task is None:
+            chat.task = asyncio.create_task(self._drain(chat_id, chat))
+
+    async def _drain(self, chat_id: str, chat: _ChatQueue):
+        try:
+            while chat.items:
+                enqueued_at, kwargs = chat.items[0]
+                if await self._deliver_one(chat_id, chat, kwargs):
+                    latency = time.monotonic() - enqueued_at
+                    self.latency_total += latency
+                    self.latency_max = max(self.latency_max, latency)
+                chat.items.popleft()
+        finally:
+            chat.task = None
+            if chat.items:
+                # Cancelled mid-queue: leave the rest for close() to report
+                return
+            # Drop idle chats, the bucket refills anyway while nobody sends
+            if self._chats.get(chat_id) is chat:
+                del self._chats[chat_id]
+
+    async def _deliver_one(self, chat_id: str, chat: _ChatQueue, kwargs: dict) -> bool:
+        attempt = 0
+        while True:
+            await chat.bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                await self.deliver(chat_id, **kwargs)
+                self.sent += 1
+                return True
+            except RetryLater as e:
+                delay = e.retry_after
+            except PermanentError as e:
+                print(f"Dropped message to {chat_id}: {e}")
+                self.dropped += 1
+                return False
+            except Exception as e:
+                print(f"Failed to send message to {chat_id}: {e}")
+                traceback.print_exc()
+                delay = min(2 ** attempt, 30)
+
+            attempt += 1
+            if attempt > self.max_retries:
+                print(f"Dropped message to {chat_id} after {self.max_retries} retries")
+                self.dropped += 1
+                return False
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        """Wait until every queued message is sent or dropped."""
+        while self._chats:
+            tasks = [c.task for c in self._chats.values() if c.task is not None]
+            if not tasks:
+                break
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        delivered = self.sent
+        return {
+            "queued": sum(len(c.items) for c in self._chats.values()),
+            "chats": len(self._chats),
+            "sent": self.sent,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "latency_avg": self.latency_total / delivered if delivered else 0.0,
+            "latency_max": self.latency_max,
+        }
@@ -1,112 +1,198 @@
-import asyncio
-from aiogram import Bot, Dispatcher, types
-from aiogram.filters import CommandStart
-from aiogram.types import (
-    Message,
-    ReplyKeyboardMarkup,
-    KeyboardButton
-)
-from .base import BotProvider
-
-
-class TelegramBotProvider(BotProvider):
-    def __init__(self, token: str):
-        super().__init__()
-        self.token = token
-        self.bot = Bot(token=token)
-        self.dp = Dispatcher()
-
-        # Register handlers
-        self.dp.message.register(self.handle_message)
-
-    async def handle_message(self, message: Message):
-        if self.on_message:
-            user_id = str(message.from_user.id)
-            text = message.text or ""
-
-            user_data = {
-                "username": message.from_user.username,
-                "first_name": message.from_user.first_name,
-                "last_name": message.from_user.last_name,
-                "language_code": message.from_user.language_code,
-                "is_premium": getattr(message.from_user, "is_premium", False),
-                "contact": message.contact.phone_number if message.contact else None
-            }
-
-            await self.on_message(user_id, 'telegram', text, user_data)
-
-    async def listen(self):
-        print("Telegram Bot started polling...")
-        await self.dp.start_polling(self.bot)
-
-    async def send_message(
-        self,
-        user_id: str,
-        text: str,
-        buttons: list[str] = None,
-        parse_mode: str = "text",
-        request_contact: bool = False
-    ):
-        """
-        parse_mode: text | markdown | html
-        request_contact: True -> adds button to share phone number
-        """
-
-
-        
-        try:
-            markup = None
-
-            if buttons or request_contact:
-                keyboard = []
-
-                # Обычные кнопки (обратная совместимость)
-                if buttons:
-                    for btn in buttons:
-                        keyboard.append([KeyboardButton(text=btn)])
-
-                # Кнопка запроса номера телефона
-                if request_contact:
-                    
-                    keyboard.append([
-                        KeyboardButton(
-                            text=text,
-                            request_contact=True
-                        )
-                    ])
-
-                markup = ReplyKeyboardMarkup(
-                    keyboard=keyboard,
-                    resize_keyboard=True,
-                    one_time_keyboard=True
-                )
-
-            # Приводим parse_mode к aiogram-совместимому
-            tg_parse_mode = None
-            if parse_mode == "markdown":
-                tg_parse_mode = "MarkdownV2"
-            elif parse_mode == "html":
-                tg_parse_mode = "HTML"
-
-            await self.bot.send_message(
-                chat_id=user_id,
-                text=text,
-                reply_markup=markup,
-                parse_mode=tg_parse_mode
-            )
-
-        except Exception as e:
-            print(f"Failed to send message to {user_id}: {e}")
-        
-        #keyboard = ReplyKeyboardMarkup(
-        #keyboard=[
-        #[KeyboardButton(text=text, request_contact=True)]
-        #],
-        #resize_keyboard=True,
-        #one_time_keyboard=True
-        #)
-        #await self.bot.send_message(
-        #chat_id=user_id,
-        #text="📞 *Номер телефона*\nНажмите кнопку ниже",
-        #reply_markup=keyboard,
+import asyncio
+import os
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import (
+    TelegramRetryAfter,
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNotFound,
+    TelegramUnauthorizedError
+)
+from aiogram.filters import CommandStart
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiogram.types import (
+    Message,
+    ReplyKeyboardMarkup,
+    KeyboardButton
+)
+from .base import BotProvider
+from .outbound import OutboundPipeline, RetryLater, PermanentError
+
+
+class TelegramBotProvider(BotProvider):
+    def __init__(self, token: str, api_url: str = None, handle_signals: bool = True):
+        super().__init__()
+        self.token = token
+        self.handle_signals = handle_signals
+
+        # TG_API_URL points the bot at a local Bot API server (or a fake one in tests)
+        api_url = api_url or os.getenv("TG_API_URL")
+        session = AiohttpSession(api=TelegramAPIServer.from_base(api_url)) if api_url else None
+        self.bot = Bot(token=token, session=session)
+        self.dp = Dispatcher()
+
+        # Outgoing messages go through a rate-limited, per-chat ordered queue
+        self.outbound = OutboundPipeline(self._deliver)
+
+        # Register handlers
+        self.dp.message.register(self.handle_message)
+
+    async def handle_message(self, message: Message):
+        if self.on_message:
+            user_id = str(message.from_user.id)
+            text = message.text or ""
+
+            user_data = {
+                "username": message.from_user.username,
+                "first_name": message.from_user.first_name,
+                "last_name": message.from_user.last_name,
+                "language_code": message.from_user.language_code,
+                "is_premium": getattr(message.from_user, "is_premium", False),
+                "contact": message.contact.phone_number if message.contact else None
+            }
+
+            # With MessageDispatcher as the callback this only enqueues
+            await self.on_message(user_id, 'telegram', text, user_data)
+
+    async def listen(self):
+        print("Telegram Bot started polling...")
+        polling = asyncio.create_task(self.dp.start_polling(self.bot, handle_signals=self.handle_signals))
+        try:
+            await asyncio.shield(polling)
+        except asyncio.CancelledError:
+            # Cancelling start_polling would leave aiogram's getUpdates loop running
+            try:
+                await self.dp.stop_polling()
+            except RuntimeError:  # not started yet
+                polling.cancel()
+            raise
+
+    async def listen_webhook(self, host: str, port: int, path: str = "/webhook",
+                             secret_token: str = None, public_url: str = None):
+        """
+        Receive updates over HTTP instead of polling; runs until cancelled.
+
+        Every POST to `path` must carry the X-Telegram-Bot-Api-Secret-Token
+        header equal to `secret_token` (401 otherwise). Telegram gets its
+        200 right away: the update is handled in a background task, which
+        only puts the message into the dispatcher queue. GET /healthz is
+        for load balancers.
+
+        With `public_url` the webhook is registered with Telegram at
+        public_url + path; leave it empty when several instances share one
+        URL and it is set once from outside.
+        """
+        if not secret_token:
+            print("Warning: TG_WEBHOOK_SECRET is not set, anyone can post updates")
+
+        app = web.Application()
+        handler = SimpleRequestHandler(
+            dispatcher=self.dp,
+            bot=self.bot,
+            handle_in_background=True,
+            secret_token=secret_token or None
+        )
+        # Not handler.register(): its shutdown hook closes the bot session while
+        # the outbound queue is still sending; close() does it after the flush
+        app.router.add_post(path, handler.handle)
+        app.router.add_get("/healthz", lambda request: web.Response(text="ok"))
+
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+
+        if public_url:
+            await self.bot.set_webhook(
+                public_url.rstrip("/") + path,
+                secret_token=secret_token or None,
+                allowed_updates=self.dp.resolve_used_update_types()
+            )
+
+        print(f"Telegram Bot listening for webhooks on http://{host}:{port}{path}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    async def send_message(
+        self,
+        user_id: str,
+        text: str,
+        buttons: list[str] = None,
+        parse_mode: str = "text",
+        request_contact: bool = False
+    ):
+        """
+        parse_mode: text | markdown | html
+        request_contact: True -> adds button to share phone number
+
+        The message is queued and delivered by the outbound pipeline.
+        """
+        markup = None
+
+        if buttons or request_contact:
+            keyboard = []
+
+            # Обычные кнопки (обратная совместимость)
+            if buttons:
+                for btn in buttons:
+                    keyboard.append([KeyboardButton(text=btn)])
+
+            # Кнопка запроса номера телефона
+            if request_contact:
+                
+                keyboard.append([
+                    KeyboardButton(
+                        text=text,
+                        request_contact=True
+                    )
+                ])
+
+            markup = ReplyKeyboardMarkup(
+                keyboard=keyboard,
+                resize_keyboard=True,
+                one_time_keyboard=True
+            )
+
+        # Приводим parse_mode к aiogram-совместимому
+        tg_parse_mode = None
+        if parse_mode == "markdown":
+            tg_parse_mode = "MarkdownV2"
+        elif parse_mode == "html":
+            tg_parse_mode = "HTML"
+
+        self.outbound.send(
+            user_id,
+            text=text,
+            reply_markup=markup,
+            parse_mode=tg_parse_mode
+        )
+
+    async def _deliver(self, chat_id: str, **kwargs):
+        """Single Bot API call, with errors mapped for the outbound pipeline."""
+        try:
+            await self.bot.send_message(chat_id=chat_id, **kwargs)
+        except TelegramRetryAfter as e:
+            raise RetryLater(e.retry_after)
+        except (TelegramBadRequest, TelegramForbiddenError, TelegramNotFound, TelegramUnauthorizedError) as e:
+            raise PermanentError(str(e))
+
+    async def close(self):
+        await self.outbound.close()
+        await self.bot.session.close()
+        
+        #keyboard = ReplyKeyboardMarkup(
+        #keyboard=[
+        #[KeyboardButton(text=text, request_contact=True)]
+        #],
+        #resize_keyboard=True,
+        #one_time_keyboard=True
+        #)
+        #await self.bot.send_message(
+        #chat_id=user_id,
+        #text="📞 *Номер телефона*\nНажмите кнопку ниже",
+        #reply_markup=keyboard,
         #parse_mode="MarkdownV2")
\ No newline at end of file
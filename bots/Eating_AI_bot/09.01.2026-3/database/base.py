@@ -1,21 +1,69 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, DeclarativeBase
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
-
-DB_URL = os.getenv("DB_URL", "sqlite:///./bot.db")
-
-engine = create_engine(DB_URL, echo=False)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-class Base(DeclarativeBase):
-    pass
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import sessionmaker, DeclarativeBase
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from .postgres import engine_options, is_postgres  # noqa: E402
+from .sqlite import SQLITE_PROFILE, SQLITE_PROFILES, SQLITE_READERS, SqliteWriter, set_pragmas  # noqa: E402
+
+DB_URL = os.getenv("DB_URL", "sqlite:///./bot.db")
+
+
+def to_async_url(url: str) -> str:
+    """Map a sync DB URL onto the matching asyncio driver (aiosqlite / asyncpg)."""
+    if url.startswith("sqlite:"):
+        return "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    for prefix in ("postgresql+psycopg2:", "postgresql:", "postgres:"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg:" + url[len(prefix):]
+    return url
+
+
+def to_sync_url(url: str) -> str:
+    """
+    Name psycopg2 explicitly in a PostgreSQL URL: SQLAlchemy 2.1 maps a bare
+    postgresql:// onto psycopg 3, and postgres:// onto nothing.
+    """
+    for prefix in ("postgresql:", "postgres:"):
+        if url.startswith(prefix):
+            return "postgresql+psycopg2:" + url[len(prefix):]
+    return url
+
+
+# The bot engine uses the async URL, admin.py and scripts keep the sync one
+ASYNC_DB_URL = os.getenv("ASYNC_DB_URL") or to_async_url(DB_URL)
+
+if SQLITE_PROFILE not in SQLITE_PROFILES:
+    raise ValueError(f"Unknown SQLITE_PROFILE: {SQLITE_PROFILE}")
+# Only meaningful for SQLite; ignored for other databases
+SQLITE_PRODUCTION = SQLITE_PROFILE == "production" and DB_URL.startswith("sqlite:")
+
+# Pool sizing and prepared statements for PostgreSQL (database/postgres.py)
+engine = create_engine(to_sync_url(DB_URL), echo=False, **(engine_options(is_async=False) if is_postgres(DB_URL) else {}))
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+if SQLITE_PRODUCTION:
+    set_pragmas(engine)
+    # The bot only reads through the async engine; its writes go through db_writer
+    async_engine = create_async_engine(ASYNC_DB_URL, echo=False, pool_size=SQLITE_READERS, max_overflow=0)
+    set_pragmas(async_engine.sync_engine, query_only=True)
+    db_writer = SqliteWriter(DB_URL)
+else:
+    async_engine = create_async_engine(
+        ASYNC_DB_URL, echo=False, **(engine_options(is_async=True) if is_postgres(ASYNC_DB_URL) else {})
+    )
+    db_writer = None
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+class Base(DeclarativeBase):
+    pass
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
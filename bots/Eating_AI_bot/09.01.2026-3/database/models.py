@@ -1,62 +1,122 @@
-from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey
-from sqlalchemy.orm import relationship
-from datetime import datetime
-from .base import Base
-
-class Block(Base):
-    __tablename__ = "blocks"
-
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, nullable=False)
-    script_code = Column(Text, nullable=False)
-    is_start = Column(Boolean, default=False)
-    ui_x = Column(Integer, default=0)
-    ui_y = Column(Integer, default=0)
-
-class BotUser(Base):
-    __tablename__ = "bot_users"
-
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(String, index=True) # External ID
-    username = Column(String, nullable=True)
-    platform = Column(String, index=True)
-    is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
-
-class UserSession(Base):
-    __tablename__ = "user_sessions"
-
-    user_id = Column(String, primary_key=True)
-    platform = Column(String, primary_key=True)
-    current_block_id = Column(Integer, ForeignKey("blocks.id"))
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-
-    block = relationship("Block")
-
-class UserParam(Base):
-    __tablename__ = "user_params"
-
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(String, index=True)
-    platform = Column(String, index=True)
-    key = Column(String, nullable=False)
-    value = Column(Text, nullable=True)
-
-class Trace(Base):
-    __tablename__ = "trace"
-
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(String, index=True)
-    platform = Column(String, index=True)
-    block_id = Column(Integer, ForeignKey("blocks.id"), nullable=True)
-    direction = Column(String, nullable=False) # 'inbound' or 'outbound'
-    content = Column(Text, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
-
-class Module(Base):
-    __tablename__ = "modules"
-
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, unique=True, nullable=False)
-    py_file = Column(String, nullable=False)
-    status = Column(String, default="stop") # run, stop, error
+from sqlalchemy import Column, Integer, String, Text, Boolean, Date, DateTime, ForeignKey, Index, LargeBinary, UniqueConstraint
+from sqlalchemy.orm import relationship
+from datetime import datetime
+from .base import Base
+
+# workflow_id 0 is the single bot started from TG_TOKEN (RUN_MODE=single);
+# other values are ids of `workflows` rows (RUN_MODE=workflows)
+DEFAULT_WORKFLOW = 0
+
+class Workflow(Base):
+    """One hosted bot: its own token, blocks, users and sessions (see engine/workflows.py)."""
+    __tablename__ = "workflows"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, nullable=False)
+    description = Column(Text, nullable=True)
+    owner_id = Column(Integer, nullable=True)
+    telegram_token = Column(String, nullable=True)
+    openai_key = Column(String, nullable=True)
+    status = Column(String, default="stopped") # running, stopped
+    is_active = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class Block(Base):
+    __tablename__ = "blocks"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, nullable=False)
+    script_code = Column(Text, nullable=False)
+    is_start = Column(Boolean, default=False)
+    is_heavy = Column(Boolean, default=False) # run in a worker process (BLOCK_EXECUTION=heavy)
+    workflow_id = Column(Integer, nullable=False, default=DEFAULT_WORKFLOW, index=True)
+    ui_x = Column(Integer, default=0)
+    ui_y = Column(Integer, default=0)
+
+class BotUser(Base):
+    __tablename__ = "bot_users"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String, index=True) # External ID
+    username = Column(String, nullable=True)
+    platform = Column(String, index=True)
+    workflow_id = Column(Integer, nullable=False, default=DEFAULT_WORKFLOW, index=True)
+    is_active = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class UserSession(Base):
+    __tablename__ = "user_sessions"
+
+    workflow_id = Column(Integer, primary_key=True, default=DEFAULT_WORKFLOW)
+    user_id = Column(String, primary_key=True)
+    platform = Column(String, primary_key=True)
+    current_block_id = Column(Integer, ForeignKey("blocks.id"))
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    block = relationship("Block")
+
+class UserParam(Base):
+    __tablename__ = "user_params"
+    # One value per key; also serves lookups of one user's params
+    __table_args__ = (Index("ux_user_params_workflow_key", "workflow_id", "user_id", "platform", "key", unique=True),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    workflow_id = Column(Integer, nullable=False, default=DEFAULT_WORKFLOW)
+    user_id = Column(String)
+    platform = Column(String)
+    key = Column(String, nullable=False)
+    value = Column(Text, nullable=True)
+
+class UserDocument(Base):
+    """All params of one user in a single row (PARAM_STORAGE=document)."""
+    __tablename__ = "user_documents"
+
+    workflow_id = Column(Integer, primary_key=True, default=DEFAULT_WORKFLOW)
+    user_id = Column(String, primary_key=True)
+    platform = Column(String, primary_key=True)
+    data = Column(LargeBinary, nullable=False) # see database/params.py encode_document
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class Trace(Base):
+    __tablename__ = "trace"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String, index=True)
+    platform = Column(String, index=True)
+    workflow_id = Column(Integer, nullable=False, default=DEFAULT_WORKFLOW)
+    block_id = Column(Integer, ForeignKey("blocks.id"), nullable=True)
+    direction = Column(String, nullable=False) # 'inbound' or 'outbound'
+    content = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class Module(Base):
+    __tablename__ = "modules"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, nullable=False)
+    py_file = Column(String, nullable=False)
+    status = Column(String, default="stop") # run, stop, error
+
+class CacheVersion(Base):
+    __tablename__ = "cache_versions"
+
+    name = Column(String, primary_key=True) # e.g. 'scenario'
+    version = Column(Integer, default=0, nullable=False)
+
+class TraceRollup(Base):
+    __tablename__ = "trace_rollup"
+    __table_args__ = (UniqueConstraint("day", "block_id", "direction"),)
+
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False, index=True)
+    block_id = Column(Integer, nullable=True) # no FK: blocks may be deleted later
+    direction = Column(String, nullable=False)
+    messages = Column(Integer, default=0, nullable=False)
+
+class TraceArchive(Base):
+    __tablename__ = "trace_archive"
+
+    day = Column(Date, primary_key=True)
+    path = Column(String, nullable=False) # compressed JSON lines file
+    rows = Column(Integer, default=0, nullable=False)
+    archived_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -0,0 +1,127 @@
+import json
+import os
+import zlib
+from datetime import datetime
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from .models import UserDocument, UserParam, UserSession
+
+# How user params are stored:
+#   rows     - one UserParam row per key (default)
+#   document - one UserDocument row per user holding all keys
+PARAM_STORAGE = os.getenv("PARAM_STORAGE", "rows")
+PARAM_STORAGES = ("rows", "document")
+
+# Documents longer than this are zlib-compressed
+DOCUMENT_COMPRESS_MIN = 256
+
+# Both dialects support INSERT ... ON CONFLICT against the unique
+# (workflow_id, user_id, platform, key) index, or the primary key of
+# user_documents and user_sessions
+_INSERTS = {
+    "sqlite": sqlite.insert,
+    "postgresql": postgresql.insert,
+}
+
+
+def _insert(dialect: str, model):
+    insert = _INSERTS.get(dialect)
+    if insert is None:
+        raise ValueError(f"Unsupported dialect: {dialect}")
+    return insert(model)
+
+
+def upsert_params(dialect: str, user_id: str, platform: str, values: dict, workflow_id: int = 0):
+    """
+    One INSERT ... ON CONFLICT DO UPDATE statement writing every key of
+    `values` for the user. `dialect` is the engine's dialect name, e.g.
+    db.get_bind().dialect.name.
+    """
+    stmt = _insert(dialect, UserParam).values([
+        {"workflow_id": workflow_id, "user_id": user_id, "platform": platform, "key": key, "value": value}
+        for key, value in values.items()
+    ])
+    return stmt.on_conflict_do_update(
+        index_elements=[UserParam.workflow_id, UserParam.user_id, UserParam.platform, UserParam.key],
+        set_={"value": stmt.excluded.value}
+    )
+
+
+def upsert_session(dialect: str, user_id: str, platform: str, block_id: int, updated_at: datetime,
+                   workflow_id: int = 0):
+    """One INSERT ... ON CONFLICT DO UPDATE putting the user at `block_id`."""
+    stmt = _insert(dialect, UserSession).values(
+        workflow_id=workflow_id,
+        user_id=user_id,
+        platform=platform,
+        current_block_id=block_id,
+        updated_at=updated_at
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[UserSession.workflow_id, UserSession.user_id, UserSession.platform],
+        set_={"current_block_id": stmt.excluded.current_block_id, "updated_at": stmt.excluded.updated_at}
+    )
+
+
+# ───────────────────────────────
+# Document storage
+# ───────────────────────────────
+
+def encode_document(values: dict) -> bytes:
+    """
+    Compact binary form of a params dict: one format byte, then compact
+    JSON ('j') or zlib-compressed compact JSON ('z') for larger documents.
+    """
+    raw = json.dumps(values, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(raw) >= DOCUMENT_COMPRESS_MIN:
+        packed = zlib.compress(raw)
+        if len(packed) < len(raw):
+            return b"z" + packed
+    return b"j" + raw
+
+
+def decode_document(data: bytes) -> dict:
+    if not data:
+        return {}
+    fmt, body = data[:1], data[1:]
+    if fmt == b"z":
+        body = zlib.decompress(body)
+    elif fmt != b"j":
+        raise ValueError(f"Unknown user document format {fmt!r}")
+    return json.loads(body.decode("utf-8"))
+
+
+def upsert_document(dialect: str, user_id: str, platform: str, values: dict, workflow_id: int = 0):
+    """One INSERT ... ON CONFLICT DO UPDATE replacing the user's whole document."""
+    stmt = _insert(dialect, UserDocument).values(
+        workflow_id=workflow_id,
+        user_id=user_id,
+        platform=platform,
+        data=encode_document(values),
+        updated_at=datetime.utcnow()
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[UserDocument.workflow_id, UserDocument.user_id, UserDocument.platform],
+        set_={"data": stmt.excluded.data, "updated_at": stmt.excluded.updated_at}
+    )
+
+
+# ───────────────────────────────
+# Sync readers (admin.py, scripts)
+# ───────────────────────────────
+
+def read_params(db: Session, user_id: str, storage: str = PARAM_STORAGE, workflow_id: int = None) -> dict:
+    """All params of a user (any platform; any workflow unless given) as {key: value}."""
+    if storage == "document":
+        query = db.query(UserDocument.data).filter(UserDocument.user_id == user_id)
+        if workflow_id is not None:
+            query = query.filter(UserDocument.workflow_id == workflow_id)
+        values = {}
+        for data, in query:
+            values.update(decode_document(data))
+        return values
+
+    rows = db.query(UserParam.key, UserParam.value).filter(UserParam.user_id == user_id)
+    if workflow_id is not None:
+        rows = rows.filter(UserParam.workflow_id == workflow_id)
+    return dict(rows.all())
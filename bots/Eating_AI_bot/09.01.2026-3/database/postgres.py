@@ -0,0 +1,48 @@
+import os
+from uuid import uuid4
+
+# Connections per engine: each bot process (ENGINE_WORKERS) and admin.py
+# hold up to DB_POOL_SIZE + DB_MAX_OVERFLOW, keep the sum under max_connections
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # reconnect after this many seconds, -1 - never
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"  # check a connection before handing it out
+
+# asyncpg prepares every statement on the server; the bot runs the same few
+# statements per message, so with a cache each is parsed and planned once
+# per connection. 0 - no statement outlives its transaction (PgBouncer in
+# transaction pooling mode, where the next transaction may get another server).
+PG_STATEMENT_CACHE_SIZE = int(os.getenv("PG_STATEMENT_CACHE_SIZE", "500"))
+PG_APPLICATION_NAME = os.getenv("PG_APPLICATION_NAME", "eating_ai_bot")
+
+
+def is_postgres(url: str) -> bool:
+    return url.startswith(("postgresql", "postgres:"))
+
+
+def engine_options(is_async: bool) -> dict:
+    """create_engine / create_async_engine keyword arguments for PostgreSQL."""
+    options = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+    if not is_async:
+        # psycopg2; admin.py and scripts
+        options["connect_args"] = {"application_name": PG_APPLICATION_NAME}
+        return options
+
+    connect_args = {
+        "prepared_statement_cache_size": PG_STATEMENT_CACHE_SIZE,
+        "server_settings": {"application_name": PG_APPLICATION_NAME},
+    }
+    if not PG_STATEMENT_CACHE_SIZE:
+        # asyncpg's own cache too, and unique names: behind PgBouncer a name
+        # prepared by another client may already exist on the server
+        connect_args["statement_cache_size"] = 0
+        connect_args["prepared_statement_name_func"] = lambda: f"__asyncpg_{uuid4()}__"
+    options["connect_args"] = connect_args
+    return options
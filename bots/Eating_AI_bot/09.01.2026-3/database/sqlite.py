@@ -0,0 +1,190 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+import traceback
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import NullPool
+
+# default    - SQLAlchemy defaults (rollback journal, a write lock per transaction)
+# production - WAL and the pragmas below on every connection; the bot reads
+#              through query-only connections and writes through SqliteWriter
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "default")
+SQLITE_PROFILES = ("default", "production")
+
+# NORMAL in WAL mode only fsyncs at checkpoints: a power loss can undo the
+# last commits, a crashed process cannot. FULL fsyncs every commit.
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_MB = int(os.getenv("SQLITE_CACHE_MB", "64"))  # page cache per connection
+SQLITE_MMAP_MB = int(os.getenv("SQLITE_MMAP_MB", "256"))  # memory-mapped I/O, 0 - off
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# Read-only connections of the bot. Every dispatcher worker holds one while
+# it handles a message and one more is left for the engine's reads between
+# messages, so there are never fewer than DISPATCH_WORKERS (the setting of
+# engine/dispatcher.py) + 1; 0 - exactly that many
+SQLITE_READERS = max(int(os.getenv("SQLITE_READERS", "0")), int(os.getenv("DISPATCH_WORKERS", "8")) + 1)
+
+# Group commit: at most this many transactions per COMMIT
+SQLITE_WRITER_BATCH = int(os.getenv("SQLITE_WRITER_BATCH", "200"))
+# How long (ms) the writer waits for more transactions before committing;
+# 0 - commit whatever queued up while the previous commit ran
+SQLITE_WRITER_WAIT_MS = float(os.getenv("SQLITE_WRITER_WAIT_MS", "0"))
+
+
+def set_pragmas(engine, query_only: bool = False):
+    """Apply the production pragmas to every new connection of `engine` (sync or async)."""
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not query_only:
+            # Persistent in the file; readers cannot switch it
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_MB * 1024}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        if query_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+
+class SqliteWriter:
+    """
+    The one connection of the bot process that writes, owned by a thread.
+
+    Callers hand in a function of a sync Connection and await its result.
+    The thread takes every function queued at that moment (up to `batch`,
+    optionally waiting `wait_ms` for more), runs each in its own SAVEPOINT
+    of one transaction and commits once: a function that raises only
+    loses its own writes, a failed COMMIT fails the whole group. With one
+    writer there is no lock contention inside the process, and N
+    concurrent messages cost one commit instead of N.
+
+    The thread starts on first use in each process, so a writer created
+    before ENGINE_WORKERS forks is still usable in every worker; each
+    worker then has its own writer, and busy_timeout settles the rest.
+    """
+
+    def __init__(self, url: str, batch: int = SQLITE_WRITER_BATCH, wait_ms: float = SQLITE_WRITER_WAIT_MS):
+        self.engine = create_engine(url, poolclass=NullPool)
+        set_pragmas(self.engine)
+        # pysqlite opens transactions on its own and cannot nest SAVEPOINTs;
+        # let SQLAlchemy emit them instead (see the SQLAlchemy SQLite docs)
+        event.listen(self.engine, "connect", self._autocommit_driver)
+        event.listen(self.engine, "begin", self._begin)
+
+        self.batch = batch
+        self.wait = wait_ms / 1000
+        self._queue = None
+        self._thread = None
+        self._pid = None
+
+        # Metrics
+        self.transactions = 0
+        self.commits = 0
+        self.failed = 0
+
+    @staticmethod
+    def _autocommit_driver(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @staticmethod
+    def _begin(conn):
+        # Take the write lock up front: waits in busy_timeout instead of failing on upgrade
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    def _start(self):
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self._pid = os.getpid()
+        self._thread.start()
+
+    async def run(self, fn):
+        """Run fn(connection) in the next group commit; returns its result once committed."""
+        if self._pid != os.getpid():
+            self._start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put((fn, future))
+        return await future
+
+    def close(self):
+        """Finish the queued work and stop the thread; the next run() starts it again."""
+        if self._pid != os.getpid():
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._pid = None
+
+    # ───────────────────────────────
+    # Writer thread
+    # ───────────────────────────────
+
+    def _run(self):
+        with self.engine.connect() as conn:
+            stopping = False
+            while not stopping:
+                job = self._queue.get()
+                if job is None:
+                    return
+                jobs = [job]
+                deadline = time.monotonic() + self.wait
+                while len(jobs) < self.batch:
+                    try:
+                        if self.wait:
+                            job = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                        else:
+                            job = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        stopping = True
+                        break
+                    jobs.append(job)
+                self._commit(conn, jobs)
+
+    def _commit(self, conn, jobs: list):
+        outcomes = []  # (future, result, exception)
+        try:
+            with conn.begin():
+                for fn, future in jobs:
+                    savepoint = conn.begin_nested()
+                    try:
+                        result = fn(conn)
+                    except Exception as e:
+                        savepoint.rollback()
+                        outcomes.append((future, None, e))
+                    else:
+                        savepoint.commit()
+                        outcomes.append((future, result, None))
+        except Exception as e:
+            print(f"SQLite group commit of {len(jobs)} transactions failed: {e}")
+            traceback.print_exc()
+            outcomes = [(future, None, e) for _, future in jobs]
+        else:
+            self.commits += 1
+
+        for future, result, error in outcomes:
+            self.transactions += 1
+            if error is not None:
+                self.failed += 1
+            future.get_loop().call_soon_threadsafe(self._resolve, future, result, error)
+
+    @staticmethod
+    def _resolve(future, result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "transactions": self.transactions,
+            "commits": self.commits,
+            "per_commit": round(self.transactions / self.commits, 2) if self.commits else 0,
+            "failed": self.failed,
+        }
@@ -0,0 +1,230 @@
+"""
+Trace retention: keeps the last TRACE_RETENTION_DAYS days of `trace` in the
+main DB and moves older rows to one gzip-compressed JSON-lines file per day
+under TRACE_ARCHIVE_DIR. Per-day, per-block message counts are kept in
+`trace_rollup`, and `trace_archive` lists the archived days for the admin UI.
+
+Run by hand or from cron:
+    python -m database.trace_archive [--days 30]
+The bot also runs it every TRACE_RETENTION_INTERVAL hours (0 disables).
+"""
+import argparse
+import gzip
+import json
+import os
+import zlib
+from datetime import date, datetime, timedelta
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+from .base import Base, SessionLocal, engine
+from .models import Trace, TraceArchive, TraceRollup
+
+TRACE_RETENTION_DAYS = int(os.getenv("TRACE_RETENTION_DAYS", "30"))
+TRACE_RETENTION_INTERVAL = float(os.getenv("TRACE_RETENTION_INTERVAL", "6"))  # hours
+TRACE_ARCHIVE_DIR = os.getenv("TRACE_ARCHIVE_DIR", "./archive/trace")
+TRACE_ARCHIVE_BATCH = int(os.getenv("TRACE_ARCHIVE_BATCH", "5000"))
+
+
+def archive_path(day: date, archive_dir: str = TRACE_ARCHIVE_DIR) -> str:
+    return os.path.join(archive_dir, day.strftime("%Y"), f"trace-{day.isoformat()}.jsonl.gz")
+
+
+def _row_to_dict(row: Trace) -> dict:
+    return {
+        "id": row.id,
+        "workflow_id": row.workflow_id,
+        "user_id": row.user_id,
+        "platform": row.platform,
+        "block_id": row.block_id,
+        "direction": row.direction,
+        "content": row.content,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+    }
+
+
+def _append(path: str, rows: list):
+    """
+    Append rows as a new gzip member; readers see one continuous stream.
+    The member is complete (trailer written) and fsynced before this
+    returns, so the caller may delete the rows from the DB afterwards.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as raw:
+        with gzip.open(raw, "at", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        # Closing the gzip stream wrote the trailer; now make it durable
+        raw.flush()
+        os.fsync(raw.fileno())
+
+
+def _scan(path: str) -> tuple:
+    """
+    Walk the gzip members of an archive. Returns the length of the file up
+    to the end of its last complete member (trailer and CRC intact) and
+    the ids of the rows in that member.
+    """
+    good = offset = 0
+    last, member, tail = set(), set(), b""
+    stream = zlib.decompressobj(zlib.MAX_WBITS | 16)  # gzip wrapper
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            while chunk:
+                try:
+                    lines = (tail + stream.decompress(chunk)).split(b"\n")
+                    tail = lines.pop()
+                    for line in lines:
+                        member.add(json.loads(line)["id"])
+                except (zlib.error, ValueError, KeyError):
+                    return good, last
+                if not stream.eof:
+                    offset += len(chunk)
+                    break
+                # End of a member; the rest of the chunk starts the next one
+                rest = stream.unused_data
+                offset += len(chunk) - len(rest)
+                good = offset
+                last, member, tail = member, set(), b""
+                stream = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                chunk = rest
+    return good, last
+
+
+def _resume(path: str) -> set:
+    """
+    Make an archive safe to append to after a crash in an earlier run.
+
+    An incomplete member is cut off: the reader stops at it, so it would
+    hide every member written after it. Returns the ids of the last
+    complete member; only its rows can have been archived without being
+    deleted from the DB, and must not be written again.
+    """
+    if not os.path.exists(path):
+        return set()
+    good, last = _scan(path)
+    size = os.path.getsize(path)
+    if good < size:
+        print(f"Archive {path}: cutting off {size - good} bytes of an incomplete write")
+        with open(path, "r+b") as raw:
+            raw.truncate(good)
+            raw.flush()
+            os.fsync(raw.fileno())
+    return last
+
+
+def _add_rollups(db: Session, day: date, rows: list):
+    counts = {}
+    for row in rows:
+        key = (row["block_id"], row["direction"])
+        counts[key] = counts.get(key, 0) + 1
+
+    for (block_id, direction), n in counts.items():
+        rollup = db.scalar(select(TraceRollup).where(
+            TraceRollup.day == day,
+            TraceRollup.block_id.is_(None) if block_id is None else TraceRollup.block_id == block_id,
+            TraceRollup.direction == direction,
+        ))
+        if rollup:
+            rollup.messages += n
+        else:
+            db.add(TraceRollup(day=day, block_id=block_id, direction=direction, messages=n))
+
+
+def archive_traces(db: Session, days: int = TRACE_RETENTION_DAYS, archive_dir: str = TRACE_ARCHIVE_DIR,
+                   batch_size: int = TRACE_ARCHIVE_BATCH) -> int:
+    """
+    Move trace rows older than `days` full days into the archive files.
+
+    Works in batches of `batch_size` rows, one transaction each, so the
+    write lock is only held briefly. Rows are written to disk before they
+    are deleted, so a crash never loses a row; the first time a run
+    touches a file it repairs what a crash may have left (see _resume),
+    so each row is written to the archive once.
+    Returns the number of rows moved.
+    """
+    # created_at is stored in UTC
+    cutoff = datetime.combine(datetime.utcnow().date() - timedelta(days=days), datetime.min.time())
+    moved = 0
+    archived = {}  # path -> ids already in the file, see _resume; once per file and run
+
+    while True:
+        batch = db.scalars(
+            select(Trace).where(Trace.created_at < cutoff).order_by(Trace.id).limit(batch_size)
+        ).all()
+        if not batch:
+            return moved
+
+        by_day = {}
+        for row in batch:
+            by_day.setdefault(row.created_at.date(), []).append(_row_to_dict(row))
+
+        for day, rows in by_day.items():
+            path = archive_path(day, archive_dir)
+            if path not in archived:
+                archived[path] = _resume(path)
+            # Rows are counted in the transaction that deletes them, so every
+            # row of the batch is counted here, even one a crash left in the file
+            unwritten = [row for row in rows if row["id"] not in archived[path]]
+            if unwritten:
+                _append(path, unwritten)
+            _add_rollups(db, day, rows)
+
+            entry = db.get(TraceArchive, day)
+            if entry:
+                entry.rows += len(rows)
+                entry.path = path
+            else:
+                db.add(TraceArchive(day=day, path=path, rows=len(rows)))
+
+        db.execute(delete(Trace).where(Trace.id.in_([row.id for row in batch])))
+        db.commit()
+        db.expunge_all()
+        moved += len(batch)
+
+
+def read_archive(day: date, user_id: str = None, limit: int = 500, archive_dir: str = TRACE_ARCHIVE_DIR) -> list:
+    """Load archived rows of one day, newest first, optionally for one user."""
+    path = archive_path(day, archive_dir)
+    if not os.path.exists(path):
+        return []
+
+    seen = set()
+    rows = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                row = json.loads(line)
+                if row["id"] in seen or (user_id and row["user_id"] != user_id):
+                    continue
+                seen.add(row["id"])
+                rows.append(row)
+        except (EOFError, gzip.BadGzipFile, zlib.error, json.JSONDecodeError) as e:
+            # A crash while appending: the rows of that member are still in the DB
+            print(f"Archive {path} is truncated, showing the rows before it: {e}")
+
+    rows.sort(key=lambda r: r["id"], reverse=True)
+    return rows[:limit]
+
+
+def run_retention(days: int = TRACE_RETENTION_DAYS) -> int:
+    """Open a session of its own; used by the CLI and the bot's periodic task."""
+    db = SessionLocal()
+    try:
+        # create_all() does not add indexes to an existing table
+        for index in Trace.__table__.indexes:
+            index.create(db.get_bind(), checkfirst=True)
+        moved = archive_traces(db, days)
+    finally:
+        db.close()
+    if moved:
+        print(f"Archived {moved} trace rows older than {days} days")
+    return moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move old trace rows to the compressed archive")
+    parser.add_argument("--days", type=int, default=TRACE_RETENTION_DAYS, help="days to keep in the DB")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    run_retention(args.days)
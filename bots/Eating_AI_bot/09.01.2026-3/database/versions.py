@@ -0,0 +1,24 @@
+from sqlalchemy.orm import Session
+from .models import CacheVersion
+
+# Names of the version counters shared by admin.py and the bot process
+SCENARIO = "scenario"
+USERS = "users"
+STATE = "state"
+
+
+def bump_version(db: Session, name: str):
+    """
+    Increment a version counter inside the caller's transaction.
+    The bot process polls these counters to know when to reload its caches.
+    """
+    row = db.query(CacheVersion).filter_by(name=name).first()
+    if row:
+        row.version += 1
+    else:
+        db.add(CacheVersion(name=name, version=1))
+
+
+def get_version(db: Session, name: str) -> int:
+    row = db.query(CacheVersion).filter_by(name=name).first()
+    return row.version if row else 0
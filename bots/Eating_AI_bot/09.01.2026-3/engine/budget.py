@@ -0,0 +1,181 @@
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from greenlet import getcurrent
+
+MAX_HOPS = int(os.getenv("MAX_HOPS", "25"))  # blocks run per inbound message, 0 = no limit
+BLOCK_WALL_BUDGET = float(os.getenv("BLOCK_WALL_BUDGET", "5"))  # seconds per block, 0 = no limit
+BLOCK_STEP_BUDGET = int(os.getenv("BLOCK_STEP_BUDGET", "0"))  # bytecode instructions per block, 0 = no limit
+
+
+class BudgetExceeded(Exception):
+    """A block or a message went over one of its execution budgets."""
+
+    def __init__(self, kind: str, limit, block_id: int = None):
+        super().__init__(f"{kind} budget exceeded (limit {limit})")
+        self.kind = kind  # hops | wall | steps | cpu
+        self.limit = limit
+        self.block_id = block_id
+
+
+# ───────────────────────────────
+# Step budget via tracing, wall-time budget via SIGALRM
+# ───────────────────────────────
+
+# Once a block is over its wall budget the alarm repeats every this many
+# seconds until the block is stopped (or returns)
+WALL_ALARM_INTERVAL = 0.05
+
+
+class _Budget:
+    __slots__ = ("max_steps", "wall", "steps", "deadline", "traced", "previous")
+
+    def __init__(self, max_steps: int, wall: float, timer: bool):
+        self.max_steps = max_steps
+        self.wall = wall
+        self.steps = 0
+        self.deadline = time.monotonic() + wall if wall else None
+        # Without SIGALRM the wall clock is checked by the tracer as well
+        self.traced = bool(max_steps) or (bool(wall) and not timer)
+        self.previous = None  # trace function of the thread before the block
+
+    def trace(self, frame, event, arg):
+        # Opcode events, not line events: a one-line `while True: pass`
+        # never starts a new line and would never be stopped
+        if event == "opcode":
+            self.steps += 1
+            if self.max_steps and self.steps > self.max_steps:
+                raise BudgetExceeded("steps", self.max_steps)
+            # time.monotonic() on every instruction would double the tracing cost
+            if self.deadline and not self.steps & 1023 and time.monotonic() > self.deadline:
+                raise BudgetExceeded("wall", self.wall)
+        return self.trace
+
+    def start(self, timer: bool):
+        """Install the tracer and arm the alarm; again after every pause."""
+        if self.traced:
+            self.previous = sys.gettrace()
+            sys.settrace(_dispatch)
+        if timer and self.deadline is not None:
+            signal.setitimer(signal.ITIMER_REAL, max(self.deadline - time.monotonic(), 1e-6),
+                             WALL_ALARM_INTERVAL)
+
+    def stop(self, timer: bool):
+        if timer and self.deadline is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if self.traced:
+            sys.settrace(self.previous)
+
+
+# Blocks run inside AsyncSession.run_sync greenlets that share the event-loop
+# thread; only one of them runs at a time, the others wait in call_module
+# (see budget_paused) with their tracer removed and their alarm disarmed
+_active = {}  # greenlet -> _Budget
+_alarm_installed = False
+
+
+def _dispatch(frame, event, arg):
+    budget = _active.get(getcurrent())
+    if budget is None or not frame.f_code.co_filename.startswith("<block "):
+        return None
+    frame.f_trace_lines = False
+    frame.f_trace_opcodes = True
+    return budget.trace
+
+
+def _raise_wall(signum, frame):
+    # Raised only while block code is on the stack: an alarm that goes off
+    # in the engine just as the block returns is ignored, the next one is
+    # WALL_ALARM_INTERVAL later
+    budget = _active.get(getcurrent())
+    while budget is not None and frame is not None:
+        if frame.f_code.co_filename.startswith("<block "):
+            raise BudgetExceeded("wall", budget.wall)
+        frame = frame.f_back
+
+
+def _use_timer(wall: float) -> bool:
+    """SIGALRM is delivered to the main thread only, where the engine's event loop runs."""
+    global _alarm_installed
+    if not wall or not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        return False
+    if not _alarm_installed:
+        signal.signal(signal.SIGALRM, _raise_wall)
+        _alarm_installed = True
+    return True
+
+
+@contextmanager
+def block_budget(max_steps: int = BLOCK_STEP_BUDGET, wall: float = BLOCK_WALL_BUDGET):
+    """
+    Raise BudgetExceeded in block code (compiled as "<block N>") run inside
+    the `with` when it runs longer than `wall` seconds or, with `max_steps`,
+    executes more bytecode instructions than that. Wall time is enforced
+    with an interval timer (SIGALRM) on the main thread and costs nothing
+    while the block is within budget; counting instructions traces every
+    opcode of the block and is several times slower. Native calls that
+    never return to Python (a huge sum() for instance) cannot be
+    interrupted here; BlockProcessPool covers those.
+    """
+    if not max_steps and not wall:
+        yield
+        return
+
+    timer = _use_timer(wall)
+    key = getcurrent()
+    budget = _Budget(max_steps, wall, timer)
+    _active[key] = budget
+    budget.start(timer)
+    try:
+        yield
+    finally:
+        budget.stop(timer)
+        del _active[key]
+
+
+@contextmanager
+def budget_paused():
+    """
+    Stop the budget of the current block while it waits, e.g. for a module:
+    the wall clock does not run, and other users' blocks and the engine run
+    without its tracer and alarm.
+    """
+    budget = _active.get(getcurrent())
+    if budget is None:
+        yield
+        return
+
+    timer = _use_timer(budget.wall)
+    budget.stop(timer)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        if budget.deadline is not None:
+            budget.deadline += time.monotonic() - started
+        budget.start(timer)
+
+
+# ───────────────────────────────
+# Metrics
+# ───────────────────────────────
+
+class BudgetViolations:
+    def __init__(self):
+        self.by_kind = Counter()
+        self.by_block = Counter()
+
+    def record(self, error: BudgetExceeded):
+        self.by_kind[error.kind] += 1
+        self.by_block[error.block_id] += 1
+
+    def stats(self) -> dict:
+        return {
+            "total": sum(self.by_kind.values()),
+            "by_kind": dict(self.by_kind),
+            "by_block": dict(self.by_block),
+        }
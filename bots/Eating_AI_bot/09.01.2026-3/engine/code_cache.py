@@ -0,0 +1,53 @@
+import hashlib
+
+
+class BlockCodeCache:
+    """
+    Cache of compiled block scripts.
+
+    Entries are keyed by block id and checked against a hash of the
+    script source, so an edited block is recompiled on its next run
+    even if nobody told the cache about the edit.
+    """
+
+    def __init__(self):
+        self._entries = {}  # block_id -> (source digest, code object)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(source: str) -> str:
+        return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+    def get(self, block_id: int, source: str):
+        """Return the compiled code object for the block, compiling on a miss."""
+        digest = self.digest(source)
+        entry = self._entries.get(block_id)
+
+        if entry and entry[0] == digest:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        code = compile(source, f"<block {block_id}>", "exec")
+        # Old versions of the block are replaced, not accumulated
+        self._entries[block_id] = (digest, code)
+        return code
+
+    def invalidate(self, block_id: int = None):
+        """Drop one block (or everything when block_id is None)."""
+        if block_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(block_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# Shared per-process cache; admin.py invalidates it when a block is saved
+block_code_cache = BlockCodeCache()
@@ -1,155 +1,206 @@
-from sqlalchemy.orm import Session
-from database.models import UserParam, Trace, UserSession, Block
-from datetime import datetime
-from typing import List, Optional
-
-
-class ContextHelper:
-    def __init__(self, db: Session, user_id: str, platform: str, connector, module_manager):
-        self.db = db
-        self.user_id = user_id
-        self.platform = platform
-        self.connector = connector
-        self.module_manager = module_manager
-        self.should_stop = False  # Flag to stop execution if go_to is called
-
-    # ───────────────────────────────
-    # Modules
-    # ───────────────────────────────
-
-    def module_start(self, name: str):
-        """Force initialization of a module."""
-        self.module_manager.load_module(name)
-
-    def call_module(self, name: str, func_name: str, *args):
-        """Call a function in a module."""
-        module = self.module_manager.get_module(name)
-        if not hasattr(module, func_name):
-            raise AttributeError(f"Module {name} has no function {func_name}")
-        return getattr(module, func_name)(*args)
-
-    # ───────────────────────────────
-    # Params
-    # ───────────────────────────────
-
-    def set_param(self, key: str, value: str):
-        param = self.db.query(UserParam).filter_by(
-            user_id=self.user_id,
-            platform=self.platform,
-            key=key
-        ).first()
-
-        if param:
-            param.value = str(value)
-        else:
-            param = UserParam(
-                user_id=self.user_id,
-                platform=self.platform,
-                key=key,
-                value=str(value)
-            )
-            self.db.add(param)
-
-        self.db.commit()
-
-    def get_param(self, key: str):
-        param = self.db.query(UserParam).filter_by(
-            user_id=self.user_id,
-            platform=self.platform,
-            key=key
-        ).first()
-        return param.value if param else None
-
-    # ───────────────────────────────
-    # Messaging
-    # ───────────────────────────────
-
-    async def send_message(
-        self,
-        text: str,
-        buttons: Optional[List[str]] = None,
-        parse_mode: str = "text",
-        request_contact: bool = False
-    ):
-        """
-        Unified send_message compatible with BotProvider
-
-        :param text: message text
-        :param buttons: reply buttons
-        :param parse_mode: text | markdown | html
-        :param request_contact: request phone number
-        """
-
-        if not text:
-            return
-
-        MAX_LENGTH = 4000
-        parts = []
-
-        # Split long messages safely
-        if len(text) <= MAX_LENGTH:
-            parts.append(text)
-        else:
-            remaining = text
-            while remaining:
-                if len(remaining) <= MAX_LENGTH:
-                    parts.append(remaining)
-                    break
-
-                split_index = remaining.rfind('\n', 0, MAX_LENGTH)
-                if split_index == -1:
-                    split_index = remaining.rfind(' ', 0, MAX_LENGTH)
-                if split_index == -1:
-                    split_index = MAX_LENGTH
-
-                parts.append(remaining[:split_index])
-                remaining = remaining[split_index:].lstrip()
-
-        for i, part in enumerate(parts):
-            # ── Trace log
-            trace = Trace(
-                user_id=self.user_id,
-                platform=self.platform,
-                direction='outbound',
-                content=part,
-                created_at=datetime.utcnow()
-            )
-
-            session = self.db.query(UserSession).filter_by(
-                user_id=self.user_id,
-                platform=self.platform
-            ).first()
-
-            if session:
-                trace.block_id = session.current_block_id
-
-            self.db.add(trace)
-            self.db.commit()
-
-            # Buttons only on last message part
-            current_buttons = buttons if i == len(parts) - 1 else None
-            current_request_contact = request_contact if i == len(parts) - 1 else False
-
-            await self.connector.send_message(
-                user_id=self.user_id,
-                text=part,
-                buttons=current_buttons,
-                parse_mode=parse_mode,
-                request_contact=current_request_contact
-            )
-
-    # ───────────────────────────────
-    # Navigation
-    # ───────────────────────────────
-
-    def go_to(self, block_id: int):
-        session = self.db.query(UserSession).filter_by(
-            user_id=self.user_id,
-            platform=self.platform
-        ).first()
-
-        if session:
-            session.current_block_id = block_id
-            session.updated_at = datetime.utcnow()
-            self.db.commit()
-            self.should_stop = True
+import time
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.util import await_only
+from datetime import datetime
+from typing import Dict, List, Optional
+from .budget import budget_paused
+from .state import UserState
+
+
+class ContextHelper:
+    """
+    Scripting API of a single block run.
+
+    Nothing a block does touches the database: reads come from the
+    UserState loaded once for the whole message, and set_param, go_to and
+    send_message are recorded here. apply() moves them into the state only
+    if the block finished without raising; the engine writes the state
+    back right before its single commit. The state is shared by all hops
+    of one message, which is how a later hop sees values set by an earlier one.
+
+    The engine runs blocks through AsyncSession.run_sync, so call_module
+    looks blocking to the script but yields to the event loop while the
+    module works. `db` is the message's session; modules are looked up
+    through it instead of a second connection from the pool.
+    """
+
+    MAX_LENGTH = 4000
+
+    def __init__(self, state: UserState, connector, module_manager, db: AsyncSession = None):
+        self.state = state
+        self.db = db
+        self.user_id = state.user_id
+        self.platform = state.platform
+        self.connector = connector
+        self.module_manager = module_manager
+        self.should_stop = False  # Flag to stop execution if go_to is called
+
+        self.pending_params = {}  # key -> value set by this block
+        self.next_block_id = None
+        self.outbox = []
+        self.traces = []  # outbound trace rows, filled by apply()
+        self.module_time = 0.0  # seconds spent waiting on modules, for BlockMetrics
+
+    # ───────────────────────────────
+    # Modules
+    # ───────────────────────────────
+
+    def module_start(self, name: str):
+        """
+        Make sure a module is loaded. Goes through the same lock as
+        call_module, so a module already loaded is never executed again
+        under calls that are running in it.
+        """
+        started = time.perf_counter()
+        try:
+            with budget_paused():
+                await_only(self.module_manager.get_module(name, self.db))
+        finally:
+            self.module_time += time.perf_counter() - started
+
+    def call_module(self, name: str, func_name: str, *args):
+        """
+        Call a function in a module.
+        The block waits for the result, other users keep being served meanwhile.
+        The wait does not count against the block's wall-time budget.
+        """
+        started = time.perf_counter()
+        try:
+            with budget_paused():
+                return await_only(self.module_manager.call(name, func_name, *args, db=self.db))
+        finally:
+            self.module_time += time.perf_counter() - started
+
+    # ───────────────────────────────
+    # Params
+    # ───────────────────────────────
+
+    def set_param(self, key: str, value: str):
+        self.pending_params[key] = str(value)
+
+    def get_param(self, key: str):
+        if key in self.pending_params:
+            return self.pending_params[key]
+        return self.state.get(key)
+
+    def get_params(self, keys: List[str]) -> Dict[str, Optional[str]]:
+        """Several params at once: get_params(['age', 'height']) -> {'age': ..., 'height': ...}"""
+        values = self.state.get_many(keys)
+        values.update((key, self.pending_params[key]) for key in keys if key in self.pending_params)
+        return values
+
+    # ───────────────────────────────
+    # Messaging
+    # ───────────────────────────────
+
+    def send_message(
+        self,
+        text: str,
+        buttons: Optional[List[str]] = None,
+        parse_mode: str = "text",
+        request_contact: bool = False
+    ):
+        """
+        Backward-compatible script API:
+        send_message(text)
+        send_message(text, buttons)
+        send_message(text, buttons, parse_mode, request_contact)
+
+        :param text: message text
+        :param buttons: reply buttons
+        :param parse_mode: text | markdown | html
+        :param request_contact: request phone number
+        """
+        self.outbox.append({
+            "text": text,
+            "buttons": buttons,
+            "parse_mode": parse_mode,
+            "request_contact": request_contact
+        })
+
+    @classmethod
+    def split_text(cls, text: str) -> List[str]:
+        """Split long messages safely (newline, then space, then hard cut)."""
+        if len(text) <= cls.MAX_LENGTH:
+            return [text]
+
+        parts = []
+        remaining = text
+        while remaining:
+            if len(remaining) <= cls.MAX_LENGTH:
+                parts.append(remaining)
+                break
+
+            split_index = remaining.rfind('\n', 0, cls.MAX_LENGTH)
+            if split_index == -1:
+                split_index = remaining.rfind(' ', 0, cls.MAX_LENGTH)
+            if split_index == -1:
+                split_index = cls.MAX_LENGTH
+
+            parts.append(remaining[:split_index])
+            remaining = remaining[split_index:].lstrip()
+        return parts
+
+    # ───────────────────────────────
+    # Navigation
+    # ───────────────────────────────
+
+    def go_to(self, block_id: int):
+        if self.state.session:
+            self.next_block_id = block_id
+            self.should_stop = True
+
+    # ───────────────────────────────
+    # Unit of work
+    # ───────────────────────────────
+
+    def replay(self, effects: dict):
+        """Record effects a block produced in a worker process (see BlockProcessPool)."""
+        for key, value in effects["params"].items():
+            self.set_param(key, value)
+        for msg in effects["outbox"]:
+            self.send_message(**msg)
+        if effects["next_block_id"] is not None:
+            self.go_to(effects["next_block_id"])
+
+    def apply(self) -> List[dict]:
+        """
+        Move the block's writes into the user state and return the
+        outbound message parts to deliver once the engine commits.
+        Outbound trace rows are collected in `self.traces` for the TraceWriter.
+        """
+        for key, value in self.pending_params.items():
+            self.state.set(key, value)
+
+        session = self.state.session
+        if self.next_block_id is not None:
+            self.state.move_to(self.next_block_id)
+
+        deliveries = []
+        for msg in self.outbox:
+            if not msg["text"]:
+                continue
+
+            parts = self.split_text(msg["text"])
+            for i, part in enumerate(parts):
+                self.traces.append({
+                    "workflow_id": self.state.workflow_id,
+                    "user_id": self.user_id,
+                    "platform": self.platform,
+                    "block_id": session.current_block_id if session else None,
+                    "direction": "outbound",
+                    "content": part,
+                    "created_at": datetime.utcnow()
+                })
+
+                # Buttons only on last message part
+                last = i == len(parts) - 1
+                deliveries.append({
+                    "user_id": self.user_id,
+                    "text": part,
+                    "buttons": msg["buttons"] if last else None,
+                    "parse_mode": msg["parse_mode"],
+                    "request_contact": msg["request_contact"] if last else False
+                })
+
+        return deliveries
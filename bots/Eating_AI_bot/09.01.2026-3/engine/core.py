@@ -1,208 +1,388 @@
-import traceback
-from sqlalchemy.orm import Session
-from database.models import UserSession, Block, Trace, BotUser
-from .context import ContextHelper
-from .manager import ModuleManager
-from datetime import datetime
-
-
-class ChatbotEngine:
-    def __init__(self, db_session_factory, connector):
-        self.db_session_factory = db_session_factory
-        self.connector = connector
-        self.module_manager = ModuleManager(db_session_factory)
-
-    async def process_message(
-        self,
-        user_id: str,
-        platform: str,
-        text: str,
-        user_data: dict = None
-    ):
-        db: Session = self.db_session_factory()
-
-        try:
-            # ───────────────────────────────
-            # 0. User management
-            # ───────────────────────────────
-
-            user = db.query(BotUser).filter_by(
-                user_id=user_id,
-                platform=platform
-            ).first()
-
-            username = user_data.get("username") if user_data else None
-
-            if not user:
-                user = BotUser(
-                    user_id=user_id,
-                    platform=platform,
-                    username=username,
-                    is_active=True
-                )
-                db.add(user)
-                db.commit()
-            else:
-                if username and user.username != username:
-                    user.username = username
-                    db.commit()
-
-            # Save user_data → UserParam
-            if user_data:
-                from database.models import UserParam
-                for key, value in user_data.items():
-                    if key == "username" or value is None:
-                        continue
-
-                    param = db.query(UserParam).filter_by(
-                        user_id=user_id,
-                        platform=platform,
-                        key=key
-                    ).first()
-
-                    if param:
-                        param.value = str(value)
-                    else:
-                        db.add(UserParam(
-                            user_id=user_id,
-                            platform=platform,
-                            key=key,
-                            value=str(value)
-                        ))
-                db.commit()
-
-            if not user.is_active:
-                print(f"Ignored message from inactive user {user_id}")
-                return
-
-            # ───────────────────────────────
-            # 1. Log inbound
-            # ───────────────────────────────
-
-            session = db.query(UserSession).filter_by(
-                user_id=user_id,
-                platform=platform
-            ).first()
-
-            trace = Trace(
-                user_id=user_id,
-                platform=platform,
-                block_id=session.current_block_id if session else None,
-                direction="inbound",
-                content=text,
-                created_at=datetime.utcnow()
-            )
-            db.add(trace)
-            db.commit()
-
-            # ───────────────────────────────
-            # 2. Session initialization
-            # ───────────────────────────────
-
-            if not session:
-                start_block = db.query(Block).filter_by(is_start=True).first()
-                if not start_block:
-                    print("Error: No start block found!")
-                    return
-
-                session = UserSession(
-                    user_id=user_id,
-                    platform=platform,
-                    current_block_id=start_block.id
-                )
-                db.add(session)
-                db.commit()
-
-            # ───────────────────────────────
-            # 3. Block execution loop
-            # ───────────────────────────────
-
-            event = "message"
-
-            while True:
-                block = db.query(Block).filter_by(
-                    id=session.current_block_id
-                ).first()
-
-                if not block:
-                    print(f"Error: Block {session.current_block_id} not found")
-                    break
-
-                helper = ContextHelper(
-                    db=db,
-                    user_id=user_id,
-                    platform=platform,
-                    connector=self.connector,
-                    module_manager=self.module_manager
-                )
-
-                # ───────────────────────────────
-                # 4. Execution context
-                # ───────────────────────────────
-
-                outbox = []
-
-                def sync_send_message(
-                    text,
-                    buttons=None,
-                    parse_mode="text",
-                    request_contact=False
-                ):
-                    """
-                    Backward-compatible wrapper:
-                    send_message(text)
-                    send_message(text, buttons)
-                    send_message(text, buttons, parse_mode, request_contact)
-                    """
-                    outbox.append({
-                        "text": text,
-                        "buttons": buttons,
-                        "parse_mode": parse_mode,
-                        "request_contact": request_contact
-                    })
-
-                context = {
-                    "input_text": text,
-                    "event": event,
-                    "set_param": helper.set_param,
-                    "get_param": helper.get_param,
-                    "send_message": sync_send_message,
-                    "go_to": helper.go_to,
-                    "ModuleStart": helper.module_start,
-                    "call_module": helper.call_module,
-                    "print": print
-                }
-
-                # ───────────────────────────────
-                # 5. Execute block
-                # ───────────────────────────────
-
-                try:
-                    exec(block.script_code, context)
-
-                    # Flush outbox
-                    for msg in outbox:
-                        await helper.send_message(
-                            text=msg["text"],
-                            buttons=msg["buttons"],
-                            parse_mode=msg["parse_mode"],
-                            request_contact=msg["request_contact"]
-                        )
-
-                    if helper.should_stop:
-                        event = "enter"
-                        continue
-                    else:
-                        break
-
-                except Exception as e:
-                    print(f"Error executing block {block.id}: {e}")
-                    traceback.print_exc()
-                    await self.connector.send_message(
-                        user_id,
-                        "⚠️ Произошла ошибка в работе бота"
-                    )
-                    break
-
-        finally:
-            db.close()
+import functools
+import time
+import traceback
+from sqlalchemy import insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.base import db_writer
+from database.models import BotUser
+from database.sqlite import SqliteWriter
+from .context import ContextHelper
+from .manager import ModuleManager
+from .profiles import ProfileCache
+from .budget import (BLOCK_STEP_BUDGET, BLOCK_WALL_BUDGET, MAX_HOPS, BudgetExceeded,
+                     BudgetViolations, block_budget)
+from .code_cache import block_code_cache
+from .executor import BlockFailed, BlockProcessPool
+from .metrics import BlockMetrics, statement_count
+from .scenario import ScenarioCache
+from .state import UserState
+from .store import StateStore, make_state_store
+from .trace_writer import TraceWriter
+from .users import UserDirectory, UserEntry
+from datetime import datetime
+from typing import Optional
+
+
+class ChatbotEngine:
+    def __init__(self, db_session_factory, connector, trace_writer: TraceWriter = None,
+                 state_store: StateStore = None, writer: Optional[SqliteWriter] = db_writer):
+        self.db_session_factory = db_session_factory  # async_sessionmaker
+        self.connector = connector  # of workflow 0, the TG_TOKEN bot
+        self.connectors = {}  # workflow_id -> connector, kept by WorkflowRunner
+        self.writer = writer  # SQLITE_PROFILE=production: all writes go through it
+        self.module_manager = ModuleManager(db_session_factory, writer=writer)
+        self.code_cache = block_code_cache
+        self.scenario_cache = ScenarioCache(self.code_cache)
+        self.trace_writer = trace_writer or TraceWriter(db_session_factory, writer=writer)
+        self.profile_cache = ProfileCache()
+        self.user_directory = UserDirectory(db_session_factory)
+        self.state_store = state_store or make_state_store(db_session_factory)
+        self.block_pool = BlockProcessPool()
+
+        # Runaway protection
+        self.max_hops = MAX_HOPS
+        self.step_budget = BLOCK_STEP_BUDGET
+        self.wall_budget = BLOCK_WALL_BUDGET
+        self.violations = BudgetViolations()
+
+        self.block_metrics = BlockMetrics()
+
+    async def close(self):
+        """
+        Flush buffered trace rows, stop the block worker processes, close
+        the state store and stop the SQLite writer thread.
+        """
+        await self.trace_writer.close()
+        await self.block_pool.close()
+        self.state_store.close()
+        if self.writer:
+            self.writer.close()
+
+    async def process_message(
+        self,
+        user_id: str,
+        platform: str,
+        text: str,
+        user_data: dict = None,
+        workflow_id: int = 0
+    ):
+        """
+        Handle one inbound message as a single unit of work.
+
+        Every write (user, params, session, block effects) is staged and
+        runs in one transaction that is committed once at the end; with
+        SQLITE_PROFILE=production that transaction is handed to the SQLite
+        writer thread and shares a commit with other messages. A block that raises
+        has none of its own writes applied, while earlier hops are still
+        committed. If anything else fails the whole transaction is rolled
+        back. After a successful commit the trace rows are handed to the
+        buffered TraceWriter and the outbound messages are delivered.
+
+        user_data is only synced when it differs from what was synced for
+        this user last time (see ProfileCache). Users known to be inactive
+        are dropped before any database access (see UserDirectory).
+
+        `workflow_id` is the bot the message came to (0 for the single
+        TG_TOKEN bot); users, sessions, params, blocks and every cache are
+        kept apart per workflow.
+
+        The session and params come from `state_store` (see engine.store);
+        a store that is not SQL writes them after the commit.
+        """
+        traces = []
+        writes = []
+        key = (workflow_id, user_id, platform)
+
+        await self.user_directory.refresh()
+        await self.state_store.refresh()
+        generation = self.user_directory.generation
+        self.profile_cache.follow(generation)
+        entry = self.user_directory.get(key)
+        if entry is not None and not entry.is_active:
+            print(f"Ignored message from inactive user {user_id}")
+            return
+
+        fingerprint = self.profile_cache.fingerprint(user_data) if user_data else None
+        sync_profile = fingerprint is not None and not self.profile_cache.matches(key, fingerprint)
+
+        async with self.db_session_factory() as db:
+            try:
+                deliveries, user = await self._handle(db, workflow_id, user_id, platform, text, user_data,
+                                                      sync_profile, entry, traces, writes)
+                new_user_id = await self._commit(db, writes)
+            except Exception:
+                await db.rollback()
+                self.state_store.discard(key)
+                raise
+            finally:
+                # Module statuses noted during the message; after commit or
+                # rollback the session holds no connection, so this takes the only one
+                await self.module_manager.write_statuses()
+        await self.state_store.committed(key)
+
+        # ids of new users are known after the commit
+        if user.id is None:
+            user = user._replace(id=new_user_id)
+        self.user_directory.put(key, user, generation)
+
+        if sync_profile and user.is_active:
+            self.profile_cache.remember(key, fingerprint, generation)
+
+        for row in traces:
+            await self.trace_writer.write(row)
+
+        connector = self.connector_for(workflow_id)
+        if connector is None:
+            # The workflow was stopped while the message was being handled
+            if deliveries:
+                print(f"Dropped {len(deliveries)} messages of stopped workflow {workflow_id}")
+            return
+        for msg in deliveries:
+            await connector.send_message(**msg)
+
+    async def _handle(
+        self,
+        db: AsyncSession,
+        workflow_id: int,
+        user_id: str,
+        platform: str,
+        text: str,
+        user_data: dict,
+        sync_profile: bool,
+        entry: Optional[UserEntry],
+        traces: list,
+        writes: list
+    ) -> tuple:
+        """
+        Read through `db`, stage all writes for one message in `writes`,
+        collect its trace rows in `traces` and return the messages to
+        deliver along with the user (a UserEntry; its id is None for a
+        user inserted by `writes`).
+        """
+
+        # ───────────────────────────────
+        # 0. User management
+        # ───────────────────────────────
+
+        username = user_data.get("username") if user_data else None
+
+        if entry is not None:
+            user = entry
+        else:
+            row = (await db.execute(select(BotUser.id, BotUser.username, BotUser.is_active).filter_by(
+                workflow_id=workflow_id,
+                user_id=user_id,
+                platform=platform
+            ))).first()
+
+            if not row:
+                writes.append(insert(BotUser).values(
+                    workflow_id=workflow_id,
+                    user_id=user_id,
+                    platform=platform,
+                    username=username,
+                    is_active=True
+                ))
+                user = UserEntry(None, username, True)
+            else:
+                user = UserEntry(*row)
+                if not user.is_active:
+                    print(f"Ignored message from inactive user {user_id}")
+                    return [], user
+
+        if sync_profile and username and user.username != username and user.id is not None:
+            writes.append(update(BotUser).where(BotUser.id == user.id).values(username=username))
+            user = user._replace(username=username)
+
+        # Session and all params, loaded once and shared by all hops
+        state = await self.state_store.load(db, workflow_id, user_id, platform)
+
+        # Save user_data → UserParam (one bulk upsert together with the block's params);
+        # only the keys that changed end up in the upsert
+        if sync_profile:
+            for key, value in user_data.items():
+                if key == "username" or value is None:
+                    continue
+                state.set(key, str(value))
+
+        # ───────────────────────────────
+        # 1. Log inbound
+        # ───────────────────────────────
+
+        session = state.session
+
+        traces.append({
+            "workflow_id": workflow_id,
+            "user_id": user_id,
+            "platform": platform,
+            "block_id": session.current_block_id if session else None,
+            "direction": "inbound",
+            "content": text,
+            "created_at": datetime.utcnow()
+        })
+
+        # ───────────────────────────────
+        # 2. Session initialization
+        # ───────────────────────────────
+
+        scenario = await self.scenario_cache.current(db, workflow_id)
+
+        if not session:
+            start_block = scenario.start_block
+            if not start_block:
+                print("Error: No start block found!")
+                # Keep the user_data synced above
+                await self.state_store.save(db, state, writes)
+                return [], user
+
+            session = state.start(start_block.id)
+
+        # ───────────────────────────────
+        # 3. Block execution loop
+        # ───────────────────────────────
+
+        event = "message"
+        deliveries = []
+        hops = 0
+        # Counts statements of this message's transaction, see engine.metrics
+        connection = (await db.connection()).sync_connection
+
+        while True:
+            block = scenario.get(session.current_block_id)
+
+            if not block:
+                print(f"Error: Block {session.current_block_id} not found")
+                break
+
+            # A block that go_to's itself on 'enter', or a cycle of blocks
+            hops += 1
+            if self.max_hops and hops > self.max_hops:
+                self._report_violation(BudgetExceeded("hops", self.max_hops, block.id), state, traces)
+                deliveries.append({
+                    "user_id": user_id,
+                    "text": "⚠️ Произошла ошибка в работе бота"
+                })
+                break
+
+            helper = ContextHelper(
+                state=state,
+                connector=self.connector_for(workflow_id),
+                module_manager=self.module_manager,
+                db=db
+            )
+
+            # ───────────────────────────────
+            # 4. Execution context
+            # ───────────────────────────────
+
+            context = {
+                "input_text": text,
+                "event": event,
+                "set_param": helper.set_param,
+                "get_param": helper.get_param,
+                "get_params": helper.get_params,
+                "send_message": helper.send_message,
+                "go_to": helper.go_to,
+                "ModuleStart": helper.module_start,
+                "call_module": helper.call_module,
+                "print": print
+            }
+
+            # ───────────────────────────────
+            # 5. Execute block
+            # ───────────────────────────────
+
+            started = time.perf_counter()
+            statements = statement_count(connection)
+            try:
+                if self.block_pool.wants(block):
+                    # CPU-heavy block: runs in a worker process, effects are replayed into the helper
+                    await self.block_pool.run(block, helper, text, event)
+                else:
+                    code = self.code_cache.get(block.id, block.script_code)
+                    # run_sync lets the synchronous script API await modules
+                    # without blocking the event loop
+                    await db.run_sync(lambda _: self._exec(code, context))
+            except BudgetExceeded as e:
+                e.block_id = block.id
+                self._report_violation(e, state, traces)
+                deliveries.append({
+                    "user_id": user_id,
+                    "text": "⚠️ Произошла ошибка в работе бота"
+                })
+                break
+            except Exception as e:
+                # The helper's recorded writes are simply never applied
+                print(f"Error executing block {block.id}: {e}")
+                if isinstance(e, BlockFailed):
+                    print(e.details)
+                else:
+                    traceback.print_exc()
+                deliveries.append({
+                    "user_id": user_id,
+                    "text": "⚠️ Произошла ошибка в работе бота"
+                })
+                break
+            finally:
+                self.block_metrics.observe(block.id, event, time.perf_counter() - started,
+                                           statement_count(connection) - statements,
+                                           len(helper.outbox), helper.module_time)
+
+            deliveries.extend(helper.apply())
+            traces.extend(helper.traces)
+
+            if helper.should_stop:
+                event = "enter"
+                continue
+            else:
+                break
+
+        await self.state_store.save(db, state, writes)
+        return deliveries, user
+
+    async def _commit(self, db: AsyncSession, writes: list) -> Optional[int]:
+        """
+        Run the staged writes in one transaction and commit: in `db`, or in
+        the next group commit of the SQLite writer. Returns the id of the
+        BotUser they inserted, if any.
+        """
+        if self.writer is None:
+            new_user_id = await db.run_sync(lambda session: apply_writes(writes, session.connection()))
+            await db.commit()
+            return new_user_id
+        # Ends the read transaction, so the connection goes back to the pool while waiting
+        await db.rollback()
+        if not writes:
+            return None
+        return await self.writer.run(functools.partial(apply_writes, writes))
+
+    def connector_for(self, workflow_id: int):
+        return self.connectors.get(workflow_id, self.connector if workflow_id == 0 else None)
+
+    def _exec(self, code, context: dict):
+        with block_budget(self.step_budget, self.wall_budget):
+            exec(code, context)
+
+    def _report_violation(self, error: BudgetExceeded, state: UserState, traces: list):
+        """Log a budget violation, count it and keep it in the trace next to the messages."""
+        print(f"Block {error.block_id} stopped: {error}")
+        self.violations.record(error)
+        traces.append({
+            "workflow_id": state.workflow_id,
+            "user_id": state.user_id,
+            "platform": state.platform,
+            "block_id": error.block_id,
+            "direction": "error",
+            "content": str(error),
+            "created_at": datetime.utcnow()
+        })
+
+
+def apply_writes(writes: list, connection) -> Optional[int]:
+    """Execute staged statements in order; returns the id of an inserted BotUser."""
+    new_user_id = None
+    for statement in writes:
+        result = connection.execute(statement)
+        if statement.is_insert and statement.table is BotUser.__table__:
+            new_user_id = result.inserted_primary_key[0]
+    return new_user_id
@@ -0,0 +1,149 @@
+import asyncio
+import os
+import time
+import traceback
+from collections import deque
+
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "8"))
+DISPATCH_IDLE_TIMEOUT = float(os.getenv("DISPATCH_IDLE_TIMEOUT", "60"))
+
+
+class _UserQueue:
+    __slots__ = ("items", "scheduled", "last_active")
+
+    def __init__(self):
+        self.items = deque()  # (enqueued_at, args)
+        self.scheduled = False  # key is in the ready queue or being processed
+        self.last_active = time.monotonic()
+
+
+class MessageDispatcher:
+    """
+    Sits between a connector and ChatbotEngine.process_message.
+
+    Every (workflow_id, user_id, platform) gets its own FIFO queue, and at most one of
+    its messages is processed at a time, so a user's messages never race
+    on UserSession.current_block_id. Different users are processed in
+    parallel by a fixed pool of worker tasks. Queues that have been empty
+    for `idle_timeout` seconds are evicted.
+    """
+
+    def __init__(self, handler, workers: int = DISPATCH_WORKERS, idle_timeout: float = DISPATCH_IDLE_TIMEOUT):
+        self.handler = handler
+        self.workers = workers
+        self.idle_timeout = idle_timeout
+
+        self._queues = {}  # (workflow_id, user_id, platform) -> _UserQueue
+        self._ready = asyncio.Queue()  # keys with pending messages, one entry per key
+        self._tasks = []
+        self._pending = 0
+
+        # Metrics
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.evicted = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    # ───────────────────────────────
+    # Lifecycle
+    # ───────────────────────────────
+
+    async def start(self):
+        for n in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(), name=f"dispatch-worker-{n}"))
+        self._tasks.append(asyncio.create_task(self._evict_idle(), name="dispatch-evictor"))
+
+    async def close(self):
+        """Wait for queued messages to be processed, then stop the workers."""
+        while self._pending:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    # ───────────────────────────────
+    # Intake
+    # ───────────────────────────────
+
+    async def submit(self, user_id: str, platform: str, text: str, user_data: dict = None,
+                     workflow_id: int = 0):
+        """
+        Connector callback: enqueue the message and return immediately.
+        WorkflowRunner binds `workflow_id` for the connectors it starts.
+        """
+        key = (workflow_id, user_id, platform)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = _UserQueue()
+
+        queue.items.append((time.monotonic(), (user_id, platform, text, user_data, workflow_id)))
+        queue.last_active = time.monotonic()
+        self._pending += 1
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, len(queue.items))
+
+        if not queue.scheduled:
+            queue.scheduled = True
+            self._ready.put_nowait(key)
+
+    # ───────────────────────────────
+    # Processing
+    # ───────────────────────────────
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            enqueued_at, args = queue.items.popleft()
+
+            wait = time.monotonic() - enqueued_at
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+            try:
+                await self.handler(*args)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Error processing message from {key[1]} ({key[2]}, workflow {key[0]}): {e}")
+                traceback.print_exc()
+            finally:
+                self._pending -= 1
+                queue.last_active = time.monotonic()
+
+                # Re-queue at the tail so one busy user cannot starve the others
+                if queue.items:
+                    self._ready.put_nowait(key)
+                else:
+                    queue.scheduled = False
+
+    async def _evict_idle(self):
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2 or 1)
+            now = time.monotonic()
+            for key in [k for k, q in self._queues.items()
+                        if not q.scheduled and not q.items and now - q.last_active >= self.idle_timeout]:
+                del self._queues[key]
+                self.evicted += 1
+
+    # ───────────────────────────────
+    # Metrics
+    # ───────────────────────────────
+
+    def stats(self) -> dict:
+        done = self.processed + self.failed
+        return {
+            "queues": len(self._queues),
+            "pending": self._pending,
+            "max_depth": self.max_depth,
+            "submitted": self.submitted,
+            "processed": self.processed,
+            "failed": self.failed,
+            "evicted": self.evicted,
+            "wait_avg": self.wait_total / done if done else 0.0,
+            "wait_max": self.wait_max,
+        }
@@ -0,0 +1,260 @@
+import asyncio
+import math
+import os
+import signal
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional
+from .budget import BLOCK_STEP_BUDGET, BudgetExceeded, block_budget
+from .code_cache import BlockCodeCache
+
+try:
+    import resource  # Unix only
+except ImportError:
+    resource = None
+
+# inline - every block runs in the event-loop thread (default)
+# heavy  - blocks marked is_heavy run in worker processes
+# all    - every block runs in worker processes
+BLOCK_EXECUTION = os.getenv("BLOCK_EXECUTION", "inline")
+BLOCK_PROCESSES = int(os.getenv("BLOCK_PROCESSES", "0")) or os.cpu_count() or 1
+BLOCK_TIMEOUT = float(os.getenv("BLOCK_TIMEOUT", "10"))  # wall seconds per block
+BLOCK_CPU_LIMIT = int(os.getenv("BLOCK_CPU_LIMIT", "5"))  # CPU seconds per block, 0 = no limit
+
+# Scripting calls that need the parent process (module state, threads, network)
+PARENT_ONLY_CALLS = ("call_module", "ModuleStart")
+
+
+class BlockFailed(Exception):
+    """A block raised inside a worker; carries the worker's traceback text."""
+
+    def __init__(self, message: str, details: str = ""):
+        super().__init__(message)
+        self.details = details
+
+
+# ───────────────────────────────
+# Worker side
+# ───────────────────────────────
+
+_code_cache = None
+
+
+def _init_worker():
+    global _code_cache
+    _code_cache = BlockCodeCache()  # warm for the life of the worker
+    # Ctrl+C is handled by the parent, which shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class _Effects:
+    """Worker-side scripting API: reads a params snapshot, records writes."""
+
+    def __init__(self, params: Dict[str, str], has_session: bool):
+        self.params = params
+        self.has_session = has_session
+        self.pending_params = {}
+        self.outbox = []
+        self.next_block_id = None
+
+    def set_param(self, key: str, value: str):
+        self.pending_params[key] = str(value)
+
+    def get_param(self, key: str):
+        if key in self.pending_params:
+            return self.pending_params[key]
+        return self.params.get(key)
+
+    def get_params(self, keys: List[str]) -> Dict[str, Optional[str]]:
+        return {key: self.get_param(key) for key in keys}
+
+    def send_message(self, text: str, buttons: Optional[List[str]] = None,
+                     parse_mode: str = "text", request_contact: bool = False):
+        self.outbox.append({
+            "text": text,
+            "buttons": buttons,
+            "parse_mode": parse_mode,
+            "request_contact": request_contact
+        })
+
+    def go_to(self, block_id: int):
+        if self.has_session:
+            self.next_block_id = block_id
+
+    def parent_only(self, *args):
+        raise RuntimeError("call_module / ModuleStart are not available in worker processes")
+
+
+_limits = {}  # limits of the block being run, for the signal handlers
+
+
+def _raise_wall(signum, frame):
+    raise BudgetExceeded("wall", _limits["wall"])
+
+
+def _raise_cpu(signum, frame):
+    raise BudgetExceeded("cpu", _limits["cpu"])
+
+
+def _run_block(block_id: int, source: str, input_text: str, event: str, params: dict,
+               has_session: bool, timeout: float, cpu_limit: int, max_steps: int) -> dict:
+    """Execute one block in a worker and return its effects (or the error)."""
+    effects = _Effects(params, has_session)
+    context = {
+        "input_text": input_text,
+        "event": event,
+        "set_param": effects.set_param,
+        "get_param": effects.get_param,
+        "get_params": effects.get_params,
+        "send_message": effects.send_message,
+        "go_to": effects.go_to,
+        "ModuleStart": effects.parent_only,
+        "call_module": effects.parent_only,
+        "print": print
+    }
+
+    _limits.update(wall=timeout, cpu=cpu_limit)
+    cpu_soft = None
+    if cpu_limit and resource is not None:
+        # RLIMIT_CPU counts the whole process, so the limit is moved past what is used so far
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu_soft, cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)
+        signal.signal(signal.SIGXCPU, _raise_cpu)
+        resource.setrlimit(resource.RLIMIT_CPU,
+                           (math.ceil(usage.ru_utime + usage.ru_stime) + cpu_limit, cpu_hard))
+    if timeout and hasattr(signal, "setitimer"):
+        signal.signal(signal.SIGALRM, _raise_wall)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+
+    try:
+        # Wall time is already covered by SIGALRM
+        with block_budget(max_steps, wall=0):
+            exec(_code_cache.get(block_id, source), context)
+    except BudgetExceeded as e:
+        return {"violation": e.kind, "limit": e.limit}
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}", "details": traceback.format_exc()}
+    finally:
+        if timeout and hasattr(signal, "setitimer"):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if cpu_soft is not None:
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_soft, cpu_hard))
+
+    return {
+        "params": effects.pending_params,
+        "outbox": effects.outbox,
+        "next_block_id": effects.next_block_id,
+    }
+
+
+# ───────────────────────────────
+# Parent side
+# ───────────────────────────────
+
+class BlockProcessPool:
+    """
+    Runs block scripts in a pool of worker processes so CPU-heavy blocks
+    neither stall the event loop nor stay on one core.
+
+    A worker gets the block source, the input and a snapshot of the user's
+    params, and sends back the block's effects (params set, messages, go_to),
+    which the parent replays through ContextHelper. Each worker keeps its
+    own compiled-code cache. Inside the worker the block is stopped by
+    SIGALRM after `timeout` seconds, by SIGXCPU after `cpu_limit` CPU
+    seconds (Unix) and by the step budget after `max_steps` instructions. If a
+    worker does not answer within timeout + 1s the whole pool is killed
+    and recreated. Every such stop is raised as BudgetExceeded.
+
+    Blocks that call modules always run inline: module instances live in
+    the parent process.
+    """
+
+    def __init__(self, mode: str = BLOCK_EXECUTION, processes: int = BLOCK_PROCESSES,
+                 timeout: float = BLOCK_TIMEOUT, cpu_limit: int = BLOCK_CPU_LIMIT,
+                 max_steps: int = BLOCK_STEP_BUDGET):
+        if mode not in ("inline", "heavy", "all"):
+            raise ValueError(f"Unknown block execution mode: {mode}")
+
+        self.mode = mode
+        self.processes = processes
+        self.timeout = timeout
+        self.cpu_limit = cpu_limit
+        self.max_steps = max_steps
+        self._pool = None
+        self._slots = None  # one block per worker, so queueing does not eat into the timeout
+
+        # Metrics
+        self.runs = 0
+        self.failed = 0
+        self.over_budget = 0
+        self.restarts = 0
+
+    def wants(self, block) -> bool:
+        if self.mode == "inline" or (self.mode == "heavy" and not block.is_heavy):
+            return False
+        return not any(name in block.script_code for name in PARENT_ONLY_CALLS)
+
+    async def run(self, block, helper, input_text: str, event: str):
+        """Execute `block` in a worker and record its effects in `helper`."""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.processes)
+
+        async with self._slots:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.processes, initializer=_init_worker)
+            pool = self._pool
+
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                pool, _run_block, block.id, block.script_code, input_text, event,
+                dict(helper.state.values), helper.state.session is not None, self.timeout, self.cpu_limit,
+                self.max_steps
+            )
+            self.runs += 1
+
+            try:
+                result = await asyncio.wait_for(future, self.timeout + 1 if self.timeout else None)
+            except asyncio.TimeoutError:
+                self.over_budget += 1
+                self._restart(pool)
+                raise BudgetExceeded("wall", self.timeout, block.id)
+            except BrokenProcessPool:
+                # Killed together with a runaway block of another user
+                self.failed += 1
+                self._restart(pool)
+                raise
+
+        if "violation" in result:
+            self.over_budget += 1
+            raise BudgetExceeded(result["violation"], result["limit"], block.id)
+        if "error" in result:
+            self.failed += 1
+            raise BlockFailed(result["error"], result["details"])
+
+        helper.replay(result)
+
+    def _restart(self, pool: ProcessPoolExecutor):
+        if self._pool is not pool:
+            return  # already replaced
+        self._pool = None
+        self.restarts += 1
+        # ProcessPoolExecutor cannot cancel a running call; kill the workers instead
+        for process in list(getattr(pool, "_processes", {}).values()):
+            process.kill()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    async def close(self):
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            # Waiting for the workers to exit blocks; keep the loop serving meanwhile
+            await asyncio.to_thread(pool.shutdown, True, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "runs": self.runs,
+            "failed": self.failed,
+            "over_budget": self.over_budget,
+            "restarts": self.restarts,
+        }
@@ -1,61 +1,160 @@
-import importlib.util
-import os
-import sys
-from sqlalchemy.orm import Session
-from database.models import Module
-
-class ModuleManager:
-    def __init__(self, db_session_factory):
-        self.db_session_factory = db_session_factory
-        self.loaded_modules = {} # name -> module instance/object
-
-    def load_module(self, name: str):
-        db = self.db_session_factory()
-        try:
-            module_record = db.query(Module).filter_by(name=name).first()
-            if not module_record:
-                raise ValueError(f"Module {name} not found in database")
-
-            file_path = module_record.py_file
-            if not os.path.exists(file_path):
-                # Try relative to project root if not absolute
-                # Assuming MOD folder is in project root
-                file_path = os.path.abspath(file_path)
-                if not os.path.exists(file_path):
-                     raise FileNotFoundError(f"Module file not found: {file_path}")
-
-            spec = importlib.util.spec_from_file_location(name, file_path)
-            if spec is None:
-                raise ImportError(f"Could not load spec for module {name}")
-            
-            module = importlib.util.module_from_spec(spec)
-            sys.modules[name] = module
-            spec.loader.exec_module(module)
-            
-            # Instantiate the main class if convention exists, or just return module
-            # The user example has a class GigaChatAssistant.
-            # We might need a convention. For now, let's assume the module exposes a specific class or function?
-            # Or we just return the module object and let the script call what it needs.
-            # But the user said "Initialization... at first call".
-            # Let's assume the module has an `init()` function or we just return the module.
-            
-            self.loaded_modules[name] = module
-            
-            module_record.status = "run"
-            db.commit()
-            print(f"Module {name} loaded successfully.")
-            return module
-
-        except Exception as e:
-            print(f"Error loading module {name}: {e}")
-            if module_record:
-                module_record.status = "error"
-                db.commit()
-            raise e
-        finally:
-            db.close()
-
-    def get_module(self, name: str):
-        if name in self.loaded_modules:
-            return self.loaded_modules[name]
-        return self.load_module(name)
+import asyncio
+import importlib.util
+import inspect
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from database.models import Module
+
+# Threads shared by all synchronous module calls
+MODULE_THREADS = int(os.getenv("MODULE_THREADS", "8"))
+# Default max concurrent calls per module, and per-module overrides: "GigaAI=2,Other=1".
+# Modules keep state in globals, so one call at a time unless the module
+# declares `CONCURRENCY = N` (safe to call from N threads) or MODULE_LIMITS says so.
+MODULE_CONCURRENCY = int(os.getenv("MODULE_CONCURRENCY", "1"))
+MODULE_LIMITS = os.getenv("MODULE_LIMITS", "")
+
+
+def parse_limits(spec: str) -> dict:
+    limits = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            limits[name.strip()] = int(value)
+    return limits
+
+
+class ModuleManager:
+    def __init__(self, db_session_factory, threads: int = MODULE_THREADS,
+                 default_limit: int = MODULE_CONCURRENCY, limits: dict = None, writer=None):
+        self.db_session_factory = db_session_factory  # async_sessionmaker
+        self.writer = writer  # SqliteWriter: the session is read-only, statuses are written there
+        self.loaded_modules = {} # name -> module instance/object
+
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="module")
+        self.default_limit = default_limit
+        self.limits = limits if limits is not None else parse_limits(MODULE_LIMITS)
+        self._semaphores = {}  # name -> asyncio.Semaphore
+        self._load_locks = {}  # name -> asyncio.Lock, so concurrent first calls load once
+        self._statuses = {}  # name -> status noted by load_module, not stored yet
+
+    async def load_module(self, name: str, db: AsyncSession):
+        """
+        Import module `name` (again, if it is already loaded).
+
+        `db` is the caller's session: a block that loads a module already
+        holds the message's connection, and taking a second one from the
+        pool here would wait forever once every connection is held by such
+        a block. The new status is only noted; write_statuses() stores it
+        after the caller's transaction.
+        """
+        py_file = await db.scalar(select(Module.py_file).filter_by(name=name))
+        if py_file is None:
+            raise ValueError(f"Module {name} not found in database")
+
+        try:
+            module = self._import(name, py_file)
+        except Exception as e:
+            print(f"Error loading module {name}: {e}")
+            self._statuses[name] = "error"
+            raise e
+
+        # Instantiate the main class if convention exists, or just return module
+        # The user example has a class GigaChatAssistant.
+        # We might need a convention. For now, let's assume the module exposes a specific class or function?
+        # Or we just return the module object and let the script call what it needs.
+        # But the user said "Initialization... at first call".
+        # Let's assume the module has an `init()` function or we just return the module.
+
+        self.loaded_modules[name] = module
+        self._statuses[name] = "run"
+        print(f"Module {name} loaded successfully.")
+        return module
+
+    async def write_statuses(self):
+        """Store the statuses noted by load_module; call it with no session of the caller open."""
+        if not self._statuses:
+            return
+        statuses, self._statuses = self._statuses, {}
+        statements = [update(Module).where(Module.name == name).values(status=status)
+                      for name, status in statuses.items()]
+        try:
+            if self.writer is None:
+                async with self.db_session_factory() as db:
+                    for statement in statements:
+                        await db.execute(statement)
+                    await db.commit()
+            else:
+                await self.writer.run(lambda connection: [connection.execute(st) for st in statements])
+        except Exception as e:
+            print(f"Saving module statuses failed: {e}")
+
+    @staticmethod
+    def _import(name: str, file_path: str):
+        if not os.path.exists(file_path):
+            # Try relative to project root if not absolute
+            # Assuming MOD folder is in project root
+            file_path = os.path.abspath(file_path)
+            if not os.path.exists(file_path):
+                 raise FileNotFoundError(f"Module file not found: {file_path}")
+
+        spec = importlib.util.spec_from_file_location(name, file_path)
+        if spec is None:
+            raise ImportError(f"Could not load spec for module {name}")
+
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        return module
+
+    def preload(self, db: Session):
+        """
+        Import every module up front (sync, no event loop needed), so that
+        processes forked afterwards share it. Statuses are left as they are:
+        a module that fails here is loaded again on its first call.
+        """
+        for record in db.scalars(select(Module)):
+            try:
+                self.loaded_modules[record.name] = self._import(record.name, record.py_file)
+            except Exception as e:
+                print(f"Preloading module {record.name} failed: {e}")
+
+    async def get_module(self, name: str, db: AsyncSession):
+        if name in self.loaded_modules:
+            return self.loaded_modules[name]
+
+        lock = self._load_locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            if name in self.loaded_modules:
+                return self.loaded_modules[name]
+            return await self.load_module(name, db)
+
+    async def call(self, name: str, func_name: str, *args, db: AsyncSession):
+        """
+        Call a module function without blocking the event loop.
+
+        `async def` functions are awaited directly, plain functions run in
+        the shared thread pool. Either way at most `limits[name]` calls of
+        one module run at the same time (else the module's CONCURRENCY,
+        else default_limit). `db` is the caller's session,
+        used if the module still has to be loaded.
+        """
+        module = await self.get_module(name, db)
+        if not hasattr(module, func_name):
+            raise AttributeError(f"Module {name} has no function {func_name}")
+        func = getattr(module, func_name)
+
+        semaphore = self._semaphores.get(name)
+        if semaphore is None:
+            limit = self.limits.get(name, getattr(module, "CONCURRENCY", self.default_limit))
+            semaphore = self._semaphores[name] = asyncio.Semaphore(limit)
+
+        async with semaphore:
+            if inspect.iscoroutinefunction(func):
+                return await func(*args)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(func, *args))
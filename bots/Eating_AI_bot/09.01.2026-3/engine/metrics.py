@@ -0,0 +1,190 @@
+import os
+from bisect import bisect_left
+from typing import Dict, Tuple
+from aiohttp import web
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9101"))  # 0 = no metrics endpoint
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+# ───────────────────────────────
+# SQL statement counting
+# ───────────────────────────────
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info["statements"] = conn.info.get("statements", 0) + 1
+
+
+def statement_count(conn) -> int:
+    """Statements run so far on a (sync) Connection."""
+    return conn.info.get("statements", 0)
+
+
+# ───────────────────────────────
+# Histograms
+# ───────────────────────────────
+
+class Histogram:
+    """Fixed-bucket histogram, the same shape as a Prometheus one."""
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate like PromQL histogram_quantile(): linear inside the bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def cumulative(self):
+        total = 0
+        for le, n in zip(self.buckets + ("+Inf",), self.counts):
+            total += n
+            yield le, total
+
+
+class BlockMetrics:
+    """
+    Per block and event ("enter" / "message") histograms of block runs:
+    execution time, SQL statements, messages sent and time spent waiting
+    on modules. observe() is a few list increments, so it runs on every hop.
+    """
+
+    SERIES = {
+        # name: (help, buckets)
+        "exec_seconds": ("Block execution time", SECONDS_BUCKETS),
+        "sql_statements": ("SQL statements run while the block executed", COUNT_BUCKETS),
+        "messages": ("Messages sent by the block", COUNT_BUCKETS),
+        "module_seconds": ("Time the block waited on call_module / ModuleStart", SECONDS_BUCKETS),
+    }
+
+    def __init__(self):
+        self.blocks: Dict[Tuple[int, str], Dict[str, Histogram]] = {}
+
+    def observe(self, block_id: int, event: str, seconds: float, statements: int,
+                messages: int, module_seconds: float):
+        series = self._series(block_id, event)
+        series["exec_seconds"].observe(seconds)
+        series["sql_statements"].observe(statements)
+        series["messages"].observe(messages)
+        series["module_seconds"].observe(module_seconds)
+
+    def _series(self, block_id: int, event: str) -> Dict[str, Histogram]:
+        series = self.blocks.get((block_id, event))
+        if series is None:
+            series = {name: Histogram(buckets) for name, (_, buckets) in self.SERIES.items()}
+            self.blocks[(block_id, event)] = series
+        return series
+
+    def dump(self) -> list:
+        """Raw histograms as JSON-able lists, for merge() in another process."""
+        return [
+            [block_id, event, {name: [h.counts, h.sum, h.count] for name, h in series.items()}]
+            for (block_id, event), series in self.blocks.items()
+        ]
+
+    def merge(self, dump: list):
+        """Add the histograms of another BlockMetrics (see dump())."""
+        for block_id, event, raw in dump:
+            series = self._series(block_id, event)
+            for name, (counts, total, count) in raw.items():
+                histogram = series[name]
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.sum += total
+                histogram.count += count
+
+    def render(self, prefix: str = "chatbot_block_") -> str:
+        """Prometheus text exposition format."""
+        lines = []
+        for name, (help_text, _) in self.SERIES.items():
+            metric = prefix + name
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for (block_id, event), series in sorted(self.blocks.items()):
+                labels = f'block_id="{block_id}",event="{event}"'
+                histogram = series[name]
+                for le, total in histogram.cumulative():
+                    lines.append(f'{metric}_bucket{{{labels},le="{le}"}} {total}')
+                lines.append(f"{metric}_sum{{{labels}}} {histogram.sum:g}")
+                lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        """block_id -> short numbers per event, for the workflow editor overlay."""
+        result = {}
+        for (block_id, event), series in self.blocks.items():
+            runs = series["exec_seconds"].count
+            result.setdefault(str(block_id), {})[event] = {
+                "runs": runs,
+                "p50_ms": round(series["exec_seconds"].quantile(0.5) * 1000, 2),
+                "p95_ms": round(series["exec_seconds"].quantile(0.95) * 1000, 2),
+                "sql_avg": round(series["sql_statements"].sum / runs, 2),
+                "messages_avg": round(series["messages"].sum / runs, 2),
+                "module_ms_avg": round(series["module_seconds"].sum / runs * 1000, 2),
+            }
+        return result
+
+
+# ───────────────────────────────
+# HTTP endpoint (bot process)
+# ───────────────────────────────
+
+def render_engine_metrics(engine) -> str:
+    lines = [engine.block_metrics.render()]
+    lines.append("# HELP chatbot_budget_violations_total Blocks stopped by an execution budget")
+    lines.append("# TYPE chatbot_budget_violations_total counter")
+    for kind, n in sorted(engine.violations.by_kind.items()):
+        lines.append(f'chatbot_budget_violations_total{{kind="{kind}"}} {n}')
+    return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server(engine, host: str = METRICS_HOST, port: int = METRICS_PORT,
+                               render=render_engine_metrics) -> web.AppRunner:
+    """
+    Serve GET /metrics (Prometheus) and GET /metrics/blocks (JSON summary
+    used by the admin's /workflow overlay). Returns the runner to clean up.
+
+    `engine` is anything with block_metrics and violations: ChatbotEngine,
+    or the Supervisor, which sums them over its worker processes.
+    """
+
+    async def metrics(request):
+        return web.Response(text=render(engine),
+                            content_type="text/plain", charset="utf-8")
+
+    async def blocks(request):
+        return web.json_response(engine.block_metrics.summary())
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    app.router.add_get("/metrics/blocks", blocks)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Metrics on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,66 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+
+
+class ProfileCache:
+    """
+    Fingerprints of the last user_data synced for each user.
+
+    Connectors send the whole profile (names, language, premium flag...)
+    with every message, while it almost never changes. When the fingerprint
+    matches, the engine skips the profile sync for that message. Holds at
+    most `max_size` users, least recently seen are forgotten first.
+
+    Follows the generation of the engine's UserDirectory: when admin.py
+    or seed.py bump the 'users' version (a user deleted, params wiped) all
+    fingerprints are dropped and the next message of each user syncs again.
+    """
+
+    def __init__(self, max_size: int = PROFILE_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # (workflow_id, user_id, platform) -> fingerprint
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def follow(self, generation: int):
+        """Drop everything when the user directory moved to another generation."""
+        if generation != self.generation:
+            self._entries.clear()
+            self.generation = generation
+
+    @staticmethod
+    def fingerprint(profile: dict) -> str:
+        data = json.dumps(profile, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+    def matches(self, key: tuple, fingerprint: str) -> bool:
+        if self._entries.get(key) == fingerprint:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def remember(self, key: tuple, fingerprint: str, generation: int):
+        """
+        Store a fingerprint synced while the directory was at `generation`;
+        it is dropped if the directory was invalidated since.
+        """
+        if generation != self.generation:
+            return
+        self._entries[key] = fingerprint
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,98 @@
+import os
+import time
+from types import MappingProxyType
+from typing import Dict, NamedTuple, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from database.models import Block
+from database.versions import SCENARIO, get_version
+
+# How often (seconds) the engine checks whether admin.py edited the scenario
+SCENARIO_POLL_INTERVAL = float(os.getenv("SCENARIO_POLL_INTERVAL", "1.0"))
+
+
+class BlockSnapshot(NamedTuple):
+    id: int
+    name: str
+    script_code: str
+    is_start: bool
+    is_heavy: bool
+
+
+class ScenarioSnapshot:
+    """Immutable in-memory copy of the blocks of one workflow."""
+
+    __slots__ = ("version", "blocks", "start_block")
+
+    def __init__(self, version: int, blocks: dict):
+        self.version = version
+        self.blocks = MappingProxyType(blocks)
+        self.start_block = next((b for b in blocks.values() if b.is_start), None)
+
+    def get(self, block_id: int) -> Optional[BlockSnapshot]:
+        return self.blocks.get(block_id)
+
+
+class ScenarioCache:
+    """
+    Holds a ScenarioSnapshot per workflow and swaps all of them for fresh
+    ones when the 'scenario' version counter changes.
+
+    The counter is read at most once per poll interval, so block lookups
+    during the go_to loop never touch the database. A block is only
+    visible to the workflow it belongs to.
+    """
+
+    def __init__(self, code_cache=None, poll_interval: float = SCENARIO_POLL_INTERVAL):
+        self.code_cache = code_cache
+        self.poll_interval = poll_interval
+        self.version = None
+        self.snapshots: Dict[int, ScenarioSnapshot] = {}  # workflow_id -> snapshot
+        self._checked_at = 0.0
+        self.reloads = 0
+
+    async def current(self, db: AsyncSession, workflow_id: int = 0) -> ScenarioSnapshot:
+        now = time.monotonic()
+        if self.version is None or now - self._checked_at >= self.poll_interval:
+            self._checked_at = now
+            version = await db.run_sync(get_version, SCENARIO)
+            if version != self.version:
+                await db.run_sync(self.load, version)
+
+        snapshot = self.snapshots.get(workflow_id)
+        if snapshot is None:
+            # Workflow without blocks (yet)
+            snapshot = ScenarioSnapshot(self.version, {})
+        return snapshot
+
+    def load(self, db: Session, version: int):
+        by_workflow = {}
+        for b in db.query(Block).all():
+            by_workflow.setdefault(b.workflow_id or 0, {})[b.id] = BlockSnapshot(
+                b.id, b.name, b.script_code, bool(b.is_start), bool(b.is_heavy)
+            )
+        old = self.snapshots
+
+        # Single reference assignment: readers see either the old or the new snapshots
+        self.snapshots = {
+            workflow_id: ScenarioSnapshot(version, blocks) for workflow_id, blocks in by_workflow.items()
+        }
+        self.version = version
+        self.reloads += 1
+
+        if self.code_cache is not None:
+            fresh = {}
+            for snapshot in self.snapshots.values():
+                fresh.update(snapshot.blocks)
+            for snapshot in old.values():
+                for block_id, block in snapshot.blocks.items():
+                    if block_id not in fresh or fresh[block_id].script_code != block.script_code:
+                        self.code_cache.invalidate(block_id)
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "workflows": len(self.snapshots),
+            "blocks": sum(len(s.blocks) for s in self.snapshots.values()),
+            "reloads": self.reloads,
+        }
@@ -0,0 +1,148 @@
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.models import UserDocument, UserParam, UserSession
+from database.params import (PARAM_STORAGE, PARAM_STORAGES, decode_document,
+                             upsert_document, upsert_params, upsert_session)
+
+
+class SessionState:
+    """Where the user is in the scenario: a detached copy of their UserSession row."""
+    __slots__ = ("current_block_id", "updated_at")
+
+    def __init__(self, current_block_id: Optional[int], updated_at: Optional[datetime] = None):
+        self.current_block_id = current_block_id
+        self.updated_at = updated_at
+
+
+class UserState:
+    """
+    Session and params of one user, loaded once per inbound message.
+
+    All reads during the message are served from memory. Writes only mark
+    keys dirty; write_back() stores all of them with a single upsert right
+    before the engine commits: the dirty UserParam rows, or the whole
+    UserDocument when `storage` is "document", plus the session when the
+    user moved. The state holds no ORM objects, so a StateStore can keep
+    it between messages (see engine.store).
+    """
+
+    def __init__(self, user_id: str, platform: str, session: Optional[SessionState] = None,
+                 values: Optional[Dict[str, str]] = None, storage: str = PARAM_STORAGE,
+                 workflow_id: int = 0):
+        if storage not in PARAM_STORAGES:
+            raise ValueError(f"Unknown param storage: {storage}")
+
+        self.user_id = user_id
+        self.platform = platform
+        self.workflow_id = workflow_id
+        self.storage = storage
+        self.session = session
+        self.stored = dict(values or {})  # key -> value as in the database
+        self.values = dict(self.stored)
+        self.dirty = set()
+        self.session_dirty = False
+
+    @property
+    def key(self) -> tuple:
+        return self.workflow_id, self.user_id, self.platform
+
+    @classmethod
+    async def load(cls, db: AsyncSession, user_id: str, platform: str,
+                   storage: str = PARAM_STORAGE, workflow_id: int = 0) -> "UserState":
+        row = (await db.execute(select(UserSession.current_block_id, UserSession.updated_at).filter_by(
+            workflow_id=workflow_id,
+            user_id=user_id,
+            platform=platform
+        ))).first()
+        session = SessionState(*row) if row else None
+
+        if storage == "document":
+            data = await db.scalar(select(UserDocument.data).filter_by(
+                workflow_id=workflow_id,
+                user_id=user_id,
+                platform=platform
+            ))
+            values = decode_document(data)
+        else:
+            params = await db.execute(select(UserParam.key, UserParam.value).filter_by(
+                workflow_id=workflow_id,
+                user_id=user_id,
+                platform=platform
+            ))
+            values = dict(params.all())
+
+        return cls(user_id, platform, session, values, storage, workflow_id)
+
+    # ───────────────────────────────
+    # Params
+    # ───────────────────────────────
+
+    def get(self, key: str) -> Optional[str]:
+        return self.values.get(key)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Optional[str]]:
+        return {key: self.values.get(key) for key in keys}
+
+    def set(self, key: str, value: str):
+        self.values[key] = value
+        if key in self.stored and self.stored[key] == value:
+            self.dirty.discard(key)
+        else:
+            self.dirty.add(key)
+
+    # ───────────────────────────────
+    # Session
+    # ───────────────────────────────
+
+    def start(self, block_id: int) -> SessionState:
+        """Create the session of a new user at `block_id`."""
+        self.session = SessionState(block_id)
+        self.move_to(block_id)
+        return self.session
+
+    def move_to(self, block_id: int):
+        self.session.current_block_id = block_id
+        self.session.updated_at = datetime.utcnow()
+        self.session_dirty = True
+
+    # ───────────────────────────────
+    # Write-back
+    # ───────────────────────────────
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.dirty) or self.session_dirty
+
+    def statements(self, dialect: str) -> list:
+        """
+        The upserts storing the dirty params and the session, for the
+        engine to run in its transaction; the state counts as saved.
+        """
+        statements = []
+        if self.dirty:
+            changed = {key: self.values[key] for key in self.dirty}
+            if self.storage == "document":
+                statements.append(upsert_document(dialect, self.user_id, self.platform, self.values,
+                                                  self.workflow_id))
+            else:
+                statements.append(upsert_params(dialect, self.user_id, self.platform, changed,
+                                                 self.workflow_id))
+        if self.session_dirty:
+            statements.append(upsert_session(dialect, self.user_id, self.platform,
+                                             self.session.current_block_id, self.session.updated_at,
+                                             self.workflow_id))
+        self.mark_saved()
+        return statements
+
+    async def write_back(self, db: AsyncSession):
+        """Upsert the dirty params and the session inside `db`'s transaction (no commit)."""
+        for statement in self.statements(db.get_bind().dialect.name):
+            await db.execute(statement)
+
+    def mark_saved(self):
+        """Everything in memory is now what the store holds."""
+        self.stored = dict(self.values)
+        self.dirty.clear()
+        self.session_dirty = False
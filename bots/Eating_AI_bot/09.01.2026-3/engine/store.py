@@ -0,0 +1,458 @@
+import asyncio
+import mmap
+import os
+import struct
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.params import PARAM_STORAGE, decode_document, encode_document
+from database.versions import STATE, get_version
+from .state import SessionState, UserState
+
+try:
+    import fcntl  # Unix only
+except ImportError:
+    fcntl = None
+
+# Where sessions and params live between messages:
+#   sql - user_sessions and user_params/user_documents (default)
+#   kv  - one append-only file on local disk, single process only
+STATE_STORE = os.getenv("STATE_STORE", "sql")
+STATE_STORES = ("sql", "kv")
+
+# In-memory LRU tier in front of the store, in users; 0 - no tier
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "0"))
+# Seconds a cached user is trusted before being re-read; 0 - until evicted
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", "0"))
+# How often (seconds) the tier checks whether admin.py changed a session
+STATE_POLL_INTERVAL = float(os.getenv("STATE_POLL_INTERVAL", "1.0"))
+
+STATE_KV_PATH = os.getenv("STATE_KV_PATH", "./state.kv")
+# When the kv file is fsync'ed:
+#   always   - after every message, before its replies are sent
+#   interval - at most every STATE_KV_SYNC_INTERVAL seconds
+#   none     - when the OS decides
+STATE_KV_SYNC = os.getenv("STATE_KV_SYNC", "interval")
+STATE_KV_SYNCS = ("always", "interval", "none")
+STATE_KV_SYNC_INTERVAL = float(os.getenv("STATE_KV_SYNC_INTERVAL", "1.0"))
+# Rewrite the file once this share of it is overwritten records
+STATE_KV_COMPACT_RATIO = float(os.getenv("STATE_KV_COMPACT_RATIO", "0.5"))
+STATE_KV_COMPACT_MIN = 1024 * 1024  # bytes; smaller files are never rewritten
+
+
+class StateStore(ABC):
+    """
+    Loads and saves UserState for the engine, one user and one message at a time.
+
+    For every message the engine calls load() and, once the blocks ran,
+    save(), which may add statements to `writes`, the staged writes the
+    engine runs in its transaction; then committed() after the commit or
+    discard() after a rollback. Messages of one user never overlap (see
+    MessageDispatcher and Supervisor), so per-user bookkeeping between
+    save() and committed() needs no locking.
+    """
+
+    async def refresh(self):
+        """Called before every message; lets a cache notice outside changes."""
+
+    @abstractmethod
+    async def load(self, db: AsyncSession, workflow_id: int, user_id: str, platform: str) -> UserState:
+        pass
+
+    @abstractmethod
+    async def save(self, db: AsyncSession, state: UserState, writes: list):
+        pass
+
+    async def committed(self, key: tuple):
+        """The engine's transaction for the user `key` was committed."""
+
+    def discard(self, key: tuple):
+        """The engine's transaction for the user `key` was rolled back."""
+
+    def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+
+# ───────────────────────────────
+# SQL
+# ───────────────────────────────
+
+class SqlStateStore(StateStore):
+    """
+    user_sessions plus user_params (or user_documents, see PARAM_STORAGE),
+    read with two SELECTs and written in the engine's own transaction:
+    durable exactly when the engine's commit is.
+    """
+
+    def __init__(self, storage: str = PARAM_STORAGE):
+        self.storage = storage
+
+    async def load(self, db, workflow_id, user_id, platform):
+        return await UserState.load(db, user_id, platform, self.storage, workflow_id)
+
+    async def save(self, db, state, writes):
+        writes.extend(state.statements(db.get_bind().dialect.name))
+
+
+# ───────────────────────────────
+# LRU tier
+# ───────────────────────────────
+
+class _Cached:
+    __slots__ = ("block_id", "updated_at", "values", "storage", "loaded_at")
+
+    def __init__(self, state: UserState):
+        session = state.session
+        self.block_id = session.current_block_id if session else None
+        self.updated_at = session.updated_at if session else None
+        self.values = dict(state.values)
+        self.storage = state.storage
+        self.loaded_at = time.monotonic()
+
+    def state(self, workflow_id: int, user_id: str, platform: str) -> UserState:
+        session = SessionState(self.block_id, self.updated_at) if self.block_id is not None else None
+        return UserState(user_id, platform, session, self.values, self.storage, workflow_id)
+
+
+class CachedStateStore(StateStore):
+    """
+    Write-through LRU tier in front of another store.
+
+    A cached user is loaded without touching the backend. Writes still go
+    to the backend inside the engine's transaction, so durability is the
+    backend's; the cached copy is only replaced after the commit and is
+    dropped on a rollback.
+
+    The copy is only right while this process is the one handling the
+    user: one bot process, or ENGINE_WORKERS (every user stays in one
+    worker). Several bot instances behind a webhook balancer must not use
+    it. admin.py bumps the 'state' version counter when it moves a user;
+    the counter is read at most once per poll interval and the whole tier
+    is dropped when it moves. `ttl` bounds how long any other outside
+    change can go unnoticed.
+    """
+
+    def __init__(self, backend: StateStore, db_session_factory, max_size: int = STATE_CACHE_SIZE,
+                 ttl: float = STATE_CACHE_TTL, poll_interval: float = STATE_POLL_INTERVAL):
+        self.backend = backend
+        self.db_session_factory = db_session_factory  # async_sessionmaker
+        self.max_size = max_size
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.version = None
+        self.generation = 0  # bumped on every invalidation
+        self._entries = OrderedDict()  # (workflow_id, user_id, platform) -> _Cached
+        self._pending = {}  # key -> (_Cached, generation) saved but not yet committed
+        self._checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def refresh(self):
+        await self.backend.refresh()
+        now = time.monotonic()
+        if now - self._checked_at < self.poll_interval:
+            return
+        self._checked_at = now
+
+        async with self.db_session_factory() as db:
+            version = await db.run_sync(get_version, STATE)
+        if version != self.version:
+            self.version = version
+            self.invalidate()
+
+    async def load(self, db, workflow_id, user_id, platform):
+        key = (workflow_id, user_id, platform)
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl and time.monotonic() - entry.loaded_at > self.ttl:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return await self.backend.load(db, workflow_id, user_id, platform)
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.state(workflow_id, user_id, platform)
+
+    async def save(self, db, state, writes):
+        await self.backend.save(db, state, writes)
+        self._pending[state.key] = (_Cached(state), self.generation)
+
+    async def committed(self, key):
+        await self.backend.committed(key)
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        entry, generation = pending
+        if generation != self.generation:
+            # Invalidated meanwhile: the state may be built on a stale copy
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            entry.loaded_at = previous.loaded_at  # the TTL counts from the backend read
+        self._entries[key] = entry
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, key):
+        self.backend.discard(key)
+        self._pending.pop(key, None)
+        self._entries.pop(key, None)
+
+    def invalidate(self, key: tuple = None):
+        """Drop one user (or everything when key is None)."""
+        if key is None:
+            self._entries.clear()
+            self.generation += 1
+        else:
+            self._entries.pop(key, None)
+
+    def close(self):
+        self.backend.close()
+
+    def stats(self) -> dict:
+        return {
+            **self.backend.stats(),
+            "cache_size": len(self._entries),
+            "cache_hits": self.hits,
+            "cache_misses": self.misses,
+            "cache_evictions": self.evictions,
+        }
+
+
+# ───────────────────────────────
+# Embedded key-value file
+# ───────────────────────────────
+
+# crc32 of key + value, key length, value length
+_HEADER = struct.Struct("<IHI")
+
+
+class KvStateStore(StateStore):
+    """
+    Sessions and params in one append-only file on local disk, for a
+    single bot process on a single node; the SQL tables are not used.
+
+    Every saved user is appended as one record (a header, the key and the
+    encoded state); an in-memory index points at the latest record of each
+    user, which is read through a memory map. A record torn by a crash is
+    cut off when the file is opened. Once overwritten records take more
+    than `compact_ratio` of the file it is rewritten with live records
+    only. An exclusive lock keeps a second process off the file.
+
+    Records are appended after the engine's commit, so a crash between
+    the two loses that one message's state change. `sync` is the rest of
+    the durability trade-off, see STATE_KV_SYNC.
+    """
+
+    def __init__(self, path: str = STATE_KV_PATH, sync: str = STATE_KV_SYNC,
+                 sync_interval: float = STATE_KV_SYNC_INTERVAL,
+                 compact_ratio: float = STATE_KV_COMPACT_RATIO, storage: str = PARAM_STORAGE):
+        if sync not in STATE_KV_SYNCS:
+            raise ValueError(f"Unknown STATE_KV_SYNC: {sync}")
+        self.path = path
+        self.sync = sync
+        self.sync_interval = sync_interval
+        self.compact_ratio = compact_ratio
+        self.storage = storage  # only passed on to UserState
+
+        self._index = {}  # key bytes -> (value offset, value length)
+        self._pending = {}  # (workflow_id, user_id, platform) -> record bytes
+        self._map = None
+        self._compacting = asyncio.Lock()  # appends wait while compact() rewrites the file
+        self._synced_at = time.monotonic()
+        self.live = 0  # bytes of the latest records
+        self.syncs = 0
+        self.compactions = 0
+
+        self._fd = self._open(path)
+        self.size = os.fstat(self._fd).st_size
+        self._scan()
+
+    @staticmethod
+    def _open(path: str) -> int:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        if fcntl is None:
+            return fd
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise RuntimeError(f"{path} is used by another bot process")
+        return fd
+
+    def _scan(self):
+        offset = 0
+        data = self._view()
+        while offset + _HEADER.size <= self.size:
+            crc, key_len, value_len = _HEADER.unpack_from(data, offset)
+            end = offset + _HEADER.size + key_len + value_len
+            if end > self.size or zlib.crc32(data[offset + _HEADER.size:end]) != crc:
+                break
+            self._put(bytes(data[offset + _HEADER.size:offset + _HEADER.size + key_len]),
+                      end - value_len, value_len, end - offset)
+            offset = end
+        if offset < self.size:
+            print(f"State store {self.path}: dropped {self.size - offset} bytes of a torn record")
+            os.ftruncate(self._fd, offset)
+            self.size = offset
+            self._map = None
+
+    def _view(self):
+        """Memory map covering the whole file (remapped when it grew)."""
+        if not self.size:
+            return b""
+        if self._map is None or len(self._map) < self.size:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _put(self, key: bytes, value_offset: int, value_len: int, record_len: int):
+        previous = self._index.get(key)
+        if previous is not None:
+            self.live -= _HEADER.size + len(key) + previous[1]
+        self._index[key] = (value_offset, value_len)
+        self.live += record_len
+
+    @staticmethod
+    def _key(workflow_id: int, user_id: str, platform: str) -> bytes:
+        return f"{workflow_id}\x1f{user_id}\x1f{platform}".encode("utf-8")
+
+    def keys(self):
+        """(workflow_id, user_id, platform) of every stored user."""
+        for key in list(self._index):
+            workflow_id, user_id, platform = key.decode("utf-8").split("\x1f")
+            yield int(workflow_id), user_id, platform
+
+    # ───────────────────────────────
+    # StateStore
+    # ───────────────────────────────
+
+    async def load(self, db, workflow_id, user_id, platform):
+        found = self._index.get(self._key(workflow_id, user_id, platform))
+        session, values = None, {}
+        if found is not None:
+            offset, length = found
+            record = decode_document(self._view()[offset:offset + length])
+            if record["b"] is not None:
+                session = SessionState(record["b"], datetime.fromisoformat(record["u"]))
+            values = record["p"]
+        return UserState(user_id, platform, session, values, self.storage, workflow_id)
+
+    async def save(self, db, state, writes):
+        if not state.changed:
+            return
+        session = state.session
+        value = encode_document({
+            "b": session.current_block_id if session else None,
+            "u": session.updated_at.isoformat() if session else None,
+            "p": state.values,
+        })
+        key = self._key(*state.key)
+        self._pending[state.key] = _HEADER.pack(zlib.crc32(key + value), len(key), len(value)) + key + value
+        state.mark_saved()
+
+    async def committed(self, key):
+        record = self._pending.pop(key, None)
+        if record is None:
+            return
+        async with self._compacting:
+            os.write(self._fd, record)
+            key_len = _HEADER.unpack_from(record)[1]
+            self._put(record[_HEADER.size:_HEADER.size + key_len],
+                      self.size + _HEADER.size + key_len, len(record) - _HEADER.size - key_len, len(record))
+            self.size += len(record)
+
+        if self.sync == "always" or (
+            self.sync == "interval" and time.monotonic() - self._synced_at >= self.sync_interval
+        ):
+            self._synced_at = time.monotonic()
+            # compact() may close self._fd meanwhile; it fsyncs the new file itself
+            fd = os.dup(self._fd)
+            try:
+                await asyncio.to_thread(os.fsync, fd)
+            finally:
+                os.close(fd)
+            self.syncs += 1
+
+        if (not self._compacting.locked() and self.size >= STATE_KV_COMPACT_MIN
+                and self.live < self.size * (1 - self.compact_ratio)):
+            await self.compact()
+
+    def discard(self, key):
+        self._pending.pop(key, None)
+
+    async def compact(self):
+        """
+        Rewrite the file with the latest record of every user. The copy runs
+        in a thread; appends wait for it, loads keep reading the old file.
+        """
+        async with self._compacting:
+            fd, index, size = await asyncio.to_thread(self._rewrite, self._view(), list(self._index.items()))
+            if self._map is not None:
+                self._map.close()
+            self._map = None
+            os.close(self._fd)
+            self._fd = fd
+            self._index = index
+            self.size = self.live = size
+            self.compactions += 1
+
+    def _rewrite(self, data, records: list) -> tuple:
+        """Write `records` to a new file and move it over the old one."""
+        tmp_path = self.path + ".tmp"
+        fd = self._open(tmp_path)
+        os.ftruncate(fd, 0)
+        index, offset, chunk = {}, 0, []
+        for key, (value_offset, value_len) in records:
+            value = data[value_offset:value_offset + value_len]
+            chunk.append(_HEADER.pack(zlib.crc32(key + value), len(key), value_len) + key + value)
+            index[key] = (offset + _HEADER.size + len(key), value_len)
+            offset += _HEADER.size + len(key) + value_len
+            if len(chunk) >= 1000:
+                os.write(fd, b"".join(chunk))
+                chunk = []
+        os.write(fd, b"".join(chunk))
+        os.fsync(fd)
+        os.replace(tmp_path, self.path)
+        return fd, index, offset
+
+    def close(self):
+        if self._fd is None:
+            return
+        os.fsync(self._fd)
+        if self._map is not None:
+            self._map.close()
+        os.close(self._fd)
+        self._fd = None
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._index),
+            "file_bytes": self.size,
+            "live_bytes": self.live,
+            "syncs": self.syncs,
+            "compactions": self.compactions,
+        }
+
+
+def make_state_store(db_session_factory, store: str = STATE_STORE, cache_size: int = STATE_CACHE_SIZE,
+                     kv_path: str = STATE_KV_PATH) -> StateStore:
+    """The store configured in .env: STATE_STORE, with the LRU tier when STATE_CACHE_SIZE > 0."""
+    if store == "sql":
+        backend = SqlStateStore()
+    elif store == "kv":
+        backend = KvStateStore(kv_path)
+    else:
+        raise ValueError(f"Unknown state store: {store}")
+    if cache_size > 0:
+        return CachedStateStore(backend, db_session_factory, cache_size)
+    return backend
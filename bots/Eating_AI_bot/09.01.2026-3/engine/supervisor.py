@@ -0,0 +1,468 @@
+import asyncio
+import gc
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import zlib
+from collections import deque
+from typing import List, Optional
+from connectors.base import BotProvider
+from database.base import SessionLocal, async_engine, engine as sync_engine
+from database.versions import SCENARIO, get_version
+from .budget import BudgetViolations
+from .dispatcher import MessageDispatcher
+from .metrics import BlockMetrics
+
+# Engine worker processes; 1 = the engine runs inside main.py as before
+ENGINE_WORKERS = int(os.getenv("ENGINE_WORKERS", "1"))
+WORKER_PING_INTERVAL = float(os.getenv("WORKER_PING_INTERVAL", "5"))
+WORKER_PING_TIMEOUT = float(os.getenv("WORKER_PING_TIMEOUT", "30"))  # no answer -> killed and restarted
+WORKER_DRAIN_TIMEOUT = float(os.getenv("WORKER_DRAIN_TIMEOUT", "30"))  # on shutdown, then killed
+WORKER_RESTART_DELAY = float(os.getenv("WORKER_RESTART_DELAY", "1"))
+WORKER_BACKLOG = int(os.getenv("WORKER_BACKLOG", "10000"))  # messages kept for a worker being restarted
+
+# Longest line on a supervisor <-> worker channel (metrics dumps are the big ones)
+CHANNEL_LIMIT = 16 * 1024 * 1024
+
+
+def shard_of(platform: str, user_id: str, shards: int) -> int:
+    """Worker of a user: stable across restarts and processes, unlike hash()."""
+    return zlib.crc32(f"{platform}:{user_id}".encode("utf-8")) % shards
+
+
+def _write(writer: asyncio.StreamWriter, record: dict):
+    writer.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+
+
+def preload(chatbot_engine):
+    """
+    Load the scenario, compile every block and import the modules in the
+    supervisor, before the workers are forked: they start warm and share
+    these pages copy-on-write.
+    """
+    with SessionLocal() as db:
+        chatbot_engine.scenario_cache.load(db, get_version(db, SCENARIO))
+        chatbot_engine.module_manager.preload(db)
+    for snapshot in chatbot_engine.scenario_cache.snapshots.values():
+        for block in snapshot.blocks.values():
+            try:
+                chatbot_engine.code_cache.get(block.id, block.script_code)
+            except SyntaxError as e:
+                print(f"Block {block.id} does not compile: {e}")
+    # Keep the collector from touching (and so copying) the preloaded objects
+    gc.freeze()
+
+
+# ───────────────────────────────
+# Worker side
+# ───────────────────────────────
+
+class WorkerOutbox(BotProvider):
+    """Connector of a worker process: replies go back to the supervisor, which sends them."""
+
+    def __init__(self, writer: asyncio.StreamWriter, workflow_id: int):
+        super().__init__()
+        self.writer = writer
+        self.workflow_id = workflow_id
+
+    async def listen(self):
+        pass
+
+    async def send_message(
+        self,
+        user_id: str,
+        text: str,
+        buttons: Optional[List[str]] = None,
+        parse_mode: str = "text",
+        request_contact: bool = False
+    ):
+        _write(self.writer, {
+            "type": "send",
+            "workflow_id": self.workflow_id,
+            "message": {
+                "user_id": user_id,
+                "text": text,
+                "buttons": buttons,
+                "parse_mode": parse_mode,
+                "request_contact": request_contact,
+            },
+        })
+        await self.writer.drain()
+
+
+def _worker_main(index: int, sock: socket.socket, chatbot_engine, inherited: list):
+    # Channels of the other workers stay with the supervisor, or their EOF never comes
+    for other in inherited:
+        other.close()
+    # Ctrl+C reaches the whole process group; the supervisor drains the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.set_wakeup_fd(-1)
+    # Connections of the supervisor's pools must not be used from here
+    sync_engine.dispose(close=False)
+    async_engine.sync_engine.dispose(close=False)
+
+    asyncio.run(_serve(index, sock, chatbot_engine))
+
+
+async def _serve(index: int, sock: socket.socket, chatbot_engine):
+    reader, writer = await asyncio.open_connection(sock=sock, limit=CHANNEL_LIMIT)
+    chatbot_engine.connector = WorkerOutbox(writer, 0)
+    dispatcher = MessageDispatcher(chatbot_engine.process_message)
+    await dispatcher.start()
+
+    # SIGTERM (e.g. systemd stopping the whole group) drains like the supervisor does
+    stopping = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+
+    async def read():
+        while True:
+            line = await reader.readline()
+            if not line:
+                return  # supervisor gone
+            record = json.loads(line)
+            kind = record["type"]
+            if kind == "message":
+                workflow_id = record["workflow_id"]
+                if workflow_id and workflow_id not in chatbot_engine.connectors:
+                    chatbot_engine.connectors[workflow_id] = WorkerOutbox(writer, workflow_id)
+                await dispatcher.submit(record["user_id"], record["platform"], record["text"],
+                                        record["user_data"], workflow_id=workflow_id)
+            elif kind == "ping":
+                _write(writer, {
+                    "type": "pong",
+                    "pid": os.getpid(),
+                    "dispatcher": dispatcher.stats(),
+                    "metrics": chatbot_engine.block_metrics.dump(),
+                    "violations": chatbot_engine.violations.stats(),
+                })
+            elif kind == "drain":
+                return
+
+    reading = asyncio.create_task(read())
+    waiting = asyncio.create_task(stopping.wait())
+    await asyncio.wait({reading, waiting}, return_when=asyncio.FIRST_COMPLETED)
+    reading.cancel()
+    waiting.cancel()
+
+    # Everything already queued is processed and replied to before "drained"
+    await dispatcher.close()
+    await chatbot_engine.close()
+    # aiosqlite connections hold non-daemon threads, which would keep the process alive
+    await async_engine.dispose()
+    try:
+        _write(writer, {"type": "drained", "worker": index, "dispatcher": dispatcher.stats()})
+        await writer.drain()
+        writer.close()
+    except (ConnectionError, RuntimeError):
+        pass
+
+
+# ───────────────────────────────
+# Supervisor side
+# ───────────────────────────────
+
+class _Worker:
+    __slots__ = ("index", "process", "sock", "writer", "task", "last_pong", "pid", "dispatcher",
+                 "metrics", "violations", "backlog", "routed", "restarts", "restarting", "drained")
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.sock = None  # supervisor's end of the socketpair
+        self.writer = None
+        self.task = None
+        self.last_pong = 0.0
+        self.pid = None
+        self.dispatcher = {}  # MessageDispatcher.stats() of the last pong
+        self.metrics = []  # BlockMetrics.dump() of the last pong
+        self.violations = {}
+        self.backlog = deque()  # messages that arrived while the worker was down
+        self.routed = 0
+        self.restarts = 0
+        self.restarting = False
+        self.drained = False
+
+
+class Supervisor:
+    """
+    Runs ChatbotEngine in `workers` forked processes and routes messages
+    to them by shard_of(platform, user_id), so every user always lands on
+    the same worker: their messages stay ordered and the per-process
+    caches stay valid.
+
+    Takes the dispatcher's place between connectors and the engine: the
+    connectors (and WorkflowRunner) call submit(), the worker sends the
+    replies back and the supervisor delivers them through the connector
+    of the workflow, so outbound rate limits stay process-wide. Workers
+    talk JSON lines over a socketpair.
+
+    Workers are pinged every `ping_interval` seconds; the answer carries
+    their dispatcher stats and block metrics, summed for /metrics. A
+    worker that exits or does not answer for `ping_timeout` seconds is
+    killed and forked again; messages for it are held meanwhile. close()
+    lets every worker finish its queue first.
+    """
+
+    def __init__(self, chatbot_engine, connector=None, workers: int = ENGINE_WORKERS,
+                 ping_interval: float = WORKER_PING_INTERVAL, ping_timeout: float = WORKER_PING_TIMEOUT,
+                 drain_timeout: float = WORKER_DRAIN_TIMEOUT, restart_delay: float = WORKER_RESTART_DELAY,
+                 backlog: int = WORKER_BACKLOG):
+        self.engine = chatbot_engine  # preloaded, only ever used in the workers
+        self.connector = connector  # of workflow 0, the TG_TOKEN bot
+        self.connectors = {}  # workflow_id -> connector, kept by WorkflowRunner
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.drain_timeout = drain_timeout
+        self.restart_delay = restart_delay
+        self.max_backlog = backlog
+
+        self.workers = [_Worker(n) for n in range(workers)]
+        self._context = multiprocessing.get_context("fork")
+        self._health = None
+        self._closing = False
+
+        # Counters of workers that were restarted, so the totals never go down
+        self._retired_metrics = BlockMetrics()
+        self._retired_violations = BudgetViolations()
+
+        # Metrics
+        self.dropped = 0
+
+    # ───────────────────────────────
+    # Lifecycle
+    # ───────────────────────────────
+
+    async def start(self):
+        for worker in self.workers:
+            await self._spawn(worker)
+        self._health = asyncio.create_task(self._check_health(), name="supervisor-health")
+
+    async def close(self):
+        """Let every worker process its queue and exit; kill the ones that take too long."""
+        self._closing = True
+        if self._health:
+            self._health.cancel()
+            await asyncio.gather(self._health, return_exceptions=True)
+
+        for worker in self.workers:
+            if worker.writer and not worker.writer.is_closing():
+                try:
+                    _write(worker.writer, {"type": "drain"})
+                    await worker.writer.drain()
+                except ConnectionError:
+                    pass
+
+        # The replies of the drained messages arrive before the EOF
+        deadline = time.monotonic() + self.drain_timeout
+        reading = [w.task for w in self.workers if w.task]
+        if reading:
+            await asyncio.wait(reading, timeout=self.drain_timeout)
+        for worker in self.workers:
+            await asyncio.to_thread(worker.process.join, max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                print(f"Engine worker {worker.index} did not drain in {self.drain_timeout:.0f}s, killing it")
+                worker.process.kill()
+                await asyncio.to_thread(worker.process.join)
+            if worker.task:
+                worker.task.cancel()
+            if worker.backlog:
+                print(f"Worker {worker.index}: {len(worker.backlog)} held messages were not processed")
+
+    async def _spawn(self, worker: _Worker):
+        parent, child = socket.socketpair()
+        inherited = [parent] + [w.sock for w in self.workers if w is not worker and w.sock]
+        worker.process = self._context.Process(
+            target=_worker_main, args=(worker.index, child, self.engine, inherited),
+            name=f"engine-worker-{worker.index}"
+        )
+        worker.process.start()
+        child.close()
+
+        reader, writer = await asyncio.open_connection(sock=parent, limit=CHANNEL_LIMIT)
+        worker.sock = parent
+        worker.writer = writer
+        worker.pid = worker.process.pid
+        worker.last_pong = time.monotonic()
+        worker.drained = False
+        worker.task = asyncio.create_task(self._read(worker, reader), name=f"supervisor-worker-{worker.index}")
+        print(f"Engine worker {worker.index} started (pid {worker.pid})")
+
+        while worker.backlog:
+            _write(writer, worker.backlog.popleft())
+        await writer.drain()
+
+    async def _restart(self, worker: _Worker, reason: str):
+        if worker.restarting or self._closing:
+            return
+        worker.restarting = True
+        try:
+            pending = worker.dispatcher.get("pending", 0)
+            print(f"Engine worker {worker.index} (pid {worker.pid}) {reason}; "
+                  f"about {pending} queued messages were lost, restarting")
+            if worker.process.is_alive():
+                worker.process.kill()
+            await asyncio.to_thread(worker.process.join)
+            worker.writer.close()
+            worker.writer = None
+            worker.sock = None
+
+            self._retired_metrics.merge(worker.metrics)
+            self._add_violations(self._retired_violations, worker.violations)
+            worker.metrics, worker.violations, worker.dispatcher = [], {}, {}
+            worker.restarts += 1
+
+            await asyncio.sleep(self.restart_delay)
+            if not self._closing:
+                await self._spawn(worker)
+        finally:
+            worker.restarting = False
+
+    # ───────────────────────────────
+    # Routing
+    # ───────────────────────────────
+
+    async def submit(self, user_id: str, platform: str, text: str, user_data: dict = None,
+                     workflow_id: int = 0):
+        """Connector callback, same signature as MessageDispatcher.submit."""
+        worker = self.workers[shard_of(platform, user_id, len(self.workers))]
+        record = {
+            "type": "message",
+            "workflow_id": workflow_id,
+            "user_id": user_id,
+            "platform": platform,
+            "text": text,
+            "user_data": user_data,
+        }
+        worker.routed += 1
+
+        if worker.writer is not None and not worker.writer.is_closing():
+            try:
+                _write(worker.writer, record)
+                await worker.writer.drain()
+                return
+            except ConnectionError:
+                pass  # died just now: hold the message for the restarted worker
+
+        if len(worker.backlog) >= self.max_backlog:
+            self.dropped += 1
+            print(f"Dropped message from {user_id}: worker {worker.index} is down and its backlog is full")
+            return
+        worker.backlog.append(record)
+
+    def connector_for(self, workflow_id: int):
+        return self.connectors.get(workflow_id, self.connector if workflow_id == 0 else None)
+
+    async def _read(self, worker: _Worker, reader: asyncio.StreamReader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                record = json.loads(line)
+                kind = record["type"]
+                if kind == "send":
+                    connector = self.connector_for(record["workflow_id"])
+                    if connector is None:
+                        print(f"Dropped a message of stopped workflow {record['workflow_id']}")
+                        continue
+                    await connector.send_message(**record["message"])
+                elif kind == "pong":
+                    worker.last_pong = time.monotonic()
+                    worker.dispatcher = record["dispatcher"]
+                    worker.metrics = record["metrics"]
+                    worker.violations = record["violations"]
+                elif kind == "drained":
+                    worker.drained = True
+                    worker.dispatcher = record["dispatcher"]
+        except Exception as e:
+            print(f"Engine worker {worker.index}: channel failed: {e}")
+
+        if not self._closing:
+            asyncio.create_task(self._restart(worker, "exited"))
+
+    # ───────────────────────────────
+    # Health
+    # ───────────────────────────────
+
+    async def _check_health(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.restarting or worker.writer is None:
+                    continue
+                if now - worker.last_pong > self.ping_timeout:
+                    asyncio.create_task(self._restart(
+                        worker, f"did not answer for {now - worker.last_pong:.0f}s"
+                    ))
+                    continue
+                try:
+                    _write(worker.writer, {"type": "ping"})
+                    await worker.writer.drain()
+                except ConnectionError:
+                    pass  # _read sees the EOF and restarts it
+
+    # ───────────────────────────────
+    # Metrics
+    # ───────────────────────────────
+
+    @staticmethod
+    def _add_violations(total: BudgetViolations, stats: dict):
+        total.by_kind.update(stats.get("by_kind", {}))
+        total.by_block.update({int(k): v for k, v in stats.get("by_block", {}).items()})
+
+    @property
+    def block_metrics(self) -> BlockMetrics:
+        """Sum over the workers, as of their last pong."""
+        metrics = BlockMetrics()
+        metrics.merge(self._retired_metrics.dump())
+        for worker in self.workers:
+            metrics.merge(worker.metrics)
+        return metrics
+
+    @property
+    def violations(self) -> BudgetViolations:
+        violations = BudgetViolations()
+        self._add_violations(violations, self._retired_violations.stats())
+        for worker in self.workers:
+            self._add_violations(violations, worker.violations)
+        return violations
+
+    def render_workers(self) -> str:
+        series = [
+            ("chatbot_worker_up", "gauge", "1 if the engine worker process is running",
+             lambda w: int(bool(w.process and w.process.is_alive()))),
+            ("chatbot_worker_restarts_total", "counter", "Times the worker was forked again",
+             lambda w: w.restarts),
+            ("chatbot_worker_routed_total", "counter", "Messages routed to the worker",
+             lambda w: w.routed),
+            ("chatbot_worker_pending", "gauge", "Messages queued in the worker, as of the last ping",
+             lambda w: w.dispatcher.get("pending", 0) + len(w.backlog)),
+        ]
+        lines = []
+        for name, kind, help_text, value in series:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for worker in self.workers:
+                lines.append(f'{name}{{worker="{worker.index}"}} {value(worker)}')
+        return "\n".join(lines) + "\n"
+
+    def stats(self) -> dict:
+        return {
+            "workers": [
+                {
+                    "index": w.index,
+                    "pid": w.pid,
+                    "alive": bool(w.process and w.process.is_alive()),
+                    "restarts": w.restarts,
+                    "routed": w.routed,
+                    "backlog": len(w.backlog),
+                    "dispatcher": w.dispatcher,
+                }
+                for w in self.workers
+            ],
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import traceback
+from sqlalchemy import insert
+from database.models import Trace
+
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "200"))
+TRACE_FLUSH_MS = int(os.getenv("TRACE_FLUSH_MS", "500"))
+TRACE_MAX_PENDING = int(os.getenv("TRACE_MAX_PENDING", "20000"))
+TRACE_OVERFLOW = os.getenv("TRACE_OVERFLOW", "block")  # block | drop
+
+
+class TraceWriter:
+    """
+    Buffered writer for the write-only `trace` table.
+
+    Rows are kept in memory and bulk-inserted in one transaction every
+    `batch_size` rows or `flush_ms` milliseconds, whichever comes first.
+    At most `max_pending` rows are buffered; beyond that `write` either
+    waits for the next flush (overflow="block") or drops the row and
+    counts it (overflow="drop"). With a SqliteWriter the batches go
+    through its group commit instead of a session of their own.
+    """
+
+    def __init__(self, db_session_factory, batch_size: int = TRACE_BATCH_SIZE,
+                 flush_ms: int = TRACE_FLUSH_MS, max_pending: int = TRACE_MAX_PENDING,
+                 overflow: str = TRACE_OVERFLOW, writer=None):
+        if overflow not in ("block", "drop"):
+            raise ValueError(f"Unknown trace overflow policy: {overflow}")
+
+        self.db_session_factory = db_session_factory  # async_sessionmaker
+        self.writer = writer  # SqliteWriter or None
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self.max_pending = max_pending
+        self.overflow = overflow
+
+        self._buffer = []
+        self._wakeup = None
+        self._space = None
+        self._task = None
+        self._closing = False
+
+        # Metrics
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.errors = 0
+
+    # ───────────────────────────────
+    # Lifecycle
+    # ───────────────────────────────
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._space = asyncio.Event()
+            self._space.set()
+            self._task = asyncio.create_task(self._run(), name="trace-writer")
+
+    async def close(self):
+        """Flush everything still buffered and stop the background task."""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        self._closing = False
+
+    # ───────────────────────────────
+    # Intake
+    # ───────────────────────────────
+
+    async def write(self, row: dict):
+        """Buffer one trace row (dict of Trace column values)."""
+        self.start()
+
+        while len(self._buffer) >= self.max_pending:
+            if self.overflow == "drop":
+                self.dropped += 1
+                return
+            self._space.clear()
+            self._wakeup.set()
+            await self._space.wait()
+
+        self._buffer.append(row)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    # ───────────────────────────────
+    # Flushing
+    # ───────────────────────────────
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            while self._buffer:
+                await self.flush()
+                if len(self._buffer) < self.batch_size and not self._closing:
+                    break
+
+            if self._closing and not self._buffer:
+                return
+
+    async def flush(self):
+        rows = self._buffer[:self.batch_size]
+        del self._buffer[:len(rows)]
+        self._space.set()
+
+        try:
+            if self.writer:
+                await self.writer.run(lambda connection: connection.execute(insert(Trace), rows))
+            else:
+                async with self.db_session_factory() as db:
+                    await db.execute(insert(Trace), rows)
+                    await db.commit()
+            self.written += len(rows)
+            self.batches += 1
+        except Exception as e:
+            self.errors += 1
+            print(f"Error writing {len(rows)} trace rows: {e}")
+            traceback.print_exc()
+            if self._closing:
+                self.dropped += len(rows)
+                return
+            # Give the rows another chance with the next batch, within the memory cap
+            keep = rows[:max(self.max_pending - len(self._buffer), 0)]
+            self.dropped += len(rows) - len(keep)
+            self._buffer[:0] = keep
+            await asyncio.sleep(self.flush_interval)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._buffer),
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
@@ -0,0 +1,86 @@
+import os
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+from database.versions import USERS, get_version
+
+USER_DIRECTORY_SIZE = int(os.getenv("USER_DIRECTORY_SIZE", "10000"))
+# How often (seconds) the engine checks whether admin.py changed bot_users
+USER_DIRECTORY_POLL_INTERVAL = float(os.getenv("USER_DIRECTORY_POLL_INTERVAL", "1.0"))
+
+
+class UserEntry(NamedTuple):
+    id: int
+    username: Optional[str]
+    is_active: bool
+
+
+class UserDirectory:
+    """
+    LRU-bounded in-process copy of `bot_users` (id, username, is_active).
+
+    Lets the engine reject inactive users and skip the BotUser lookup
+    without touching the database. admin.py bumps the 'users' version
+    counter on every change to bot_users; the counter is read at most once
+    per poll interval and the whole directory is dropped when it moves.
+    """
+
+    def __init__(self, db_session_factory, max_size: int = USER_DIRECTORY_SIZE,
+                 poll_interval: float = USER_DIRECTORY_POLL_INTERVAL):
+        self.db_session_factory = db_session_factory  # async_sessionmaker
+        self.max_size = max_size
+        self.poll_interval = poll_interval
+        self.version = None
+        self.generation = 0  # bumped on every invalidation
+        self._entries = OrderedDict()  # (workflow_id, user_id, platform) -> UserEntry
+        self._checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    async def refresh(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.poll_interval:
+            return
+        self._checked_at = now
+
+        async with self.db_session_factory() as db:
+            version = await db.run_sync(get_version, USERS)
+        if version != self.version:
+            self.version = version
+            self.invalidate()
+
+    def get(self, key: tuple) -> Optional[UserEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: tuple, entry: UserEntry, generation: int):
+        """
+        Store an entry read while the directory was at `generation`; it is
+        dropped if the directory was invalidated since, as it may be stale.
+        """
+        if generation != self.generation:
+            return
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: tuple = None):
+        """Drop one user (or everything when key is None)."""
+        if key is None:
+            self._entries.clear()
+            self.generation += 1
+        else:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,201 @@
+import asyncio
+import functools
+import os
+import time
+from sqlalchemy import select
+from database.models import Workflow
+
+# How often (seconds) the runner re-reads the workflows table
+WORKFLOW_POLL_INTERVAL = float(os.getenv("WORKFLOW_POLL_INTERVAL", "5"))
+# First pause (seconds) before restarting a crashed connector, doubled on every crash
+WORKFLOW_RESTART_DELAY = float(os.getenv("WORKFLOW_RESTART_DELAY", "5"))
+WORKFLOW_RESTART_MAX_DELAY = float(os.getenv("WORKFLOW_RESTART_MAX_DELAY", "300"))
+
+
+def telegram_connector(token: str):
+    from connectors.telegram import TelegramBotProvider
+    # Many dispatchers share one loop: signals are handled by main.py
+    return TelegramBotProvider(token, handle_signals=False)
+
+
+class _Running:
+    __slots__ = ("token", "connector", "task", "started_at")
+
+    def __init__(self, token, connector, task):
+        self.token = token
+        self.connector = connector
+        self.task = task
+        self.started_at = time.time()
+
+
+class WorkflowRunner:
+    """
+    Runs one connector per active workflow inside the current event loop.
+
+    A workflow is active when it is_active, its status is 'running' and it
+    has a telegram_token. The table is re-read every `poll_interval`
+    seconds: new active workflows are started, workflows that were stopped
+    or got another token are stopped (their queued outgoing messages are
+    flushed first). All connectors feed the same dispatcher, with their
+    workflow_id bound, and are registered in engine.connectors so that
+    replies go out through the bot the message came to.
+
+    A connector whose listen() fails is restarted after a pause that
+    doubles on every failure, up to `max_delay`.
+    """
+
+    def __init__(self, db_session_factory, engine, submit, connector_factory=telegram_connector,
+                 poll_interval: float = WORKFLOW_POLL_INTERVAL,
+                 restart_delay: float = WORKFLOW_RESTART_DELAY,
+                 max_delay: float = WORKFLOW_RESTART_MAX_DELAY):
+        self.db_session_factory = db_session_factory  # async_sessionmaker
+        self.engine = engine  # ChatbotEngine
+        self.submit = submit  # MessageDispatcher.submit
+        self.connector_factory = connector_factory
+        self.poll_interval = poll_interval
+        self.restart_delay = restart_delay
+        self.max_delay = max_delay
+
+        self._running = {}  # workflow_id -> _Running
+        self._failures = {}  # workflow_id -> crashes in a row
+        self._retry_at = {}  # workflow_id -> monotonic time of the next start
+        self._task = None
+
+        # Metrics
+        self.started = 0
+        self.stopped = 0
+        self.crashed = 0
+
+    # ───────────────────────────────
+    # Lifecycle
+    # ───────────────────────────────
+
+    async def start(self):
+        await self.sync()
+        self._task = asyncio.create_task(self._run(), name="workflow-runner")
+
+    async def stop_listening(self):
+        """
+        Stop polling the table and stop receiving updates, keeping the
+        connectors open so that messages still in the dispatcher get their
+        replies. Call close() once the dispatcher is drained.
+        """
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for running in self._running.values():
+            running.task.cancel()
+        await asyncio.gather(*(r.task for r in self._running.values()), return_exceptions=True)
+
+    async def close(self):
+        """Stop every running workflow."""
+        await self.stop_listening()
+        for workflow_id in list(self._running):
+            await self._stop(workflow_id)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                print(f"Workflow sync failed: {e}")
+
+    # ───────────────────────────────
+    # Sync with the workflows table
+    # ───────────────────────────────
+
+    async def _active(self) -> dict:
+        async with self.db_session_factory() as db:
+            rows = await db.execute(
+                select(Workflow.id, Workflow.telegram_token).where(
+                    Workflow.is_active.is_(True),
+                    Workflow.status == "running",
+                    Workflow.telegram_token.is_not(None),
+                    Workflow.telegram_token != ""
+                ).order_by(Workflow.id)
+            )
+            active, seen = {}, set()
+            for workflow_id, token in rows:
+                if token in seen:
+                    # Two pollers on one token would steal each other's updates
+                    print(f"Workflow {workflow_id} skipped: its token is used by another workflow")
+                    continue
+                seen.add(token)
+                active[workflow_id] = token
+            return active
+
+    async def sync(self):
+        active = await self._active()
+
+        for workflow_id, running in list(self._running.items()):
+            if running.task.done():
+                await self._crashed(workflow_id, running)
+            elif active.get(workflow_id) != running.token:
+                await self._stop(workflow_id)
+
+        # Forget the backoff of workflows that were stopped meanwhile
+        for workflow_id in list(self._retry_at):
+            if workflow_id not in active:
+                self._retry_at.pop(workflow_id)
+                self._failures.pop(workflow_id, None)
+
+        now = time.monotonic()
+        for workflow_id, token in active.items():
+            if workflow_id not in self._running and self._retry_at.get(workflow_id, 0) <= now:
+                self._start(workflow_id, token)
+
+    def _start(self, workflow_id: int, token: str):
+        connector = self.connector_factory(token)
+        connector.set_callback(functools.partial(self.submit, workflow_id=workflow_id))
+        self.engine.connectors[workflow_id] = connector
+        task = asyncio.create_task(connector.listen(), name=f"workflow-{workflow_id}")
+        self._running[workflow_id] = _Running(token, connector, task)
+        self._retry_at.pop(workflow_id, None)
+        self.started += 1
+        print(f"Workflow {workflow_id} started")
+
+    async def _stop(self, workflow_id: int):
+        running = self._running.pop(workflow_id)
+        running.task.cancel()
+        await asyncio.gather(running.task, return_exceptions=True)
+        await self._release(workflow_id, running)
+        self._failures.pop(workflow_id, None)
+        self.stopped += 1
+        print(f"Workflow {workflow_id} stopped")
+
+    async def _crashed(self, workflow_id: int, running: _Running):
+        self._running.pop(workflow_id)
+        await self._release(workflow_id, running)
+        self.crashed += 1
+
+        failures = self._failures.get(workflow_id, 0) + 1
+        self._failures[workflow_id] = failures
+        delay = min(self.restart_delay * 2 ** (failures - 1), self.max_delay)
+        self._retry_at[workflow_id] = time.monotonic() + delay
+
+        error = running.task.exception() if not running.task.cancelled() else "cancelled"
+        print(f"Workflow {workflow_id} crashed ({error}), restarting in {delay:.0f}s")
+
+    async def _release(self, workflow_id: int, running: _Running):
+        # Messages handled after this point are dropped by the engine
+        if self.engine.connectors.get(workflow_id) is running.connector:
+            del self.engine.connectors[workflow_id]
+        try:
+            await running.connector.close()
+        except Exception as e:
+            print(f"Workflow {workflow_id}: closing the connector failed: {e}")
+
+    # ───────────────────────────────
+    # Metrics
+    # ───────────────────────────────
+
+    def stats(self) -> dict:
+        return {
+            "running": sorted(self._running),
+            "waiting_restart": sorted(self._retry_at),
+            "started": self.started,
+            "stopped": self.stopped,
+            "crashed": self.crashed,
+        }
@@ -1,23 +1,23 @@
-import sqlite3
-
-def fix_db():
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("ALTER TABLE blocks ADD COLUMN ui_x INTEGER DEFAULT 0")
-        print("Added ui_x column")
-    except sqlite3.OperationalError as e:
-        print(f"ui_x might already exist: {e}")
-        
-    try:
-        cursor.execute("ALTER TABLE blocks ADD COLUMN ui_y INTEGER DEFAULT 0")
-        print("Added ui_y column")
-    except sqlite3.OperationalError as e:
-        print(f"ui_y might already exist: {e}")
-        
-    conn.commit()
-    conn.close()
-
-if __name__ == "__main__":
-    fix_db()
+from sqlalchemy import text, inspect
+from database.base import engine as default_engine
+
+
+def fix_db(engine=None):
+    """Add blocks.ui_x / ui_y (editor positions) to databases created before them."""
+    engine = engine or default_engine
+    if not inspect(engine).has_table("blocks"):
+        print("Table blocks not found, nothing to fix")
+        return
+
+    columns = {c["name"] for c in inspect(engine).get_columns("blocks")}
+    with engine.begin() as conn:
+        for column in ("ui_x", "ui_y"):
+            if column in columns:
+                print(f"{column} already exists")
+                continue
+            conn.execute(text(f"ALTER TABLE blocks ADD COLUMN {column} INTEGER DEFAULT 0"))
+            print(f"Added {column} column")
+
+
+if __name__ == "__main__":
+    fix_db()
@@ -1,38 +1,128 @@
-import asyncio
-import os
-from dotenv import load_dotenv
-from database.base import Base, engine, SessionLocal
-from connectors.telegram import TelegramBotProvider
-from engine.core import ChatbotEngine
-
-# Load env
-load_dotenv()
-
-async def main():
-    # 1. Init DB
-    print("Initializing database...")
-    Base.metadata.create_all(bind=engine)
-
-    # 2. Init Connector
-    token = os.getenv("TG_TOKEN")
-    if not token:
-        print("Error: TG_TOKEN not found in .env")
-        return
-
-    connector = TelegramBotProvider(token)
-
-    # 3. Init Engine
-    chatbot_engine = ChatbotEngine(SessionLocal, connector)
-
-    # 4. Link Connector -> Engine
-    connector.set_callback(chatbot_engine.process_message)
-
-    # 5. Start Polling
-    print("Starting bot...")
-    await connector.listen()
-
-if __name__ == "__main__":
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        print("Bot stopped.")
+import asyncio
+import os
+from dotenv import load_dotenv
+from database.base import Base, engine, AsyncSessionLocal
+from connectors.telegram import TelegramBotProvider
+from engine.core import ChatbotEngine
+from engine.dispatcher import MessageDispatcher
+from engine.store import STATE_STORE
+from engine.metrics import render_engine_metrics, start_metrics_server, METRICS_PORT
+from engine.supervisor import ENGINE_WORKERS, Supervisor, preload
+from engine.workflows import WorkflowRunner
+from database.trace_archive import run_retention, TRACE_RETENTION_INTERVAL
+import migrate_user_params
+import migrate_block_heavy
+import migrate_workflows
+
+# Load env
+load_dotenv()
+
+# single - one bot from TG_TOKEN (default), workflows - every running bot of the workflows table
+RUN_MODE = os.getenv("RUN_MODE", "single")
+
+# polling - getUpdates (default), webhook - HTTP server for Telegram updates
+TG_MODE = os.getenv("TG_MODE", "polling")
+TG_WEBHOOK_HOST = os.getenv("TG_WEBHOOK_HOST", "0.0.0.0")
+TG_WEBHOOK_PORT = int(os.getenv("TG_WEBHOOK_PORT", "8080"))
+TG_WEBHOOK_PATH = os.getenv("TG_WEBHOOK_PATH", "/webhook")
+TG_WEBHOOK_SECRET = os.getenv("TG_WEBHOOK_SECRET")
+TG_WEBHOOK_URL = os.getenv("TG_WEBHOOK_URL")  # public https://host, empty = do not call setWebhook
+
+async def trace_retention_loop():
+    # Sync DB work and file IO, kept off the event loop
+    while True:
+        try:
+            await asyncio.to_thread(run_retention)
+        except Exception as e:
+            print(f"Trace retention failed: {e}")
+        await asyncio.sleep(TRACE_RETENTION_INTERVAL * 3600)
+
+async def main():
+    # 1. Init DB
+    print("Initializing database...")
+    Base.metadata.create_all(bind=engine)
+    migrate_user_params.migrate(engine)
+    migrate_block_heavy.migrate(engine)
+    migrate_workflows.migrate(engine)
+
+    # 2. Init Connector
+    # In workflows mode TG_TOKEN is optional: it is still served as workflow 0
+    token = os.getenv("TG_TOKEN")
+    if not token and RUN_MODE != "workflows":
+        print("Error: TG_TOKEN not found in .env")
+        return
+
+    connector = TelegramBotProvider(token, handle_signals=RUN_MODE != "workflows") if token else None
+
+    # 3. Init Engine
+    if ENGINE_WORKERS > 1 and STATE_STORE == "kv":
+        print("Error: STATE_STORE=kv is a single-process store, it needs ENGINE_WORKERS=1")
+        return
+
+    supervisor = None
+    if ENGINE_WORKERS > 1:
+        # The engine runs in forked workers; this process only receives and sends
+        chatbot_engine = ChatbotEngine(AsyncSessionLocal, None)
+        preload(chatbot_engine)
+        supervisor = Supervisor(chatbot_engine, connector)
+    else:
+        chatbot_engine = ChatbotEngine(AsyncSessionLocal, connector)
+
+    # 4. Link Connector -> Dispatcher -> Engine
+    #    (or Connector -> Supervisor -> a worker's Dispatcher -> Engine)
+    dispatcher = supervisor or MessageDispatcher(chatbot_engine.process_message)
+    await dispatcher.start()
+    if connector:
+        connector.set_callback(dispatcher.submit)
+
+    workflow_runner = None
+    if RUN_MODE == "workflows":
+        # Connectors are registered where replies are sent from
+        workflow_runner = WorkflowRunner(AsyncSessionLocal, supervisor or chatbot_engine, dispatcher.submit)
+        await workflow_runner.start()
+
+    # 5. Background maintenance
+    retention_task = None
+    if TRACE_RETENTION_INTERVAL > 0:
+        retention_task = asyncio.create_task(trace_retention_loop())
+
+    metrics_runner = None
+    if METRICS_PORT > 0:
+        if supervisor:
+            metrics_runner = await start_metrics_server(
+                supervisor, render=lambda s: render_engine_metrics(s) + s.render_workers()
+            )
+        else:
+            metrics_runner = await start_metrics_server(chatbot_engine)
+
+    # 6. Start Polling / Webhook
+    print("Starting bot...")
+    try:
+        if connector is None:
+            # Only the workflows: run until interrupted
+            await asyncio.Event().wait()
+        elif TG_MODE == "webhook":
+            await connector.listen_webhook(TG_WEBHOOK_HOST, TG_WEBHOOK_PORT, TG_WEBHOOK_PATH,
+                                           TG_WEBHOOK_SECRET, TG_WEBHOOK_URL)
+        else:
+            await connector.listen()
+    finally:
+        if retention_task:
+            retention_task.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if workflow_runner:
+            await workflow_runner.stop_listening()
+        await dispatcher.close()
+        if workflow_runner:
+            await workflow_runner.close()
+        if not supervisor:
+            await chatbot_engine.close()
+        if connector:
+            await connector.close()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("Bot stopped.")
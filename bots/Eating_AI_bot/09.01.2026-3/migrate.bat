@@ -1,2 +1,2 @@
-python migrate_v2.py
-pause
+python migrate_v2.py
+pause
@@ -0,0 +1,24 @@
+from sqlalchemy import text, inspect
+from database.base import engine as default_engine
+
+
+def migrate(engine=None):
+    """
+    Add blocks.is_heavy to databases created before it existed.
+    Safe to run repeatedly; main.py, admin.py and seed.py run it on start.
+    """
+    engine = engine or default_engine
+    if not inspect(engine).has_table("blocks"):
+        return
+
+    columns = {c["name"] for c in inspect(engine).get_columns("blocks")}
+    if "is_heavy" in columns:
+        return
+
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE blocks ADD COLUMN is_heavy BOOLEAN DEFAULT FALSE"))
+    print("Added is_heavy column to blocks")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,94 @@
+"""
+Move user params between the two storage layouts:
+
+    python migrate_param_storage.py document   # user_params rows -> user_documents
+    python migrate_param_storage.py rows       # user_documents -> user_params rows
+
+Set PARAM_STORAGE in .env to the same value afterwards and restart the bot.
+Runs in batches of --batch users, one transaction each; safe to re-run after
+an interruption.
+"""
+import argparse
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.orm import Session
+from database.base import Base, engine as default_engine
+from database.models import UserDocument, UserParam
+from database.params import decode_document, upsert_document, upsert_params
+import migrate_user_params
+import migrate_workflows
+
+
+def to_document(db: Session, batch: int = 1000) -> int:
+    dialect = db.get_bind().dialect.name
+    moved = 0
+    while True:
+        users = db.execute(
+            select(UserParam.workflow_id, UserParam.user_id, UserParam.platform).distinct()
+            .order_by(UserParam.workflow_id, UserParam.user_id, UserParam.platform).limit(batch)
+        ).all()
+        if not users:
+            return moved
+
+        keys = [tuple(u) for u in users]
+        in_batch = tuple_(UserParam.workflow_id, UserParam.user_id, UserParam.platform).in_(keys)
+
+        documents = {key: {} for key in keys}
+        for data_workflow, data_user, data_platform, data in db.execute(
+            select(UserDocument.workflow_id, UserDocument.user_id, UserDocument.platform, UserDocument.data)
+            .where(tuple_(UserDocument.workflow_id, UserDocument.user_id, UserDocument.platform).in_(keys))
+        ):
+            documents[(data_workflow, data_user, data_platform)] = decode_document(data)
+        for workflow_id, user_id, platform, key, value in db.execute(
+            select(UserParam.workflow_id, UserParam.user_id, UserParam.platform, UserParam.key, UserParam.value)
+            .where(in_batch)
+        ):
+            # Rows are what the bot used last, they win over an older document
+            documents[(workflow_id, user_id, platform)][key] = value
+
+        for (workflow_id, user_id, platform), values in documents.items():
+            db.execute(upsert_document(dialect, user_id, platform, values, workflow_id))
+        db.execute(delete(UserParam).where(in_batch))
+        db.commit()
+        moved += len(keys)
+        print(f"Moved {moved} users to user_documents")
+
+
+def to_rows(db: Session, batch: int = 1000) -> int:
+    dialect = db.get_bind().dialect.name
+    moved = 0
+    while True:
+        documents = db.execute(
+            select(UserDocument.workflow_id, UserDocument.user_id, UserDocument.platform, UserDocument.data)
+            .order_by(UserDocument.workflow_id, UserDocument.user_id, UserDocument.platform).limit(batch)
+        ).all()
+        if not documents:
+            return moved
+
+        for workflow_id, user_id, platform, data in documents:
+            values = decode_document(data)
+            if values:
+                db.execute(upsert_params(dialect, user_id, platform, values, workflow_id))
+        db.execute(delete(UserDocument).where(
+            tuple_(UserDocument.workflow_id, UserDocument.user_id, UserDocument.platform)
+            .in_([(d[0], d[1], d[2]) for d in documents])
+        ))
+        db.commit()
+        moved += len(documents)
+        print(f"Moved {moved} users to user_params")
+
+
+def migrate(target: str, engine=None, batch: int = 1000) -> int:
+    engine = engine or default_engine
+    Base.metadata.create_all(bind=engine)
+    migrate_user_params.migrate(engine)  # upsert_params needs the unique index
+    migrate_workflows.migrate(engine)
+    with Session(engine) as db:
+        return to_document(db, batch) if target == "document" else to_rows(db, batch)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move user params between storage layouts")
+    parser.add_argument("target", choices=["document", "rows"])
+    parser.add_argument("--batch", type=int, default=1000, help="users per transaction")
+    args = parser.parse_args()
+    print(f"Done, {migrate(args.target, batch=args.batch)} users moved.")
@@ -0,0 +1,80 @@
+"""
+Copy user sessions and params between the SQL tables and the kv state file:
+
+    python migrate_state_store.py kv     # user_sessions + params -> STATE_KV_PATH
+    python migrate_state_store.py sql    # STATE_KV_PATH -> user_sessions + params
+
+Stop the bot first (it holds a lock on the kv file), set STATE_STORE in
+.env to the same value afterwards and start it again. The source is left
+as it is; users already in the target are overwritten. Params are read
+and written in the PARAM_STORAGE layout.
+"""
+import argparse
+import asyncio
+from sqlalchemy import select, union
+from database.base import AsyncSessionLocal, Base, async_engine, engine
+from database.models import UserDocument, UserParam, UserSession
+from database.params import PARAM_STORAGE
+from engine.state import UserState
+from engine.store import STATE_KV_PATH, KvStateStore
+import migrate_user_params
+import migrate_workflows
+
+
+def _mark_all(state: UserState):
+    state.dirty = set(state.values)
+    state.session_dirty = state.session is not None
+
+
+async def to_kv(store: KvStateStore) -> int:
+    params = UserDocument if PARAM_STORAGE == "document" else UserParam
+    moved = 0
+    async with AsyncSessionLocal() as db:
+        keys = (await db.execute(union(
+            select(UserSession.workflow_id, UserSession.user_id, UserSession.platform),
+            select(params.workflow_id, params.user_id, params.platform)
+        ))).all()
+        for workflow_id, user_id, platform in keys:
+            state = await UserState.load(db, user_id, platform, PARAM_STORAGE, workflow_id)
+            _mark_all(state)
+            await store.save(db, state, [])
+            await store.committed(state.key)
+            moved += 1
+            if moved % 1000 == 0:
+                print(f"Copied {moved} users to {store.path}")
+    return moved
+
+
+async def to_sql(store: KvStateStore, batch: int = 1000) -> int:
+    moved = 0
+    async with AsyncSessionLocal() as db:
+        for workflow_id, user_id, platform in store.keys():
+            state = await store.load(db, workflow_id, user_id, platform)
+            _mark_all(state)
+            await state.write_back(db)
+            moved += 1
+            if moved % batch == 0:
+                await db.commit()
+                print(f"Copied {moved} users to the database")
+        await db.commit()
+    return moved
+
+
+async def migrate(target: str, path: str = STATE_KV_PATH) -> int:
+    Base.metadata.create_all(bind=engine)
+    migrate_user_params.migrate(engine)
+    migrate_workflows.migrate(engine)
+    store = KvStateStore(path, sync="none")
+    try:
+        return await (to_kv(store) if target == "kv" else to_sql(store))
+    finally:
+        store.close()
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy user state between SQL and the kv file")
+    parser.add_argument("target", choices=["kv", "sql"])
+    parser.add_argument("--path", default=STATE_KV_PATH, help="kv file (default STATE_KV_PATH)")
+    args = parser.parse_args()
+    print(f"Done, {asyncio.run(migrate(args.target, args.path))} users copied.")
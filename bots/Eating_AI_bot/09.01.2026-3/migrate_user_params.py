@@ -0,0 +1,45 @@
+from sqlalchemy import text, inspect
+from database.base import engine as default_engine
+
+UNIQUE_INDEX = "ux_user_params_user_key"
+OLD_INDEXES = ["ix_user_params_user_id", "ix_user_params_platform"]
+WORKFLOW_INDEX = "ux_user_params_workflow_key"  # its successor, see migrate_workflows.py
+
+
+def migrate(engine=None):
+    """
+    Make (user_id, platform, key) unique in user_params.
+    Duplicates are removed first, keeping the newest row (highest id) of each key.
+    Safe to run repeatedly; main.py runs it on every start.
+    """
+    engine = engine or default_engine
+    if not inspect(engine).has_table("user_params"):
+        return
+
+    existing = {ix["name"] for ix in inspect(engine).get_indexes("user_params")}
+
+    with engine.begin() as conn:
+        if UNIQUE_INDEX not in existing and WORKFLOW_INDEX not in existing:
+            removed = conn.execute(text("""
+                DELETE FROM user_params
+                WHERE id NOT IN (
+                    SELECT MAX(id) FROM user_params GROUP BY user_id, platform, key
+                )
+            """)).rowcount
+            if removed:
+                print(f"Removed {removed} duplicate rows from user_params")
+
+            conn.execute(text(
+                f"CREATE UNIQUE INDEX {UNIQUE_INDEX} ON user_params (user_id, platform, key)"
+            ))
+            print(f"Created unique index {UNIQUE_INDEX}")
+
+        # Covered by the unique index (user_id is its first column)
+        for name in OLD_INDEXES:
+            if name in existing:
+                conn.execute(text(f"DROP INDEX {name}"))
+                print(f"Dropped index {name}")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -1,20 +1,23 @@
-import sqlite3
-
-def migrate():
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("ALTER TABLE bot_users ADD COLUMN username VARCHAR")
-        conn.commit()
-        print("Successfully added username column to bot_users")
-    except sqlite3.OperationalError as e:
-        if "duplicate column" in str(e):
-            print("Column username already exists")
-        else:
-            print(f"Error: {e}")
-    finally:
-        conn.close()
-
-if __name__ == "__main__":
-    migrate()
+from sqlalchemy import text, inspect
+from database.base import engine as default_engine
+
+
+def migrate(engine=None):
+    """Add bot_users.username to databases created before it existed."""
+    engine = engine or default_engine
+    if not inspect(engine).has_table("bot_users"):
+        print("Table bot_users not found, nothing to migrate")
+        return
+
+    columns = {c["name"] for c in inspect(engine).get_columns("bot_users")}
+    if "username" in columns:
+        print("Column username already exists")
+        return
+
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE bot_users ADD COLUMN username VARCHAR"))
+    print("Successfully added username column to bot_users")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -1,97 +1,74 @@
-import sqlite3
-import os
-from passlib.context import CryptContext
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-def migrate():
-    db_path = 'bot.db'
-    if not os.path.exists(db_path):
-        print("Database not found, skipping migration.")
-        return
-
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    try:
-        # 1. Create new tables
-        print("Creating new tables...")
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS admin_users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username VARCHAR NOT NULL UNIQUE,
-            password_hash VARCHAR NOT NULL,
-            role VARCHAR DEFAULT 'user',
-            is_active BOOLEAN DEFAULT 1,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-        
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS workflows (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name VARCHAR NOT NULL,
-            description TEXT,
-            owner_id INTEGER,
-            telegram_token VARCHAR,
-            openai_key VARCHAR,
-            status VARCHAR DEFAULT 'stopped',
-            is_active BOOLEAN DEFAULT 1,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (owner_id) REFERENCES admin_users (id)
-        )
-        """)
-        
-        # 2. Add workflow_id to existing tables
-        tables = ['blocks', 'bot_users', 'user_sessions', 'user_params', 'trace']
-        for table in tables:
-            try:
-                cursor.execute(f"ALTER TABLE {table} ADD COLUMN workflow_id INTEGER REFERENCES workflows(id)")
-                print(f"Added workflow_id to {table}")
-            except sqlite3.OperationalError as e:
-                if "duplicate column" in str(e):
-                    print(f"workflow_id already exists in {table}")
-                else:
-                    print(f"Error adding column to {table}: {e}")
-
-        # 3. Create Default Admin
-        print("Creating default admin...")
-        admin_user = cursor.execute("SELECT * FROM admin_users WHERE username='Admin'").fetchone()
-        if not admin_user:
-            hashed_pw = pwd_context.hash("123456")
-            cursor.execute("INSERT INTO admin_users (username, password_hash, role) VALUES (?, ?, ?)", 
-                           ("Admin", hashed_pw, "admin"))
-            admin_id = cursor.lastrowid
-            print(f"Created Admin user (ID: {admin_id})")
-        else:
-            admin_id = admin_user[0]
-            print("Admin user already exists")
-
-        # 4. Create Default Workflow
-        print("Creating default workflow...")
-        workflow = cursor.execute("SELECT * FROM workflows WHERE name='Legacy Workflow'").fetchone()
-        if not workflow:
-            cursor.execute("INSERT INTO workflows (name, description, owner_id, status) VALUES (?, ?, ?, ?)", 
-                           ("Legacy Workflow", "Imported from previous version", admin_id, "stopped"))
-            workflow_id = cursor.lastrowid
-            print(f"Created Legacy Workflow (ID: {workflow_id})")
-            
-            # 5. Migrate Data
-            print("Migrating data to Legacy Workflow...")
-            for table in tables:
-                cursor.execute(f"UPDATE {table} SET workflow_id = ? WHERE workflow_id IS NULL", (workflow_id,))
-                print(f"Updated {cursor.rowcount} rows in {table}")
-        else:
-            print("Legacy Workflow already exists")
-
-        conn.commit()
-        print("Migration completed successfully.")
-        
-    except Exception as e:
-        print(f"Migration failed: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
-
-if __name__ == "__main__":
-    migrate()
+from passlib.context import CryptContext
+from sqlalchemy import Boolean, Column, DateTime, Integer, MetaData, String, Table, func, inspect, select, text, true
+from database.base import engine as default_engine
+from database.models import Workflow
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# Not mapped in database/models.py; only this migration writes it
+admin_users = Table(
+    "admin_users", MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("username", String, nullable=False, unique=True),
+    Column("password_hash", String, nullable=False),
+    Column("role", String, server_default="user"),
+    Column("is_active", Boolean, server_default=true()),
+    Column("created_at", DateTime, server_default=func.current_timestamp()),
+)
+
+TABLES = ["blocks", "bot_users", "user_sessions", "user_params", "trace"]
+
+
+def migrate(engine=None):
+    """
+    Upgrade a single-bot database to workflows: admin_users and workflows
+    tables and a default Admin. The existing rows stay with the TG_TOKEN
+    bot, workflow 0, so single mode keeps its scenario and users. Runs on
+    SQLite and PostgreSQL; safe to run repeatedly. workflow_id is added
+    without a foreign key: workflow 0 has no workflows row.
+    """
+    engine = engine or default_engine
+    if not inspect(engine).has_table("blocks"):
+        print("Database not found, skipping migration.")
+        return
+
+    try:
+        with engine.begin() as conn:
+            # 1. Create new tables
+            print("Creating new tables...")
+            admin_users.create(conn, checkfirst=True)
+            Workflow.__table__.create(conn, checkfirst=True)
+
+            # 2. Add workflow_id to existing tables
+            inspector = inspect(conn)
+            tables = [t for t in TABLES if inspector.has_table(t)]
+            for table in tables:
+                if "workflow_id" in {c["name"] for c in inspector.get_columns(table)}:
+                    print(f"workflow_id already exists in {table}")
+                    continue
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN workflow_id INTEGER"))
+                print(f"Added workflow_id to {table}")
+
+            # 3. Create Default Admin
+            print("Creating default admin...")
+            admin_id = conn.execute(select(admin_users.c.id).where(admin_users.c.username == "Admin")).scalar()
+            if admin_id is None:
+                admin_id = conn.execute(admin_users.insert().values(
+                    username="Admin", password_hash=pwd_context.hash("123456"), role="admin"
+                )).inserted_primary_key[0]
+                print(f"Created Admin user (ID: {admin_id})")
+            else:
+                print("Admin user already exists")
+
+            # 4. Existing rows belong to the single TG_TOKEN bot (workflow 0);
+            # migrate_workflows.py adopts a "Legacy Workflow" made by older versions
+            for table in tables:
+                result = conn.execute(text(f"UPDATE {table} SET workflow_id = 0 WHERE workflow_id IS NULL"))
+                print(f"Updated {result.rowcount} rows in {table}")
+        print("Migration completed successfully.")
+    except Exception as e:
+        print(f"Migration failed: {e}")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,149 @@
+from sqlalchemy import inspect, select, text
+from database.base import engine as default_engine
+from database.models import Block, BotUser, UserDocument, UserParam, UserSession, Workflow
+
+# Tables whose rows belong to one workflow (bot)
+TABLES = ["blocks", "bot_users", "user_sessions", "user_params", "user_documents", "trace"]
+# Tables whose primary key has to include workflow_id
+KEYED = {"user_sessions": UserSession, "user_documents": UserDocument}
+OLD_UNIQUE_INDEX = "ux_user_params_user_key"
+# Columns identifying one user's row, per table, when legacy rows are adopted
+USER_KEYS = {
+    "bot_users": ("user_id", "platform"),
+    "user_sessions": ("user_id", "platform"),
+    "user_documents": ("user_id", "platform"),
+    "user_params": ("user_id", "platform", "key"),
+}
+# The workflow older versions of migrate_v2.py moved every existing row to
+LEGACY_NAME = "Legacy Workflow"
+LEGACY_DESCRIPTION = "Imported from previous version"
+WORKFLOW_INDEX = "ux_user_params_workflow_key"
+
+
+def _rebuild_sqlite(conn, model, columns: set):
+    """SQLite cannot change a primary key in place: copy the rows into a new table."""
+    table = model.__tablename__
+    copied = [c for c in columns if c != "workflow_id"]
+    workflow = "COALESCE(workflow_id, 0)" if "workflow_id" in columns else "0"
+
+    conn.execute(text(f"ALTER TABLE {table} RENAME TO {table}_old"))
+    model.__table__.create(conn)
+    conn.execute(text(
+        f"INSERT INTO {table} (workflow_id, {', '.join(copied)}) "
+        f"SELECT {workflow}, {', '.join(copied)} FROM {table}_old"
+    ))
+    conn.execute(text(f"DROP TABLE {table}_old"))
+
+
+def _adopt_legacy(conn, tables: list):
+    """
+    Give the rows of a "Legacy Workflow" back to workflow 0 and delete it.
+
+    Older migrate_v2.py moved a single-bot database into such a workflow,
+    leaving the TG_TOKEN bot without blocks. It is only adopted while it
+    has no token of its own (it never ran as a separate bot) and workflow 0
+    has no blocks. Users the TG_TOKEN bot met since then are merged: for
+    each user (and param key) the legacy row wins.
+    """
+    workflows = Workflow.__table__
+    legacy_id = conn.execute(select(workflows.c.id).where(
+        workflows.c.name == LEGACY_NAME, workflows.c.description == LEGACY_DESCRIPTION,
+        workflows.c.telegram_token.is_(None) | (workflows.c.telegram_token == ""),
+    )).scalar()
+    if legacy_id is None:
+        return
+    if conn.execute(text("SELECT 1 FROM blocks WHERE workflow_id = 0")).first():
+        print(f"Workflow 0 has blocks, {LEGACY_NAME} (ID: {legacy_id}) is left as it is")
+        return
+
+    for table in tables:
+        keys = USER_KEYS.get(table)
+        if keys:
+            same_user = " AND ".join(f"legacy.{k} = {table}.{k}" for k in keys)
+            conn.execute(text(
+                f"DELETE FROM {table} WHERE workflow_id = 0 AND EXISTS ("
+                f"SELECT 1 FROM {table} AS legacy WHERE legacy.workflow_id = :legacy AND {same_user})"
+            ), {"legacy": legacy_id})
+        moved = conn.execute(
+            text(f"UPDATE {table} SET workflow_id = 0 WHERE workflow_id = :legacy"), {"legacy": legacy_id}
+        ).rowcount
+        if moved:
+            print(f"Moved {moved} rows of {table} from {LEGACY_NAME} to workflow 0")
+    conn.execute(workflows.delete().where(workflows.c.id == legacy_id))
+    print(f"Deleted {LEGACY_NAME} (ID: {legacy_id})")
+
+
+def migrate(engine=None):
+    """
+    Scope per-bot tables by workflow_id (0 = the TG_TOKEN bot).
+    Existing rows go to workflow 0, including rows that migrate_v2.py
+    left NULL and the rows of a "Legacy Workflow" made by older versions
+    of it (see _adopt_legacy). Safe to run repeatedly; main.py, admin.py
+    and seed.py run it on start.
+    """
+    engine = engine or default_engine
+    sqlite = engine.dialect.name == "sqlite"
+
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in TABLES:
+            if not inspector.has_table(table):
+                continue
+            columns = {c["name"] for c in inspector.get_columns(table)}
+
+            if table in KEYED:
+                pk = inspector.get_pk_constraint(table)
+                if "workflow_id" in pk["constrained_columns"]:
+                    continue
+                if sqlite:
+                    _rebuild_sqlite(conn, KEYED[table], columns)
+                else:
+                    if "workflow_id" not in columns:
+                        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN workflow_id INTEGER NOT NULL DEFAULT 0"))
+                    conn.execute(text(f"UPDATE {table} SET workflow_id = 0 WHERE workflow_id IS NULL"))
+                    conn.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT {pk['name']}"))
+                    conn.execute(text(f"ALTER TABLE {table} ADD PRIMARY KEY (workflow_id, user_id, platform)"))
+                print(f"Added workflow_id to the primary key of {table}")
+                continue
+
+            if "workflow_id" not in columns:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN workflow_id INTEGER NOT NULL DEFAULT 0"))
+                print(f"Added workflow_id to {table}")
+            else:
+                # Added as nullable by migrate_v2.py
+                conn.execute(text(f"UPDATE {table} SET workflow_id = 0 WHERE workflow_id IS NULL"))
+
+        if inspector.has_table("workflows"):
+            _adopt_legacy(conn, [t for t in TABLES if inspector.has_table(t)])
+
+    # Indexes need the columns to be committed first
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for model in (Block, BotUser, UserParam):
+            if not inspector.has_table(model.__tablename__):
+                continue
+            existing = {ix["name"] for ix in inspector.get_indexes(model.__tablename__)}
+            if model is UserParam and WORKFLOW_INDEX not in existing:
+                # admin.py may get here before migrate_user_params.py removed
+                # duplicates; the newest row (highest id) of each key is kept
+                removed = conn.execute(text("""
+                    DELETE FROM user_params
+                    WHERE id NOT IN (
+                        SELECT MAX(id) FROM user_params GROUP BY workflow_id, user_id, platform, key
+                    )
+                """)).rowcount
+                if removed:
+                    print(f"Removed {removed} duplicate rows from user_params")
+            for index in model.__table__.indexes:
+                if "workflow_id" in index.columns and index.name not in existing:
+                    index.create(conn)
+
+        # Replaced by ux_user_params_workflow_key
+        if inspector.has_table("user_params") and \
+                OLD_UNIQUE_INDEX in {ix["name"] for ix in inspector.get_indexes("user_params")}:
+            conn.execute(text(f"DROP INDEX {OLD_UNIQUE_INDEX}"))
+            print(f"Dropped index {OLD_UNIQUE_INDEX}")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -1,2 +1,2 @@
-python main.py
-pause
+python main.py
+pause
@@ -1,4 +1,4 @@
-@echo off
-echo Starting Admin Panel on http://127.0.0.1:8005
-python admin.py
-pause
+@echo off
+echo Starting Admin Panel on http://127.0.0.1:8005
+python admin.py
+pause
@@ -1,16 +1,27 @@
 from database.base import SessionLocal, engine, Base
-from database.models import Block, UserSession, UserParam, Module
+from database.models import Block, UserSession, UserParam, UserDocument, Module
+from database.versions import bump_version, SCENARIO, STATE, USERS
+import migrate_user_params
+import migrate_block_heavy
+import migrate_workflows
 import os
 
 def seed():
     Base.metadata.create_all(bind=engine)
+    migrate_user_params.migrate(engine)
+    migrate_block_heavy.migrate(engine)
+    migrate_workflows.migrate(engine)
     db = SessionLocal()
 
     # Clear existing data
     db.query(UserSession).delete()
     db.query(UserParam).delete()
+    db.query(UserDocument).delete()
     db.query(Block).delete()
     db.query(Module).delete()
+    # The running bot drops its cached sessions and synced profiles
+    bump_version(db, STATE)
+    bump_version(db, USERS)
     db.commit()
 
     # --- MODULES ---
@@ -102,10 +113,8 @@ elif event == 'message':
     # --- CALCULATION (20) ---
     script_20 = f"""
 if event == 'enter':
-    age = get_param('age')
-    gender = get_param('gender')
-    height = get_param('height')
-    weight = get_param('weight')
+    p = get_params(['age', 'gender', 'height', 'weight'])
+    age, gender, height, weight = p['age'], p['gender'], p['height'], p['weight']
 
     if not (age and gender and height and weight):
         send_message("Недостаточно данных. Пожалуйста, заполните анкету.", {MAIN_MENU})
@@ -173,6 +182,7 @@ elif event == 'message':
     for b in blocks:
         db.add(b)
     
+    bump_version(db, SCENARIO)
     db.commit()
     print("Database seeded successfully with Modules and AI flow.")
     db.close()